@@ -0,0 +1,60 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+The exceptions and the helpers shared by the API and the backends.
+
+They are kept apart from the API, so that the backends that are imported
+by name raise the exceptions that the API handles even when the API runs
+as a script.
+"""
+
+
+class ResultNotFound(Exception):
+    """
+    Exception indicating that a result with a given identifier is not found.
+    """
+
+
+class BadResultId(ResultNotFound):
+    """
+    The identifier is not recognized as a valid ID by a backend.
+    """
+
+
+class BadRequest(Exception):
+    """
+    Bad request parameters or content.
+    """
+
+
+def _project(document, fields):
+    """
+    Make a projection of a document onto the given fields.
+
+    As in a MongoDB projection, the fields are paths of keys joined by
+    dots and the missing fields are left out.  The values are shared with
+    the document rather than copied, so the cost does not depend on the
+    size of the fields that are left out.
+
+    :param dict document: The document.
+    :param fields: The list of the fields to include, or None for all
+        the fields.
+    :return: The projection.
+    """
+    if fields is None:
+        return document
+    projection = {}
+    for field in fields:
+        source, target = document, projection
+        keys = field.split('.')
+        for key in keys[:-1]:
+            source = source.get(key)
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(key, {})
+            if target is source:
+                # The whole subdocument is already included.
+                break
+        else:
+            if keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+    return projection
@@ -0,0 +1,131 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+The helpers shared by the indexes that are updated as the results are
+stored and rebuilt from the backend.
+"""
+
+from math import isinf, isnan
+from numbers import Number
+
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred
+from twisted.python.log import err, msg
+
+
+def is_finite(value):
+    """
+    Check whether a number is finite, as a float.
+    """
+    try:
+        return not (isinf(value) or isnan(value))
+    except OverflowError:
+        # An integer too large for a float.
+        return False
+
+
+def value_of(result):
+    """
+    Get the numeric value of a result, or None if it has none.
+
+    The JSON decoder accepts ``Infinity`` and ``NaN``, which are stored
+    like any other value but are not taken as numeric values.
+    """
+    value = result.get('result')
+    if isinstance(value, bool) or not isinstance(value, Number):
+        return None
+    if not is_finite(value):
+        return None
+    return value
+
+
+def read_all(backend, got_entries, page_size=1000):
+    """
+    Read all the results in a backend a page at a time, from the latest to
+    the oldest.
+
+    :param IBackend backend: The backend.
+    :param got_entries: The function to call with the identifiers and the
+        results of every page, as a list of pairs.
+    :param int page_size: The number of the results to read at once.
+    :return: A Deferred that fires when all the results have been read.
+    """
+    def got_page(entries, cursor):
+        got_entries(entries)
+        return cursor
+
+    return read_pages(backend, got_page, page_size=page_size)
+
+
+def read_pages(backend, got_page, cursor=None, page_size=1000, fields=None):
+    """
+    Read the results in a backend a page at a time, from the latest to the
+    oldest, for as long as wanted.
+
+    :param IBackend backend: The backend.
+    :param got_page: The function to call with the identifiers and the
+        results of every page, as a list of pairs, and the cursor of the
+        next page.  It returns the cursor to read the next page from, or
+        None to stop.
+    :param cursor: The cursor to start from, or None for the latest
+        result.
+    :param int page_size: The number of the results to read at once.
+    :param fields: The fields of the results to read, or None for all of
+        them.
+    :return: A Deferred that fires when the reading stops.
+    """
+    done = Deferred()
+
+    def fetch(cursor):
+        # Read the pages that are available immediately in a loop, so
+        # that the stack does not grow with the number of pages.
+        while True:
+            d = backend.page({}, page_size, cursor, fields)
+            d.addCallback(lambda page: got_page(*page))
+            if not d.called:
+                d.addCallbacks(fetched, done.errback)
+                return
+            cursors = []
+            d.addCallbacks(cursors.append, done.errback)
+            if not cursors:
+                return
+            [cursor] = cursors
+            if cursor is None:
+                done.callback(None)
+                return
+
+    def fetched(cursor):
+        if cursor is None:
+            done.callback(None)
+        else:
+            fetch(cursor)
+
+    fetch(cursor)
+    return done
+
+
+class RebuildService(Service):
+    """
+    A service that rebuilds an index from the backend when started.
+
+    :ivar str description: What the index holds, for the log.
+    """
+    description = "index"
+
+    def __init__(self, index, backend):
+        """
+        :param index: The index to rebuild, with a ``rebuild`` method
+            like ``SketchIndex.rebuild``.
+        """
+        self.index = index
+        self.backend = backend
+
+    def startService(self):
+        Service.startService(self)
+        msg("rebuilding the {}".format(self.description))
+        d = self.index.rebuild(self.backend)
+        d.addCallbacks(
+            lambda _: msg("rebuilt the {}".format(self.description)),
+            lambda failure: err(
+                failure, "Rebuilding the {} failed".format(self.description)
+            ),
+        )
@@ -27,15 +27,27 @@ class IBackend(Interface):
             result.
         """
 
-    def retrieve(id):
+    def store_many(results):
+        """
+        Store several benchmarking results.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers for
+            the stored results, in the order of the results.
+        """
+
+    def retrieve(id, fields=None):
         """
         Retrieve a previously stored result by its identifier.
 
         :param id: The identifier of the result.
+        :param fields: The list of the fields of the result to return, or
+            None for all the fields.  The fields of subdocuments are given
+            as paths joined by dots.
         :return: A Deferred that fires with the result in the JSON format.
         """
 
-    def query(filter, limit):
+    def query(filter, limit, fields=None):
         """
         Retrieve previously stored results that match the given filter.
 
@@ -45,10 +57,51 @@ class IBackend(Interface):
         :param dict filter: The filter in the JSON compatible format.
         :param int limit: The number of the results to return. The
             results are sorted by their timestamp in descending order.
+        :param fields: The list of the fields of the results to return,
+            as for ``retrieve``.
         :return: A Deferred that fires with a list of the results
             in the JSON compatible format.
         """
 
+    def latest(filter, key, limit=None, fields=None):
+        """
+        Retrieve the latest of the matching results for every value of a
+        userdata field.
+
+        The results without the field are not included.
+
+        :param dict filter: The filter in the JSON compatible format.
+        :param str key: The userdata field to group the results by, e.g.
+            ``branch``.
+        :param int limit: The maximum number of the results to return, or
+            None for all of them.  The results are sorted by their
+            timestamp in descending order.
+        :param fields: The list of the fields of the results to return,
+            as for ``retrieve``.
+        :return: A Deferred that fires with a list of the results in the
+            JSON compatible format.
+        """
+
+    def page(filter, limit, cursor=None, fields=None):
+        """
+        Retrieve a page of previously stored results that match the given
+        filter.
+
+        Iterating over the pages returns the same results as ``query``,
+        in the same order, without retrieving all of them at once.
+
+        :param dict filter: The filter in the JSON compatible format.
+        :param limit: The maximum number of the results in the page, a
+            positive integer, or None for all the remaining results.
+        :param str cursor: The cursor returned with the previous page, or
+            None for the first page.
+        :param fields: The list of the fields of the results to return,
+            as for ``retrieve``.
+        :return: A Deferred that fires with a tuple of a list of
+            ``(id, result)`` pairs and the cursor for the next page.  The
+            cursor is None if there are no more results.
+        """
+
     def delete(id):
         """
         Delete a previously stored result by its identifier.
@@ -56,3 +109,19 @@ class IBackend(Interface):
         :param id: The identifier of the result.
         :return: A Deferred that fires when the result is removed.
         """
+
+    def load(entries):
+        """
+        Store results in bulk, keeping the identifiers they had when they
+        were dumped from a backend of the same kind.
+
+        This is the fast path for restoring the results, so the backends
+        may trust the identifiers rather than check them against the
+        results.  The results already stored under their identifiers are
+        left as they are, so an interrupted load can be repeated.
+
+        :param list entries: The ``(id, result)`` pairs.  A result gets a
+            new identifier if its identifier is None or can not be kept.
+        :return: A Deferred that produces a list of the identifiers of the
+            results, in the order of the entries.
+        """
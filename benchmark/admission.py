@@ -0,0 +1,230 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Admission control for the HTTP API.
+
+Requests are grouped into route classes, e.g. reads and writes.  Each
+class can have a limit on the number of requests processed concurrently
+and a bounded queue of the requests waiting to be processed.  Requests
+that do not fit into the queue are rejected, so that an overloaded server
+sheds load instead of accumulating pending work without bound.
+"""
+
+from collections import deque
+
+from twisted.internet.defer import (
+    CancelledError, Deferred, fail, maybeDeferred, succeed
+)
+from twisted.python.failure import Failure
+from twisted.web.server import Request, Site
+
+
+class Overloaded(Exception):
+    """
+    The server can not accept more requests at the moment.
+    """
+
+
+class DeadlineExceeded(Overloaded):
+    """
+    A request was not processed within its deadline.
+    """
+
+
+class RequestTooLarge(Exception):
+    """
+    The request body is larger than allowed.
+    """
+
+
+class _Limiter(object):
+    """
+    A limit on the number of concurrent operations with a bounded queue
+    of the operations waiting to start.
+    """
+    def __init__(self, concurrency, queue_size):
+        """
+        :param int concurrency: The maximum number of the concurrent
+            operations.
+        :param int queue_size: The maximum number of the waiting
+            operations.
+        """
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiting = deque()
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def acquire(self):
+        """
+        Acquire a slot for an operation.
+
+        :return: A Deferred that fires when the slot is acquired.  It
+            fails with ``Overloaded`` if the queue is full.  Cancelling
+            the Deferred removes the operation from the queue.
+        """
+        if self.active < self.concurrency:
+            self.active += 1
+            return succeed(None)
+        if len(self._waiting) >= self.queue_size:
+            return fail(Overloaded())
+        d = Deferred(self._waiting.remove)
+        self._waiting.append(d)
+        return d
+
+    def release(self):
+        """
+        Release a slot of a completed operation.
+        """
+        if self._waiting:
+            # The slot is passed to the next operation directly.
+            self._waiting.popleft().callback(None)
+        else:
+            self.active -= 1
+
+
+class AdmissionControl(object):
+    """
+    Admission control for the requests of the different route classes.
+
+    :ivar int retry_after: The number of seconds the rejected clients
+        are advised to wait before retrying.
+    """
+    def __init__(self, reactor, concurrency=None, queue_size=0,
+                 timeout=None, retry_after=1, timeouts=None):
+        """
+        :param reactor: The reactor used for the deadlines.
+        :param dict concurrency: The maximum number of the concurrent
+            requests for each route class.  Route classes that are not
+            in the dictionary are not limited.
+        :param int queue_size: The maximum number of the requests waiting
+            for each limited route class.
+        :param float timeout: The number of seconds a request may take,
+            including the time spent in the queue.  If the request is not
+            processed by then, its processing is cancelled.  None means
+            no deadline.
+        :param int retry_after: The number of seconds the rejected
+            clients are advised to wait before retrying.
+        :param dict timeouts: The timeouts for the route classes that do
+            not use the common one.  None means no deadline for the
+            class.
+        """
+        self._reactor = reactor
+        self._limiters = {
+            route_class: _Limiter(limit, queue_size)
+            for route_class, limit in (concurrency or {}).iteritems()
+        }
+        self._timeout = timeout
+        self._timeouts = timeouts or {}
+        self.retry_after = retry_after
+
+    def run(self, route_class, f, *args, **kwargs):
+        """
+        Admit a request and process it.
+
+        :param str route_class: The class of the request.
+        :param f: The function that processes the request.
+        :return: A Deferred that fires with the result of ``f``.  It fails
+            with ``Overloaded`` if the request is rejected and with
+            ``DeadlineExceeded`` if the processing does not complete in
+            time.
+        """
+        limiter = self._limiters.get(route_class)
+        if limiter is None:
+            d = maybeDeferred(f, *args, **kwargs)
+        else:
+            def admitted(_):
+                processed = maybeDeferred(f, *args, **kwargs)
+
+                def release(result):
+                    limiter.release()
+                    return result
+
+                processed.addBoth(release)
+                return processed
+
+            d = limiter.acquire()
+            d.addCallback(admitted)
+
+        timeout = self._timeouts.get(route_class, self._timeout)
+        if timeout is None:
+            return d
+
+        expired = []
+
+        def expire():
+            expired.append(True)
+            d.cancel()
+
+        def check_deadline(result):
+            if timer.active():
+                timer.cancel()
+            if (expired and isinstance(result, Failure) and
+                    result.check(CancelledError)):
+                raise DeadlineExceeded()
+            return result
+
+        timer = self._reactor.callLater(timeout, expire)
+        d.addBoth(check_deadline)
+        return d
+
+
+class LimitedRequest(Request):
+    """
+    A request that discards its body if the body exceeds the size limit
+    of the site, instead of buffering it.
+
+    :ivar bool body_too_large: Whether the body has been discarded.
+    """
+    body_too_large = False
+
+    def _max_body_size(self):
+        return getattr(self.channel.site, 'max_body_size', None)
+
+    def gotLength(self, length):
+        limit = self._max_body_size()
+        if limit is not None and length is not None and length > limit:
+            self.body_too_large = True
+            length = 0
+        Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.body_too_large:
+            return
+        limit = self._max_body_size()
+        if limit is not None and self.content.tell() + len(data) > limit:
+            self.body_too_large = True
+            self.content.seek(0)
+            self.content.truncate()
+            return
+        Request.handleContentChunk(self, data)
+
+
+class LimitedSite(Site):
+    """
+    A site that limits the size of the request bodies.
+
+    :ivar int max_body_size: The maximum size of a request body in bytes,
+        or None for no limit.
+    """
+    requestFactory = LimitedRequest
+
+    def __init__(self, resource, max_body_size=None, **kwargs):
+        Site.__init__(self, resource, **kwargs)
+        self.max_body_size = max_body_size
+
+
+def read_body(request):
+    """
+    Read the body of a request.
+
+    :param twisted.web.http.Request request: The request.
+    :raises RequestTooLarge: If the body has been discarded because of
+        its size.
+    :return: The body.
+    """
+    if getattr(request, 'body_too_large', False):
+        raise RequestTooLarge()
+    return request.content.read()
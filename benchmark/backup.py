@@ -0,0 +1,285 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Dump the results of any backend to an archive and restore them.
+
+An archive is a gzip compressed stream of JSON documents, one per line.
+The first line describes the archive::
+
+    {"version": 1, "backend": "benchmark.httpapi:InMemoryBackend"}
+
+and every other line holds a result with its identifier::
+
+    {"id": "...", "result": {...}}
+
+The results are dumped a page at a time from the latest to the oldest,
+so the archive is in the order of their timestamps and a dump of any size
+holds one page in memory.  They are restored in batches through the bulk
+``load`` of the backend, which keeps their identifiers when the archive
+was dumped from a backend of the same kind.
+
+The in-memory backends hold the results of the server they run in, so
+this command can not reach them.  Their results are dumped through the
+routing backend pointed at the server, and restored by the server itself
+with its ``--restore`` option as it starts.
+"""
+
+import sys
+from gzip import GzipFile
+from io import BufferedReader, BufferedWriter
+from itertools import islice
+from json import dumps, loads
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.internet.task import react
+from twisted.python.usage import Options, UsageError
+
+from ._indexes import read_all
+from .httpapi import BackendOptions, in_process_backends
+
+ARCHIVE_VERSION = 1
+
+
+class BadArchive(Exception):
+    """
+    The archive is not valid.
+    """
+
+
+def _kind(backend):
+    """
+    Get the kind of a backend, whose identifiers it can keep.
+    """
+    return '{}:{}'.format(type(backend).__module__, type(backend).__name__)
+
+
+def dump(backend, f, page_size=1000):
+    """
+    Write all the results in a backend to an archive.
+
+    :param IBackend backend: The backend.
+    :param f: The file to write the uncompressed archive to.
+    :param int page_size: The number of the results to read at once.
+    :return: A Deferred that fires with the number of the dumped results.
+    """
+    f.write(
+        dumps({'version': ARCHIVE_VERSION, 'backend': _kind(backend)}) +
+        b'\n'
+    )
+    counts = []
+
+    def got_entries(entries):
+        f.write(b''.join(
+            dumps({'id': id, 'result': result}) + b'\n'
+            for id, result in entries
+        ))
+        counts.append(len(entries))
+
+    d = read_all(backend, got_entries, page_size)
+    d.addCallback(lambda _: sum(counts))
+    return d
+
+
+def _read_header(f):
+    """
+    Read the first line of an archive.
+
+    :return: The kind of the backend the archive was dumped from.
+    """
+    try:
+        header = loads(f.readline())
+        version = header['version']
+        backend = header['backend']
+    except (ValueError, KeyError, TypeError):
+        raise BadArchive("Invalid archive header")
+    if version != ARCHIVE_VERSION:
+        raise BadArchive("Unsupported archive version {}".format(version))
+    return backend
+
+
+def _read_entries(f, count, keep_ids):
+    """
+    Read the next results of an archive.
+
+    :param int count: The maximum number of the results to read.
+    :param bool keep_ids: Whether to read the identifiers of the results,
+        rather than give them None.
+    :return: A list of the ``(id, result)`` pairs, empty at the end of the
+        archive.
+    """
+    entries = []
+    for line in islice(f, count):
+        try:
+            entry = loads(line)
+            id = entry['id'] if keep_ids else None
+            result = entry['result']
+        except (ValueError, KeyError, TypeError):
+            raise BadArchive("Invalid archive entry {!r}".format(line))
+        if not isinstance(result, dict):
+            raise BadArchive("Invalid archive entry {!r}".format(line))
+        entries.append((id, result))
+    return entries
+
+
+def restore(backend, f, batch_size=10000):
+    """
+    Load the results in an archive into a backend.
+
+    The results keep their identifiers if the archive was dumped from a
+    backend of the same kind.  The results already stored under their
+    identifiers are left as they are, so an interrupted restore can be
+    repeated.
+
+    :param IBackend backend: The backend.
+    :param f: The file to read the uncompressed archive from.
+    :param int batch_size: The number of the results to load at once.
+    :return: A Deferred that fires with the number of the restored
+        results, or fails with ``BadArchive``.
+    """
+    try:
+        keep_ids = _read_header(f) == _kind(backend)
+    except BadArchive:
+        return fail()
+    done = Deferred()
+    restored = []
+
+    def load(_=None):
+        # Load the batches that are stored immediately in a loop, so that
+        # the stack does not grow with the number of the batches.
+        while True:
+            try:
+                entries = _read_entries(f, batch_size, keep_ids)
+            except BadArchive:
+                done.errback()
+                return
+            if not entries:
+                done.callback(sum(restored))
+                return
+            restored.append(len(entries))
+            d = maybeDeferred(backend.load, entries)
+            if not d.called:
+                d.addCallbacks(load, done.errback)
+                return
+            failures = []
+            d.addErrback(failures.append)
+            if failures:
+                done.errback(failures[0])
+                return
+
+    load()
+    return done
+
+
+def restore_archive(backend, path, batch_size=10000):
+    """
+    Load the results in a gzip compressed archive into a backend, as
+    ``restore`` does.
+
+    :param IBackend backend: The backend.
+    :param str path: The path of the archive.
+    :param int batch_size: The number of the results to load at once.
+    :return: A Deferred that fires with the number of the restored
+        results, or fails with ``BadArchive``.
+    """
+    f = BufferedReader(GzipFile(path, 'rb'))
+    d = restore(backend, f, batch_size)
+
+    def close(passthrough):
+        f.close()
+        return passthrough
+
+    d.addBoth(close)
+    return d
+
+
+class _ArchiveOptions(BackendOptions):
+    synopsis = "[options] <archive>"
+
+    def parseArgs(self, archive):
+        self['archive'] = archive
+
+    def postOptions(self):
+        name = self['backend']
+        if name in in_process_backends:
+            raise UsageError(
+                "The {} backend keeps the results in the memory of the "
+                "server, use the routing backend with the server as its "
+                "node to dump them and the --restore option of the server "
+                "to restore them".format(name)
+            )
+        BackendOptions.postOptions(self)
+
+
+class DumpOptions(_ArchiveOptions):
+    longdesc = "Dump all the results of a backend to an archive"
+
+    optParameters = [
+        ['page-size', None, 1000,
+         "The number of the results to read from the backend at once", int],
+    ]
+
+
+class RestoreOptions(_ArchiveOptions):
+    longdesc = "Restore the results in an archive to a backend"
+
+    optParameters = [
+        ['batch-size', None, 10000,
+         "The number of the results to load into the backend at once", int],
+    ]
+
+
+class BackupOptions(Options):
+    longdesc = (
+        "Dump the results of a backend to a gzip compressed archive, or "
+        "restore them"
+    )
+
+    subCommands = [
+        ['dump', None, DumpOptions, "Dump the results to an archive"],
+        ['restore', None, RestoreOptions,
+         "Restore the results from an archive"],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise UsageError("Choose dump or restore")
+
+
+def main(reactor, args):
+    try:
+        options = BackupOptions()
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write(e.args[0])
+        sys.stderr.write('\n\n')
+        sys.stderr.write(options.getSynopsis())
+        sys.stderr.write('\n')
+        sys.stderr.write(options.getUsage())
+        raise SystemExit(1)
+
+    command = options.subOptions
+    backend = command['backend']
+    if options.subCommand == 'dump':
+        f = BufferedWriter(GzipFile(command['archive'], 'wb', 6))
+        d = dump(backend, f, command['page-size'])
+        done = "Dumped {} results\n"
+    else:
+        f = None
+        d = restore_archive(
+            backend, command['archive'], command['batch-size']
+        )
+        done = "Restored {} results\n"
+
+    def close(passthrough):
+        if f is not None:
+            f.close()
+        d = maybeDeferred(backend.disconnect)
+        d.addCallback(lambda _: passthrough)
+        return d
+
+    d.addCallback(lambda count: sys.stderr.write(done.format(count)))
+    d.addBoth(close)
+    return d
+
+
+if __name__ == '__main__':
+    react(main, (sys.argv[1:],))
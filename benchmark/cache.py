@@ -0,0 +1,102 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+A cache of the stored results.
+"""
+
+from collections import OrderedDict
+from json import dumps
+
+
+class ResultCache(object):
+    """
+    A least recently used cache of results, bounded by the total size of
+    their JSON encoding.
+
+    The results are never modified once stored, so a cached result is
+    valid until the result is deleted.
+
+    :ivar int hits: The number of the lookups that found a result.
+    :ivar int misses: The number of the lookups that did not.
+    :ivar int size: The total size of the cached results.
+    :ivar int generation: A number that changes whenever a result is
+        invalidated.  A result read from the storage may only be added if
+        no result was invalidated since the read started.
+    """
+    def __init__(self, max_size):
+        """
+        :param int max_size: The maximum total size of the cached results
+            in bytes.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def describe(self):
+        """
+        Describe the use of the cache since it was created.
+
+        :return: A line with the hit rate and the size of the cache, for
+            the log.
+        """
+        lookups = self.hits + self.misses
+        rate = float(self.hits) / lookups if lookups else 0
+        return (
+            "result cache: {} hits, {} misses ({:.0%} hit rate), "
+            "{} results in {} of {} bytes".format(
+                self.hits, self.misses, rate, len(self), self.size,
+                self.max_size,
+            )
+        )
+
+    def get(self, id):
+        """
+        Look up a result.
+
+        :return: The result or None if it is not cached.
+        """
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move the result to the most recently used end.
+        self._entries[id] = entry
+        return entry[0]
+
+    def put(self, id, result, generation=None):
+        """
+        Add a result.
+
+        :param generation: The generation at the start of the read of the
+            result, if it was read from the storage.  The result is not
+            added if a result has been invalidated since.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        size = len(dumps(result))
+        if size > self.max_size:
+            return
+        self._remove(id)
+        self._entries[id] = (result, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def invalidate(self, id):
+        """
+        Remove a result.
+        """
+        self.generation += 1
+        self._remove(id)
+
+    def _remove(self, id):
+        entry = self._entries.pop(id, None)
+        if entry is not None:
+            self.size -= entry[1]
@@ -0,0 +1,438 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+A client for the HTTP API of the benchmark results server.
+
+The client keeps persistent connections to the server, batches the
+submitted results into bulk requests and retries failed requests with
+an exponential backoff.  The results are stored with idempotency keys,
+so that the stores are retried safely too.
+"""
+
+from json import dumps, loads
+from StringIO import StringIO
+from urllib import quote, urlencode
+from uuid import uuid4
+
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.internet.task import deferLater
+from twisted.web.client import (
+    Agent, FileBodyProducer, HTTPConnectionPool, RequestNotSent,
+    ResponseFailed, readBody
+)
+from twisted.web.http import (
+    CONFLICT, CREATED, NO_CONTENT, OK, SERVICE_UNAVAILABLE
+)
+from twisted.web.http_headers import Headers
+
+
+class APIError(Exception):
+    """
+    The server responded with an error.
+
+    :ivar int code: The HTTP response code.
+    :ivar message: The error message from the server.
+    :ivar retry_after: The number of seconds the server asked to wait
+        before retrying, or None.
+    """
+    def __init__(self, code, message, retry_after=None):
+        super(APIError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+
+
+# Errors after which the request has certainly not been processed.
+_NOT_SENT_ERRORS = (ConnectError, DNSLookupError, RequestNotSent)
+
+# Errors after which the request may have been processed.
+_NETWORK_ERRORS = _NOT_SENT_ERRORS + (ResponseFailed,)
+
+
+def _make_error(code, body, headers):
+    """
+    Make an ``APIError`` from an error response.
+    """
+    try:
+        message = loads(body)['message']
+    except (ValueError, KeyError, TypeError):
+        message = body
+    retry_after = None
+    if code == SERVICE_UNAVAILABLE:
+        try:
+            retry_after = int(headers.getRawHeaders(b'retry-after')[0])
+        except (TypeError, ValueError):
+            pass
+    return APIError(code, message, retry_after)
+
+
+class BenchmarkClient(object):
+    """
+    A client for the HTTP API of the benchmark results server.
+
+    :ivar int retries: The maximum number of times a request is retried.
+    :ivar float backoff: The delay in seconds before the first retry.  It
+        doubles with every further retry.
+    :ivar float max_backoff: The maximum delay in seconds between the
+        retries.
+    :ivar int batch_size: The number of the submitted results that are
+        sent in one bulk request.
+    :ivar float batch_delay: The number of seconds a submitted result may
+        wait for other results to be sent with.
+    """
+    def __init__(self, url, reactor=None, pool=None, retries=3,
+                 backoff=0.5, max_backoff=30, batch_size=100,
+                 batch_delay=0.05):
+        """
+        :param str url: The root URL of the API of the server, e.g.
+            ``http://127.0.0.1:8888/v1``.
+        :param reactor: The reactor to use, the global one by default.
+        :param HTTPConnectionPool pool: The pool of the persistent
+            connections.  By default the client creates its own pool.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        if pool is None:
+            pool = HTTPConnectionPool(reactor)
+        self._reactor = reactor
+        self._url = url.rstrip('/') + '/benchmark-results'
+        self._pool = pool
+        self._agent = Agent(reactor, pool=pool)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._batch = []
+        self._batch_timer = None
+        self._sending = set()
+
+    def _request(self, method, url, body=None, expected=OK,
+                 idempotent=True, key=None):
+        """
+        Make a request, retrying it on failures.
+
+        Requests that are not idempotent are retried only if they have
+        certainly not been processed by the server.
+
+        :param str key: The idempotency key that makes the request
+            idempotent, or None.  A request with a key is also retried
+            while the server is processing an earlier attempt.
+        :return: A Deferred that fires with the response body.
+        """
+        retryable = _NETWORK_ERRORS if idempotent else _NOT_SENT_ERRORS
+        headers = None
+        if body is not None:
+            headers = Headers({b'content-type': [b'application/json']})
+        if key is not None:
+            headers.setRawHeaders(b'idempotency-key', [key])
+
+        def send(attempt):
+            producer = None
+            if body is not None:
+                producer = FileBodyProducer(StringIO(body))
+            d = self._agent.request(method, url, headers, producer)
+            d.addCallback(got_response)
+            d.addErrback(retry, attempt)
+            return d
+
+        def got_response(response):
+            d = readBody(response)
+            d.addCallback(check_response, response)
+            return d
+
+        def check_response(data, response):
+            if response.code == expected:
+                return data
+            raise _make_error(response.code, data, response.headers)
+
+        def retry(failure, attempt):
+            overloaded = (
+                failure.check(APIError) and
+                failure.value.code == SERVICE_UNAVAILABLE
+            )
+            in_progress = (
+                key is not None and failure.check(APIError) and
+                failure.value.code == CONFLICT
+            )
+            if attempt >= self.retries or not (
+                    overloaded or in_progress or failure.check(*retryable)):
+                return failure
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+            if overloaded and failure.value.retry_after is not None:
+                delay = max(delay, failure.value.retry_after)
+            return deferLater(self._reactor, delay, send, attempt + 1)
+
+        return send(0)
+
+    def _result_url(self, id):
+        return '{}/{}'.format(self._url, quote(id, safe=''))
+
+    def store(self, result):
+        """
+        Store a single result right away.
+
+        :param dict result: The result in the JSON compatible format.
+        :return: A Deferred that fires with the identifier of the result.
+        """
+        d = self._request(
+            b'POST', self._url, dumps(result), CREATED, key=uuid4().hex
+        )
+        d.addCallback(lambda body: loads(body)['id'].encode('ascii'))
+        return d
+
+    def store_many(self, results):
+        """
+        Store several results with one bulk request.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that fires with the list of the identifiers
+            of the results.
+        """
+        d = self._request(
+            b'POST', self._url + '/bulk', dumps(results), CREATED,
+            key=uuid4().hex,
+        )
+        d.addCallback(
+            lambda body: [id.encode('ascii') for id in loads(body)['ids']]
+        )
+        return d
+
+    def submit(self, result):
+        """
+        Submit a result to be stored with the other results submitted
+        around the same time in one bulk request.
+
+        If the bulk request fails, all of its results fail with the
+        same error.
+
+        :param dict result: The result in the JSON compatible format.
+        :return: A Deferred that fires with the identifier of the result.
+        """
+        d = Deferred()
+        self._batch.append((result, d))
+        if len(self._batch) >= self.batch_size:
+            self._send_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self._reactor.callLater(
+                self.batch_delay, self._send_batch
+            )
+        return d
+
+    def _send_batch(self):
+        if self._batch_timer is not None:
+            if self._batch_timer.active():
+                self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        sending = self.store_many([result for (result, _) in batch])
+        self._sending.add(sending)
+
+        def sent(ids):
+            self._sending.discard(sending)
+            for (_, waiting), id in zip(batch, ids):
+                waiting.callback(id)
+
+        def failed(failure):
+            self._sending.discard(sending)
+            for (_, waiting) in batch:
+                waiting.errback(failure)
+
+        sending.addCallbacks(sent, failed)
+
+    def flush(self):
+        """
+        Send the submitted results without waiting for more of them.
+
+        :return: A Deferred that fires when all the submitted results
+            have been sent.
+        """
+        self._send_batch()
+        return DeferredList(list(self._sending))
+
+    def retrieve(self, id, fields=None):
+        """
+        Retrieve a result.
+
+        :param str id: The identifier of the result.
+        :param fields: The list of the fields of the result to return, or
+            None for all the fields.
+        :return: A Deferred that fires with the result.
+        """
+        url = self._result_url(id)
+        if fields is not None:
+            url += '?' + urlencode({'fields': ','.join(fields)})
+        d = self._request(b'GET', url)
+        d.addCallback(loads)
+        return d
+
+    def query(self, branch=None, limit=None, fields=None):
+        """
+        Query the results, the latest first.
+
+        :param branch: Only return the results of this branch.
+        :param int limit: The maximum number of the results to return.
+        :param fields: The list of the fields of the results to return, or
+            None for all the fields.
+        :return: A Deferred that fires with the list of the results.
+        """
+        args = self._query_args(branch, limit, fields)
+        d = self._request(b'GET', self._query_url(args))
+        d.addCallback(lambda body: loads(body)['results'])
+        return d
+
+    def latest(self, key, branch=None, limit=None, fields=None):
+        """
+        Query the latest result for every value of a userdata field, the
+        latest first.
+
+        :param str key: The userdata field to group the results by.
+        :param branch: Only return the results of this branch.
+        :param int limit: The maximum number of the results to return.
+        :param fields: The list of the fields of the results to return, or
+            None for all the fields.
+        :return: A Deferred that fires with the list of the results.
+        """
+        args = self._query_args(branch, limit, fields)
+        args['latest'] = key
+        d = self._request(b'GET', self._query_url(args))
+        d.addCallback(lambda body: loads(body)['results'])
+        return d
+
+    def page(self, branch=None, limit=None, cursor=None, fields=None):
+        """
+        Query a page of the results, the latest first.
+
+        :param branch: Only return the results of this branch.
+        :param int limit: The maximum number of the results to return.
+        :param str cursor: The cursor returned with the previous page, or
+            None for the first page.
+        :param fields: The list of the fields of the results to return, or
+            None for all the fields.
+        :return: A Deferred that fires with a tuple of a list of
+            ``(id, result)`` pairs and the cursor for the next page, which
+            is None if there are no more results.
+        """
+        args = self._query_args(branch, limit, fields)
+        args['cursor'] = cursor or ''
+        d = self._request(b'GET', self._query_url(args))
+
+        def got_page(body):
+            data = loads(body)
+            ids = [id.encode('ascii') for id in data['ids']]
+            next = data['next']
+            if next is not None:
+                next = next.encode('ascii')
+            return zip(ids, data['results']), next
+
+        d.addCallback(got_page)
+        return d
+
+    @staticmethod
+    def _query_args(branch, limit, fields):
+        args = {}
+        if branch is not None:
+            args['branch'] = branch
+        if limit is not None:
+            args['limit'] = limit
+        if fields is not None:
+            args['fields'] = ','.join(fields)
+        return args
+
+    def _query_url(self, args):
+        if not args:
+            return self._url
+        return self._url + '?' + urlencode(args)
+
+    def cursor(self, branch=None, page_size=100, fields=None):
+        """
+        Create a cursor over the results, the latest first.
+
+        :param branch: Only return the results of this branch.
+        :param int page_size: The number of the results to fetch at once.
+        :param fields: The list of the fields of the results to return, or
+            None for all the fields.
+        :return: A ``QueryCursor``.
+        """
+        return QueryCursor(self, branch, page_size, fields)
+
+    def delete(self, id):
+        """
+        Delete a result.
+
+        :param str id: The identifier of the result.
+        :return: A Deferred that fires when the result is deleted.
+        """
+        d = self._request(b'DELETE', self._result_url(id), expected=NO_CONTENT)
+        d.addCallback(lambda _: None)
+        return d
+
+    def close(self):
+        """
+        Send the submitted results and close the connections.
+
+        :return: A Deferred that fires when the client is closed.
+        """
+        d = self.flush()
+        d.addCallback(lambda _: self._pool.closeCachedConnections())
+        return d
+
+
+class QueryCursor(object):
+    """
+    A cursor over the results of a query that fetches them a page at a
+    time.
+
+    :ivar bool exhausted: Whether all the results have been fetched.
+    """
+    def __init__(self, client, branch, page_size, fields=None):
+        self._client = client
+        self._branch = branch
+        self._page_size = page_size
+        self._fields = fields
+        self._cursor = None
+        self.exhausted = False
+
+    def next_page(self):
+        """
+        Fetch the next page of the results.
+
+        :return: A Deferred that fires with the list of the results in the
+            page.  The list is empty if the cursor is exhausted.
+        """
+        if self.exhausted:
+            return succeed([])
+        d = self._client.page(
+            self._branch, self._page_size, self._cursor, self._fields
+        )
+
+        def got_page(page):
+            entries, self._cursor = page
+            if self._cursor is None:
+                self.exhausted = True
+            return [result for (_, result) in entries]
+
+        d.addCallback(got_page)
+        return d
+
+    def for_each(self, f):
+        """
+        Call a function with every remaining result.
+
+        :param f: The function to call with every result.
+        :return: A Deferred that fires when all the results have been
+            processed.
+        """
+        def process(results):
+            for result in results:
+                f(result)
+            if self.exhausted:
+                return None
+            d = self.next_page()
+            d.addCallback(process)
+            return d
+
+        return process([])
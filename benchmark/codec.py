@@ -0,0 +1,233 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Encoding and decoding of the API payloads.
+
+The payloads are JSON by default.  They can also be BSON, as a sequence
+of documents, or MessagePack if the ``msgpack`` package is installed.
+These binary formats are more compact and faster to decode for results
+with many numbers.  The ``bson`` and ``msgpack`` packages are imported
+only when their formats are used.
+
+Large payloads are processed in a thread pool, so that decoding a big
+request or encoding a big response does not stall the reactor thread and
+every other connection with it.
+"""
+
+from json import dumps, loads
+from pkgutil import find_loader
+
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+
+JSON = 'application/json'
+BSON_TYPE = 'application/bson'
+MSGPACK = 'application/x-msgpack'
+
+# The types of the decoded values that can be stored and encoded as JSON.
+# The subclasses of long, like the Int64 of BSON, are accepted too.  The
+# binary values of MessagePack are decoded as byte strings, which may not
+# be text at all, so they are not accepted.
+_JSON_TYPES = frozenset([
+    dict, list, unicode, int, long, float, bool, type(None),
+])
+
+
+def _check_json_types(value):
+    """
+    Check that a decoded value only has the types of the JSON values, and
+    that the keys of its objects are strings.
+
+    :raises ValueError: If it does not.
+    """
+    if type(value) not in _JSON_TYPES and not isinstance(value, long):
+        raise ValueError(
+            "Unsupported value of type {}".format(type(value).__name__)
+        )
+    if isinstance(value, dict):
+        for key in value:
+            if not isinstance(key, unicode):
+                raise ValueError(
+                    "Unsupported key of type {}".format(type(key).__name__)
+                )
+        map(_check_json_types, value.itervalues())
+    elif isinstance(value, list):
+        map(_check_json_types, value)
+
+
+def _loads_bson_many(data):
+    from bson import decode_all
+    from bson.errors import BSONError
+    try:
+        documents = decode_all(data)
+    except BSONError as e:
+        raise ValueError(str(e))
+    _check_json_types(documents)
+    return documents
+
+
+def _loads_bson(data):
+    documents = _loads_bson_many(data)
+    if len(documents) != 1:
+        raise ValueError("Expected one BSON document")
+    return documents[0]
+
+
+def _encode_results_bson(envelope, results):
+    from bson import BSON
+    document = dict(envelope)
+    document['results'] = results
+    return BSON.encode(document)
+
+
+def _loads_msgpack(data):
+    import msgpack
+    try:
+        document = msgpack.unpackb(data, raw=False)
+    except msgpack.UnpackException as e:
+        raise ValueError(str(e))
+    _check_json_types(document)
+    return document
+
+
+def _encode_results_msgpack(envelope, results):
+    import msgpack
+    document = dict(envelope)
+    document['results'] = results
+    return msgpack.packb(document, use_bin_type=True)
+
+
+def _encode_results(envelope, results):
+    # The results are encoded one by one, rather than as a part of the
+    # envelope.  The JSON encoder holds the GIL while it serializes a
+    # single object, so encoding them separately lets the reactor thread
+    # run between the results when this is done in a worker thread.
+    encoded = ', '.join(dumps(result) for result in results)
+    # Splice the results into the encoded envelope before its closing
+    # brace.
+    return '{}, "results": [{}]}}'.format(dumps(envelope)[:-1], encoded)
+
+
+# The functions that decode a document, decode a list of documents and
+# encode the results in an envelope, by the content type.
+_FORMATS = {
+    JSON: (loads, loads, _encode_results),
+    BSON_TYPE: (_loads_bson, _loads_bson_many, _encode_results_bson),
+}
+# MessagePack is supported if the package is installed, which is found
+# without importing it.
+if find_loader('msgpack') is not None:
+    _FORMATS[MSGPACK] = (
+        _loads_msgpack, _loads_msgpack, _encode_results_msgpack
+    )
+
+
+def _media_type(header):
+    """
+    Get the media type of a content type, without its parameters.
+    """
+    return header.split(';', 1)[0].strip().lower()
+
+
+def request_format(content_type):
+    """
+    Get the format of a request body.
+
+    :param content_type: The value of the Content-Type header, or None.
+    :return: The supported content type of the body.  Bodies of any other
+        type are taken as JSON.
+    """
+    if content_type is not None:
+        media_type = _media_type(content_type)
+        if media_type in _FORMATS:
+            return media_type
+    return JSON
+
+
+def response_format(accept):
+    """
+    Choose the format of a response.
+
+    :param accept: The value of the Accept header, or None.
+    :return: The first supported content type in the header, or JSON if
+        there is none.
+    """
+    if accept is not None:
+        for media_range in accept.split(','):
+            media_type = _media_type(media_range)
+            if media_type in _FORMATS:
+                return media_type
+    return JSON
+
+
+def _decode(data, validate, content_type, many):
+    loads_one, loads_many, _ = _FORMATS[content_type]
+    document = (loads_many if many else loads_one)(data)
+    if validate is not None:
+        validate(document)
+    return document
+
+
+class JSONCodec(object):
+    """
+    JSON, BSON and MessagePack encoding and decoding that offloads large
+    payloads to a thread pool.
+    """
+    def __init__(self, reactor, threadpool=None, size_threshold=64 * 1024,
+                 count_threshold=100):
+        """
+        :param reactor: The reactor to deliver the results in.
+        :param threadpool: The thread pool for the large payloads, the
+            reactor's thread pool by default.
+        :param int size_threshold: The size in bytes of the data to decode
+            from which the decoding is done in the thread pool.
+        :param int count_threshold: The number of the results from which
+            their encoding is done in the thread pool.
+        """
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self.size_threshold = size_threshold
+        self.count_threshold = count_threshold
+
+    def _run(self, offload, f, *args):
+        if not offload:
+            return maybeDeferred(f, *args)
+        threadpool = self._threadpool
+        if threadpool is None:
+            threadpool = self._reactor.getThreadPool()
+        return deferToThreadPool(self._reactor, threadpool, f, *args)
+
+    def decode(self, data, validate=None, content_type=JSON, many=False):
+        """
+        Decode a document.
+
+        :param bytes data: The encoded document.
+        :param validate: A callable that is called with the decoded
+            document and raises an exception if it is not valid.
+        :param str content_type: The format of the document, see
+            ``request_format``.
+        :param bool many: Whether the document is a list of documents.
+            A list is encoded as a sequence of documents in BSON, whose
+            documents can not be lists.
+        :raises ValueError: If the data can not be decoded.
+        :return: A Deferred that fires with the decoded document.
+        """
+        return self._run(
+            len(data) >= self.size_threshold,
+            _decode, data, validate, content_type, many,
+        )
+
+    def encode_results(self, envelope, results, content_type=JSON):
+        """
+        Encode the results in an envelope as the ``results`` field.
+
+        :param dict envelope: The other fields of the encoded document.
+            It must not be empty.
+        :param list results: The results in the JSON compatible format.
+        :param str content_type: The format of the document, see
+            ``response_format``.
+        :return: A Deferred that fires with the encoded document.
+        """
+        _, _, encode = _FORMATS[content_type]
+        return self._run(
+            len(results) >= self.count_threshold, encode, envelope, results,
+        )
@@ -0,0 +1,130 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Deduplication of the submitted results.
+
+A client that retries a submission after a network failure can not know
+whether the first attempt was stored.  A submission may carry a key,
+given by the client or derived from its content, and the submissions are
+processed at most once per key: a later submission with the same key is
+answered with the identifiers stored for the first one, without storing
+its results again.
+
+The keys are claimed before the results are stored and completed with
+the identifiers afterwards, so that a submission that arrives while
+another one with the same key is being processed is rejected rather than
+stored twice.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+
+from twisted.internet.defer import fail, succeed
+
+
+class InProgress(Exception):
+    """
+    A submission with the key is being processed.
+    """
+
+
+class KeyReused(Exception):
+    """
+    The key has been used for a different submission.
+    """
+
+
+def fingerprint(path, data):
+    """
+    Identify the content of a submission.
+
+    :param str path: The path the submission was made to.
+    :param data: The submitted results in the JSON compatible format.
+    :return: A hexadecimal digest of the path and the results.
+    """
+    digest = sha256(path)
+    digest.update(b'\0')
+    digest.update(dumps(data, sort_keys=True))
+    return digest.hexdigest()
+
+
+class DedupIndex(object):
+    """
+    An index of the submission keys kept in the memory.
+
+    The keys expire after a while, and the oldest keys are dropped when
+    there are too many of them.
+
+    :ivar float expiry: The number of seconds a key is kept for.
+    :ivar int max_size: The maximum number of the keys.
+    """
+    def __init__(self, reactor, expiry=24 * 60 * 60, max_size=100000):
+        """
+        :param reactor: The reactor to tell the time with.
+        """
+        self.expiry = expiry
+        self.max_size = max_size
+        self._reactor = reactor
+        # The expiry time, the fingerprint and the value, or None while
+        # the submission is processed, by the key in the order of expiry.
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self):
+        now = self._reactor.seconds()
+        while self._entries:
+            key, (expires, _, _) = next(self._entries.iteritems())
+            if expires > now:
+                break
+            del self._entries[key]
+
+    def claim(self, key, fingerprint):
+        """
+        Claim a key for a submission.
+
+        :param str key: The key.
+        :param str fingerprint: The fingerprint of the submission.
+        :return: A Deferred that fires with None if the key has been
+            claimed, or with the value the key was completed with by an
+            earlier submission.  It fails with ``InProgress`` if the
+            earlier submission has not completed yet and with ``KeyReused``
+            if it was a different submission.
+        """
+        self._expire()
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = (
+                self._reactor.seconds() + self.expiry, fingerprint, None
+            )
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return succeed(None)
+        _, claimed, value = entry
+        if claimed != fingerprint:
+            return fail(KeyReused(key))
+        if value is None:
+            return fail(InProgress(key))
+        return succeed(value)
+
+    def complete(self, key, value):
+        """
+        Record the value of a claimed key.
+
+        :param value: The identifiers of the stored results.
+        :return: A Deferred that fires when the value is recorded.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = entry[:2] + (value,)
+        return succeed(None)
+
+    def release(self, key):
+        """
+        Give up a claimed key, after the submission has failed.
+
+        :return: A Deferred that fires when the key is released.
+        """
+        self._entries.pop(key, None)
+        return succeed(None)
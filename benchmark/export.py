@@ -0,0 +1,487 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Streaming export of the results as CSV, NDJSON or a binary columnar
+format.
+
+The results are read from a backend a page at a time, from the latest to
+the oldest, and every page is written to the response as soon as it is
+encoded.  The next page is only read when the client keeps up, so an
+export of any size holds at most one page in memory.
+
+The columnar format is a stream of little-endian values that starts with
+the 8 bytes ``BMRKCOL1`` and continues with batches of rows::
+
+    uint32 n                 the number of the rows in the batch
+    uint32 k                 the number of the userdata columns
+    k times:
+        uint32 length, bytes the UTF-8 name of the column
+        uint32 m             the size of the dictionary of the column
+        m times:
+            uint32 length, bytes
+                             a JSON encoded value
+    zero bytes to the next multiple of 8 bytes from the stream start
+    int64[n]                 the timestamps in microseconds since the
+                             Unix epoch in UTC
+    float64[n]               the values of the result field, NaN if
+                             the field is missing or not a number
+    k times:
+        int32[n]             the indexes of the values of the column in
+                             its dictionary, -1 if the field is missing
+    zero bytes to the next multiple of 8 bytes from the stream start
+
+The stream ends with a batch with no rows and no columns.  Every batch
+is self-contained, and its arrays are aligned for
+``numpy.frombuffer(data, dtype='<i8', count=n, offset=offset)`` and the
+like.
+"""
+
+import csv
+
+from datetime import datetime
+from json import dumps, loads
+from StringIO import StringIO
+from struct import pack, unpack_from
+
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.log import err
+
+from zope.interface import implementer
+
+from dateutil import parser as timestamp_parser
+
+
+COLUMNAR_MAGIC = b'BMRKCOL1'
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_utc(timestamp):
+    """
+    Convert a timestamp to a naive timestamp in UTC.  Naive timestamps are
+    taken as UTC.
+    """
+    if timestamp.utcoffset() is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    return timestamp
+
+
+def _microseconds(timestamp):
+    """
+    Get the number of microseconds between the Unix epoch and a naive
+    timestamp in UTC.
+    """
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _userdata_columns(rows):
+    """
+    Get the sorted names of the userdata fields of the results.
+    """
+    columns = set()
+    for _, result in rows:
+        userdata = result.get('userdata')
+        if isinstance(userdata, dict):
+            columns.update(userdata)
+    return sorted(columns)
+
+
+def _userdata_value(result, column, missing=None):
+    userdata = result.get('userdata')
+    if not isinstance(userdata, dict):
+        return missing
+    return userdata.get(column, missing)
+
+
+class NDJSONEncoder(object):
+    """
+    Encode the results as JSON documents, one per line.
+    """
+    content_type = b'application/x-ndjson'
+
+    def __init__(self, fields=None):
+        """
+        :param fields: The list of the fields of the results to export, or
+            None for all the fields.
+        """
+        self.fields = fields
+
+    def header(self):
+        return b''
+
+    def encode(self, rows):
+        """
+        Encode a batch of the results.
+
+        :param list rows: The ``(timestamp, result)`` pairs, where the
+            timestamp is a naive datetime in UTC.
+        :return: The encoded batch.
+        """
+        return b''.join(dumps(result) + b'\n' for (_, result) in rows)
+
+    def footer(self):
+        return b''
+
+
+class CSVEncoder(object):
+    """
+    Encode the results as CSV with the ``timestamp`` and ``result``
+    columns followed by a column per userdata field.
+
+    Values other than strings are encoded as JSON, and missing values are
+    empty.
+    """
+    content_type = b'text/csv; charset=utf-8'
+
+    def __init__(self, columns=None):
+        """
+        :param columns: The list of the userdata fields to export.  By
+            default, the fields of the results in the first batch are
+            exported.
+        """
+        self.columns = columns
+        self.fields = ['timestamp', 'result', 'userdata']
+        if columns is not None:
+            self.fields[2:] = ['userdata.' + column for column in columns]
+        self._header_written = False
+
+    def header(self):
+        # The header is written with the first batch, when the columns
+        # are known.
+        return b''
+
+    def _write_rows(self, rows):
+        output = StringIO()
+        writer = csv.writer(output)
+        for row in rows:
+            writer.writerow([self._cell(value) for value in row])
+        return output.getvalue()
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return b''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, bytes):
+            return value
+        return dumps(value)
+
+    def _header_row(self):
+        if self._header_written:
+            return b''
+        self._header_written = True
+        if self.columns is None:
+            self.columns = []
+        return self._write_rows(
+            [['timestamp', 'result'] + list(self.columns)]
+        )
+
+    def encode(self, rows):
+        """
+        Encode a batch of the results.
+
+        :param list rows: The ``(timestamp, result)`` pairs, where the
+            timestamp is a naive datetime in UTC.
+        :return: The encoded batch.
+        """
+        if self.columns is None:
+            self.columns = _userdata_columns(rows)
+        return self._header_row() + self._write_rows(
+            [result.get('timestamp'), result.get('result')] +
+            [_userdata_value(result, column) for column in self.columns]
+            for (_, result) in rows
+        )
+
+    def footer(self):
+        return self._header_row()
+
+
+def _pack_string(value):
+    return pack('<I', len(value)) + value
+
+
+class ColumnarEncoder(object):
+    """
+    Encode the results in the binary columnar format.
+    """
+    content_type = b'application/octet-stream'
+
+    def __init__(self, columns=None):
+        """
+        :param columns: The list of the userdata fields to export.  By
+            default, the fields of the results of every batch are
+            exported.
+        """
+        self.columns = columns
+        self.fields = ['timestamp', 'result', 'userdata']
+        if columns is not None:
+            self.fields[2:] = ['userdata.' + column for column in columns]
+        self._offset = 0
+
+    def _aligned(self, parts):
+        """
+        Join the parts of the stream and pad them to a multiple of 8
+        bytes from the start of the stream.
+        """
+        data = b''.join(parts)
+        data += b'\0' * (-(self._offset + len(data)) % 8)
+        self._offset += len(data)
+        return data
+
+    def header(self):
+        return self._aligned([COLUMNAR_MAGIC])
+
+    def encode(self, rows):
+        """
+        Encode a batch of the results.
+
+        :param list rows: The ``(timestamp, result)`` pairs, where the
+            timestamp is a naive datetime in UTC.
+        :return: The encoded batch.
+        """
+        columns = self.columns
+        if columns is None:
+            columns = _userdata_columns(rows)
+        n = len(rows)
+
+        description = [pack('<II', n, len(columns))]
+        arrays = [
+            pack('<{}q'.format(n),
+                 *[_microseconds(timestamp) for (timestamp, _) in rows]),
+            pack('<{}d'.format(n),
+                 *[self._number(result.get('result'))
+                   for (_, result) in rows]),
+        ]
+        missing = object()
+        for column in columns:
+            dictionary = {}
+            codes = []
+            for _, result in rows:
+                value = _userdata_value(result, column, missing)
+                if value is missing:
+                    codes.append(-1)
+                    continue
+                # Values are compared by their encoding, so that values
+                # that can not be hashed are supported.
+                encoded = dumps(value, sort_keys=True)
+                codes.append(dictionary.setdefault(encoded, len(dictionary)))
+            description.append(_pack_string(column.encode('utf-8')))
+            description.append(pack('<I', len(dictionary)))
+            for encoded in sorted(dictionary, key=dictionary.get):
+                description.append(_pack_string(encoded))
+            arrays.append(pack('<{}i'.format(n), *codes))
+        return self._aligned(description) + self._aligned(arrays)
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, (int, long, float)) and not isinstance(
+                value, bool):
+            return float(value)
+        return float('nan')
+
+    def footer(self):
+        return self._aligned([pack('<II', 0, 0)])
+
+
+def read_columnar(data):
+    """
+    Read the batches of the results in the binary columnar format.
+
+    :param bytes data: The whole stream.
+    :raises ValueError: If the stream is not valid.
+    :return: A list of the batches, each a dictionary with the
+        ``timestamp`` and ``result`` lists and a ``userdata`` dictionary of
+        the lists of the values of every column, with None for the missing
+        values.
+    """
+    if not data.startswith(COLUMNAR_MAGIC):
+        raise ValueError("Not a columnar export")
+    offset = len(COLUMNAR_MAGIC)
+    batches = []
+
+    def read_string():
+        (length,) = unpack_from('<I', data, offset)
+        return data[offset + 4:offset + 4 + length], offset + 4 + length
+
+    while True:
+        n, k = unpack_from('<II', data, offset)
+        offset += 8
+        if n == 0 and k == 0:
+            return batches
+        columns = []
+        for _ in range(k):
+            name, offset = read_string()
+            (m,) = unpack_from('<I', data, offset)
+            offset += 4
+            dictionary = []
+            for _ in range(m):
+                value, offset = read_string()
+                dictionary.append(loads(value))
+            columns.append((name.decode('utf-8'), dictionary))
+        offset += -offset % 8
+        timestamps = list(unpack_from('<{}q'.format(n), data, offset))
+        offset += 8 * n
+        results = list(unpack_from('<{}d'.format(n), data, offset))
+        offset += 8 * n
+        userdata = {}
+        for name, dictionary in columns:
+            codes = unpack_from('<{}i'.format(n), data, offset)
+            offset += 4 * n
+            userdata[name] = [
+                None if code == -1 else dictionary[code] for code in codes
+            ]
+        offset += -offset % 8
+        batches.append({
+            'timestamp': timestamps,
+            'result': results,
+            'userdata': userdata,
+        })
+
+
+ENCODERS = {
+    'ndjson': NDJSONEncoder,
+    'csv': CSVEncoder,
+    'columnar': ColumnarEncoder,
+}
+
+
+@implementer(IPushProducer)
+class Exporter(object):
+    """
+    A producer that writes the matching results of a backend to a request
+    from the latest to the oldest.
+
+    A page of the results is read only when the previous one has been
+    written and the request is not paused.  The first page starts at the
+    end of the range if the backend can make a cursor for it with a
+    ``cursor_before`` method, so that the later results are not read.
+    """
+    def __init__(self, backend, request, encoder, filter, start=None,
+                 end=None, limit=None, page_size=1000):
+        """
+        :param IBackend backend: The backend to read the results from.
+        :param request: The request to write the results to.
+        :param encoder: The encoder of the results.
+        :param dict filter: The filter of the results.
+        :param datetime start: Only export the results with timestamps at
+            or after this naive timestamp in UTC, if given.
+        :param datetime end: Only export the results with timestamps
+            before this naive timestamp in UTC, if given.
+        :param int limit: The maximum number of the results to export.
+        :param int page_size: The number of the results read at once.
+        """
+        self._backend = backend
+        self._request = request
+        self._encoder = encoder
+        self._filter = filter
+        self._start = start
+        self._end = end
+        self._remaining = limit
+        self._page_size = page_size
+        self._cursor = None
+        if end is not None and hasattr(backend, 'cursor_before'):
+            self._cursor = backend.cursor_before(end)
+        self._written = False
+        self._paused = False
+        self._pending = False
+        self._stopped = False
+        self._done = None
+
+    def export(self):
+        """
+        Start the export.
+
+        :return: A Deferred that fires when all the results have been
+            written.  It fails if reading the first page fails.  If a later
+            page fails, the connection is aborted, so that the client does
+            not take the partial export for a complete one.  Cancelling
+            the Deferred stops the export.
+        """
+        self._done = Deferred(lambda _: self.stopProducing())
+        self._request.registerProducer(self, True)
+        self._fetch()
+        return self._done
+
+    def _fetch(self):
+        """
+        Read and write the pages until the export is paused or stopped,
+        or a page is not available immediately.
+        """
+        while not (self._paused or self._pending or self._stopped):
+            d = self._backend.page(
+                self._filter, self._page_size, self._cursor,
+                self._encoder.fields,
+            )
+            d.addCallback(self._got_page)
+            d.addErrback(self._failed)
+            if not d.called:
+                self._pending = True
+                d.addCallback(self._fetched)
+                return
+
+    def _fetched(self, _):
+        self._pending = False
+        self._fetch()
+
+    def _got_page(self, page):
+        if self._stopped:
+            return
+        entries, self._cursor = page
+        finished = self._cursor is None
+        rows = []
+        for _, result in entries:
+            if self._remaining == 0:
+                break
+            timestamp = to_utc(timestamp_parser.parse(result['timestamp']))
+            if self._end is not None and timestamp >= self._end:
+                continue
+            if self._start is not None and timestamp < self._start:
+                # The rest of the results are older still.
+                finished = True
+                break
+            rows.append((timestamp, result))
+            if self._remaining is not None:
+                self._remaining -= 1
+        if self._remaining == 0:
+            finished = True
+        if not (rows or finished):
+            return
+        data = []
+        if not self._written:
+            data.append(self._encoder.header())
+            self._written = True
+        if rows:
+            data.append(self._encoder.encode(rows))
+        if finished:
+            data.append(self._encoder.footer())
+        data = b''.join(data)
+        if data:
+            self._request.write(data)
+        if finished:
+            self._stopped = True
+            self._request.unregisterProducer()
+            self._done.callback(None)
+
+    def _failed(self, failure):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._request.unregisterProducer()
+        if not self._written:
+            self._done.errback(failure)
+            return
+        err(failure, "Export failed")
+        # The Deferred is cancelled when the connection is lost.
+        self._request.transport.abortConnection()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fetch()
+
+    def stopProducing(self):
+        self._stopped = True
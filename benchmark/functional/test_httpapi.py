@@ -1,6 +1,6 @@
 from testtools import TestCase
 
-from ..httpapi import TxMongoBackend
+from ..mongo import TxMongoBackend
 from ..test.test_httpapi import BenchmarkAPITestsMixin
 
 
@@ -9,3 +9,10 @@ class TxMongoBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
         self.backend = TxMongoBackend()
         self.addCleanup(self.backend.disconnect)
         super(TxMongoBenchmarkAPITests, self).setUp()
+
+
+class CachedTxMongoBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    def setUp(self):
+        self.backend = TxMongoBackend(cache_size=1024 * 1024)
+        self.addCleanup(self.backend.disconnect)
+        super(CachedTxMongoBenchmarkAPITests, self).setUp()
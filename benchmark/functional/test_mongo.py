@@ -0,0 +1,88 @@
+from copy import deepcopy
+from uuid import uuid4
+
+from testtools import TestCase
+from testtools.deferredruntest import AsynchronousDeferredRunTest
+
+from ..dedup import InProgress
+from ..mongo import TxMongoBackend
+
+
+class CachedTxMongoBackendTests(TestCase):
+    """
+    Tests for the cache of ``TxMongoBackend``.
+    """
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=5)
+
+    RESULT = {u"userdata": {u"branch": u"master"},
+              u"timestamp": u"2016-01-01T00:00:00"}
+
+    def setUp(self):
+        super(CachedTxMongoBackendTests, self).setUp()
+        self.backend = TxMongoBackend(cache_size=1024 * 1024)
+        self.addCleanup(self.backend.disconnect)
+
+    def test_retrieve_copies(self):
+        """
+        Modifying a stored or a retrieved result, down to its subdocuments,
+        does not modify the cached result.
+        """
+        result = deepcopy(self.RESULT)
+        d = self.backend.store(result)
+
+        def retrieve(id):
+            self.addCleanup(self.backend.delete, id)
+            result[u"userdata"][u"branch"] = u"stored"
+            d = self.backend.retrieve(id)
+            d.addCallback(retrieve_again, id)
+            return d
+
+        def retrieve_again(retrieved, id):
+            self.assertEqual(self.RESULT, retrieved)
+            retrieved[u"userdata"][u"branch"] = u"retrieved"
+            return self.backend.retrieve(id)
+
+        d.addCallback(retrieve)
+        d.addCallback(self.assertEqual, self.RESULT)
+        return d
+
+
+class TxMongoDedupIndexTests(TestCase):
+    """
+    Tests for ``TxMongoDedupIndex``.
+    """
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=5)
+
+    def setUp(self):
+        super(TxMongoDedupIndexTests, self).setUp()
+        self.backend = TxMongoBackend()
+        self.addCleanup(self.backend.disconnect)
+        self.index = self.backend.dedup_index(60)
+        self.key = 'test:' + uuid4().hex
+        self.addCleanup(self.index.release, self.key)
+
+    def test_lease(self):
+        """
+        A key whose lease has run out is claimed again, and then held for
+        the new lease.
+        """
+        self.index.lease = 0
+        d = self.index.claim(self.key, 'fingerprint')
+
+        def claim_again(claimed):
+            self.assertIs(None, claimed)
+            self.index.lease = 60
+            return self.index.claim(self.key, 'fingerprint')
+
+        def claim_held(claimed):
+            self.assertIs(None, claimed)
+            d = self.index.claim(self.key, 'fingerprint')
+            d.addCallbacks(
+                lambda _: self.fail("The key was claimed during its lease"),
+                lambda failure: failure.trap(InProgress),
+            )
+            return d
+
+        d.addCallback(claim_again)
+        d.addCallback(claim_held)
+        return d
@@ -3,27 +3,37 @@
 A HTTP REST API for storing benchmark results.
 """
 
+import re
 import sys
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
+from functools import wraps
+from hashlib import md5
+from importlib import import_module
+from heapq import heapify, heappop, heapreplace
+from itertools import count, islice
 from json import dumps, loads
-from uuid import uuid4
+from operator import itemgetter
 from urlparse import urljoin
+from zlib import crc32
 
-from twisted.application.internet import StreamServerEndpointService
+from twisted.application.internet import (
+    StreamServerEndpointService, TimerService,
+)
 from twisted.application.service import MultiService, Service
-from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.defer import Deferred, fail, gatherResults, succeed
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.task import react
 from twisted.python.log import startLogging, err, msg
 from twisted.python.usage import Options, UsageError
 from twisted.web.http import (
-    BAD_REQUEST, CREATED, NO_CONTENT, NOT_FOUND, INTERNAL_SERVER_ERROR
+    BAD_REQUEST, CONFLICT, CREATED, NO_CONTENT, NOT_FOUND,
+    INTERNAL_SERVER_ERROR, REQUEST_ENTITY_TOO_LARGE, SERVICE_UNAVAILABLE
 )
 from twisted.web.resource import Resource
-from twisted.web.server import Site
-
-from bson.errors import InvalidId
-from bson.objectid import ObjectId
 
 from dateutil import parser as timestamp_parser
 
@@ -31,43 +41,199 @@ from klein import Klein
 
 from sortedcontainers import SortedList
 
-from txmongo import MongoConnectionPool
-from txmongo.filter import DESCENDING, sort as orderby
-
 from zope.interface import implementer
 
+from ._backend import BadRequest, BadResultId, ResultNotFound, _project
 from ._interfaces import IBackend
+from .admission import (
+    AdmissionControl, LimitedSite, Overloaded, RequestTooLarge, read_body
+)
+from .client import APIError, BenchmarkClient
+from .codec import JSONCodec, request_format, response_format
+from .dedup import DedupIndex, InProgress, KeyReused, fingerprint
+from .export import ENCODERS, Exporter, NDJSONEncoder, to_utc
+from .regressions import RegressionIndex, RegressionService
+from .sketch import SketchIndex, SketchService
+
+
+def _matches(filter, result):
+    """
+    Check whether a result has the same values as the filter for all
+    fields that are specified in the filter.
+    """
+    return filter.viewitems() <= result.viewitems()
+
+
+class _Descending(object):
+    """
+    A wrapper that reverses the ordering of the wrapped value.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _merge_descending(iterables, key):
+    """
+    Lazily merge iterables that are sorted in descending order.
+
+    :param iterables: The iterables to merge.
+    :param key: The function that produces the sort key of an item.
+    :return: An iterator over the items of all the iterables in
+        descending order.  Items with equal keys come in the order of
+        their iterables.
+    """
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((_Descending(key(item)), index, item, iterator))
+            break
+    heapify(heap)
+    while heap:
+        _, index, item, iterator = heap[0]
+        yield item
+        for next_item in iterator:
+            heapreplace(
+                heap, (_Descending(key(next_item)), index, next_item, iterator)
+            )
+            break
+        else:
+            heappop(heap)
+
+
+def _utc_timestamp(result):
+    """
+    Get the timestamp of a result as a naive timestamp in UTC.
+
+    :raises ValueError: If the timestamp is not valid, or out of range
+        once in UTC.
+    """
+    timestamp = result['timestamp']
+    try:
+        return to_utc(timestamp_parser.parse(timestamp))
+    except OverflowError:
+        raise ValueError("Timestamp {} is out of range".format(timestamp))
+
+
+def _branch_of(document):
+    """
+    Get the branch that a result or a filter refers to, if any.
+    """
+    userdata = document.get('userdata')
+    if isinstance(userdata, dict):
+        return userdata.get('branch')
+    return None
+
+
+def _group_of(result, key):
+    """
+    Get the group of a result by a userdata field.
+
+    :return: The JSON encoding of the value of the field, so that values
+        of any type can be compared, or None if the result does not have
+        the field.
+    """
+    userdata = result.get('userdata')
+    if not isinstance(userdata, dict) or key not in userdata:
+        return None
+    return dumps(userdata[key], sort_keys=True)
+
+
+def _make_id(timestamp, sequence):
+    """
+    Make a time-ordered identifier for a result.
+
+    The identifier is 24 hex digits: 15 for the number of microseconds
+    between the start of year 1 and the timestamp in UTC and 9 for the
+    sequence number of the result.  So the identifiers sort in the
+    order of the timestamps, and results with equal timestamps sort in
+    the order they were stored.  Naive timestamps are taken as UTC.
+
+    :param datetime timestamp: The timestamp of the result.
+    :param int sequence: The sequence number of the result.
+    """
+    if timestamp.utcoffset() is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    delta = timestamp - datetime.min
+    microseconds = (
+        (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    )
+    return '{:015x}{:09x}'.format(microseconds, sequence)
 
 
-class ResultNotFound(Exception):
+_ID = re.compile(r'[0-9a-f]{24}\Z')
+
+
+def _is_id(value):
     """
-    Exception indicating that a result with a given identifier is not found.
+    Check whether a value is an identifier made by ``_make_id``.
     """
+    return isinstance(value, basestring) and _ID.match(value) is not None
 
 
-class BadResultId(ResultNotFound):
+def _project_entries(entries, fields):
     """
-    The identifier is not recognized as a valid ID by a backend.
+    Make the projections of the results of ``(id, result)`` pairs.
     """
+    if fields is None:
+        return entries
+    return [(id, _project(result, fields)) for (id, result) in entries]
 
 
-class BadRequest(Exception):
+def _paginate(entries, limit):
     """
-    Bad request parameters or content.
+    Take a page of the entries from an iterator.
+
+    :param entries: An iterator over ``(id, result)`` pairs.  The
+        identifiers must be the cursors that continue the iteration after
+        their entries.
+    :param limit: The maximum number of the entries in the page or None.
+    :return: A tuple of the list of the entries in the page and the cursor
+        for the next page or None.
     """
+    if limit is None:
+        return list(entries), None
+    page = list(islice(entries, limit + 1))
+    if len(page) <= limit:
+        return page, None
+    del page[limit:]
+    return page, page[-1][0]
 
 
 @implementer(IBackend)
 class InMemoryBackend(object):
     """
     The backend that keeps the results in the memory.
-    """
-    def __init__(self, *args, **kwargs):
-        def get_timestamp(result):
-            return timestamp_parser.parse(result['timestamp'])
 
+    The results are identified by time-ordered identifiers, so the sorted
+    index holds just the identifiers and needs no separate sort key.
+
+    :ivar int latest_keys: The maximum number of the userdata fields whose
+        latest results are indexed.
+    """
+    def __init__(self, latest_keys=8, **kwargs):
+        """
+        :param int latest_keys: The maximum number of the userdata fields
+            whose latest results are indexed.  The fields are named by the
+            clients, so only the most recently used ones are indexed and
+            the results are scanned for the others.
+        """
+        self.latest_keys = latest_keys
         self._results = dict()
-        self._sorted = SortedList(key=get_timestamp)
+        self._sorted = SortedList()
+        self._sequence = count()
+        # The identifier of the latest result of every group, by the
+        # userdata fields that ``latest`` has been asked to group by, from
+        # the least to the most recently used.
+        self._latest = OrderedDict()
 
     def disconnect(self):
         return succeed(None)
@@ -80,31 +246,197 @@ class InMemoryBackend(object):
         :return: A Deferred that produces an identifier for the stored
             result.
         """
-        id = uuid4().hex
+        return succeed(self._add(_utc_timestamp(result), result))
+
+    def store_many(self, results):
+        """
+        Store several benchmarking results and return their identifiers.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        # Parse all the timestamps first, so that none of the results is
+        # stored if one of them is not valid.
+        timestamps = [_utc_timestamp(result) for result in results]
+        return succeed([
+            self._add(timestamp, result)
+            for timestamp, result in zip(timestamps, results)
+        ])
+
+    def _add(self, timestamp, result):
+        """
+        Add a result with the given timestamp.
+
+        :return: The identifier of the result.
+        """
+        id = _make_id(timestamp, next(self._sequence))
         self._results[id] = result
-        self._sorted.add(result)
-        return succeed(id)
+        self._sorted.add(id)
+        self._index_latest(id, result)
+        return id
+
+    def _index_latest(self, id, result):
+        """
+        Update the indexes of the latest results with an added result.
+        """
+        for key, index in self._latest.iteritems():
+            group = _group_of(result, key)
+            if group is not None and index.get(group, '') < id:
+                index[group] = id
+
+    def load(self, entries):
+        """
+        Store results in bulk, keeping the identifiers they were dumped
+        with.
+
+        The identifiers made by ``_make_id`` are kept without parsing the
+        timestamps of their results, and all the identifiers are added to
+        the index at once.
+
+        :param list entries: The ``(id, result)`` pairs.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        # Parse the timestamps needed for the new identifiers first, so
+        # that none of the results is stored if one of them is not valid.
+        return succeed(self._load([
+            (id, None, result) if _is_id(id)
+            else (None, _utc_timestamp(result), result)
+            for id, result in entries
+        ]))
+
+    def _load(self, entries):
+        """
+        Add results in bulk.
 
-    def retrieve(self, id):
+        :param list entries: The ``(id, timestamp, result)`` triples, with
+            either the identifier to keep or the timestamp to make a new
+            identifier from.
+        :return: The list of the identifiers.
+        """
+        kept = [int(id[15:], 16) for id, _, _ in entries if id is not None]
+        if kept:
+            # The new identifiers must not take the sequence numbers of the
+            # kept ones.
+            self._sequence = count(max(next(self._sequence), max(kept) + 1))
+        ids = []
+        added = []
+        for id, timestamp, result in entries:
+            if id is None:
+                id = _make_id(timestamp, next(self._sequence))
+            if id not in self._results:
+                self._results[id] = result
+                added.append(id)
+                self._index_latest(id, result)
+            ids.append(id)
+        # Sorting the identifiers and merging them into the index at once
+        # is much faster than inserting them one by one.
+        self._sorted.update(added)
+        return ids
+
+    def retrieve(self, id, fields=None):
         """
         Retrive a result by the given identifier.
         """
         try:
-            return succeed(self._results[id])
+            return succeed(_project(self._results[id], fields))
         except KeyError:
             return fail(ResultNotFound(id))
 
-    def query(self, filter, limit=None):
+    def query(self, filter, limit=None, fields=None):
         """
         Return matching results.
         """
-        matching = []
-        for result in reversed(self._sorted):
-            if len(matching) == limit:
-                break
-            if filter.viewitems() <= result.viewitems():
-                matching.append(result)
-        return succeed(matching)
+        matching = islice(self._iter_matching(filter), limit)
+        return succeed(
+            [_project(result, fields) for (_, result) in matching]
+        )
+
+    def latest(self, filter, key, limit=None, fields=None):
+        """
+        Return the latest matching result for every value of a userdata
+        field.
+
+        The latest result of every group is indexed from the first time
+        all the results are grouped by the field, for the most recently
+        used fields.  The results that match a filter are grouped as they
+        are scanned from the latest.
+        """
+        entries = islice(self._latest_entries(filter, key), limit)
+        return succeed([_project(result, fields) for (_, result) in entries])
+
+    def _latest_entries(self, filter, key):
+        """
+        Iterate over the latest matching result of every group from the
+        latest to the oldest.
+
+        :return: An iterator over the identifiers and the results.
+        """
+        if filter or not self.latest_keys:
+            # The latest result of a group may not match the filter while
+            # earlier ones do, so the index of the latest results of all
+            # the groups does not help.
+            seen = set()
+            for id, result in self._iter_matching(filter):
+                group = _group_of(result, key)
+                if group is not None and group not in seen:
+                    seen.add(group)
+                    yield id, result
+            return
+        index = self._latest.pop(key, None)
+        if index is None:
+            if len(self._latest) >= self.latest_keys:
+                self._latest.popitem(last=False)
+            index = {}
+            for id in self._sorted:
+                group = _group_of(self._results[id], key)
+                if group is not None:
+                    index[group] = id
+        # Move the index to the most recently used end.
+        self._latest[key] = index
+        for id in sorted(index.itervalues(), reverse=True):
+            yield id, self._results[id]
+
+    def page(self, filter, limit=None, cursor=None, fields=None):
+        """
+        Return a page of matching results.
+
+        The cursor is the identifier of the last result of the previous
+        page.
+        """
+        if cursor is not None and not _is_id(cursor):
+            return fail(BadRequest("Invalid cursor {}".format(cursor)))
+        entries, next_cursor = _paginate(
+            self._iter_matching(filter, cursor), limit
+        )
+        return succeed((_project_entries(entries, fields), next_cursor))
+
+    def cursor_before(self, timestamp):
+        """
+        Make a cursor for the page of the results before a timestamp, so
+        that the later results are not read.
+
+        :param datetime timestamp: The naive timestamp in UTC.
+        :return: The cursor.
+        """
+        return _make_id(timestamp, 0)
+
+    def _iter_matching(self, filter, before=None, inclusive=False):
+        """
+        Iterate over the matching results from the latest to the oldest.
+
+        :param str before: Only iterate over the results with identifiers
+            less than this one, if given.
+        :param bool inclusive: Whether to include the result identified
+            by ``before``.
+        :return: An iterator over the identifiers and the results.
+        """
+        ids = self._sorted.irange(
+            maximum=before, inclusive=(True, inclusive), reverse=True
+        )
+        for id in ids:
+            result = self._results[id]
+            if _matches(filter, result):
+                yield id, result
 
     def delete(self, id):
         """
@@ -112,23 +444,82 @@ class InMemoryBackend(object):
         """
         try:
             result = self._results.pop(id)
-            self._sorted.remove(result)
-            return succeed(None)
         except KeyError:
             return fail(ResultNotFound(id))
+        self._sorted.remove(id)
+        for key, index in self._latest.iteritems():
+            group = _group_of(result, key)
+            if group is not None and index[group] == id:
+                self._replace_latest(index, key, group, id)
+        return succeed(None)
+
+    def _replace_latest(self, index, key, group, before):
+        """
+        Find the latest result of a group after its latest result has
+        been deleted.
+        """
+        for id in self._sorted.irange(maximum=before, reverse=True):
+            if _group_of(self._results[id], key) == group:
+                index[group] = id
+                return
+        del index[group]
 
 
 @implementer(IBackend)
-class TxMongoBackend(object):
+class ShardedInMemoryBackend(object):
     """
-    The backend that uses txmongo driver to work with MongoDB.
+    The backend that keeps the results in the memory, partitioned into
+    shards by the value of a userdata field, the branch by default.
+
+    Every shard has its own index, so the queries filtered by the
+    partitioning field touch only one shard and the other operations
+    work with the population of one shard.  The shard of a result is
+    encoded as a suffix of its identifier, so the identifiers are still
+    time-ordered.
     """
-    def __init__(self, hostname="127.0.0.1", port=27017):
-        connection = MongoConnectionPool(host=hostname, port=port)
-        self.collection = connection.benchmark.results
+    def __init__(self, shards=16, key='branch', latest_keys=8, **kwargs):
+        """
+        :param int shards: The number of the shards, at most 256.
+        :param str key: The userdata field to partition the results by.
+        :param int latest_keys: The maximum number of the userdata fields
+            whose latest results are indexed by every shard.
+        """
+        if not 0 < shards <= 256:
+            raise ValueError("The number of shards must be 1 to 256")
+        self._key = key
+        self._shards = [
+            InMemoryBackend(latest_keys=latest_keys) for _ in range(shards)
+        ]
 
     def disconnect(self):
-        return self.collection.database.connection.disconnect()
+        return succeed(None)
+
+    def _shard_index(self, document):
+        """
+        Get the index of the shard for a result or a filter.
+
+        :return: The index or None if the document does not specify the
+            value of the partitioning field.
+        """
+        userdata = document.get('userdata')
+        if not isinstance(userdata, dict) or self._key not in userdata:
+            return None
+        # The hash must not depend on the process, so that the results
+        # can be partitioned between processes.
+        value = dumps(userdata[self._key], sort_keys=True)
+        return (crc32(value) & 0xffffffff) % len(self._shards)
+
+    def _locate(self, id):
+        """
+        Get the shard and the identifier within the shard for a result.
+        """
+        try:
+            index = int(id[-2:], 16)
+            if len(id) > 2:
+                return self._shards[index], id[:-2]
+        except (ValueError, IndexError):
+            pass
+        raise BadResultId(id)
 
     def store(self, result):
         """
@@ -138,98 +529,980 @@ class TxMongoBackend(object):
         :return: A Deferred that produces an identifier for the stored
             result.
         """
-        def to_str(result):
-            return str(result.inserted_id)
+        d = self.store_many([result])
+        d.addCallback(itemgetter(0))
+        return d
+
+    def store_many(self, results):
+        """
+        Store several benchmarking results and return their identifiers.
 
-        # Store the timestamp field as a special hidden datetime field
-        # for sorting.
-        result['sort$timestamp'] = timestamp_parser.parse(result['timestamp'])
-        id = self.collection.insert_one(result)
-        id.addCallback(to_str)
-        return id
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        timestamps = [_utc_timestamp(result) for result in results]
+        ids = []
+        for timestamp, result in zip(timestamps, results):
+            index = self._shard_index(result)
+            if index is None:
+                index = 0
+            id = self._shards[index]._add(timestamp, result)
+            ids.append('{}{:02x}'.format(id, index))
+        return succeed(ids)
+
+    def load(self, entries):
+        """
+        Store results in bulk, keeping the identifiers they were dumped
+        with, as ``InMemoryBackend.load`` does.
+
+        The identifiers are kept if they are in the shards of their
+        results, so the results dumped with a different number of shards
+        or partitioning field get new identifiers.
+
+        :param list entries: The ``(id, result)`` pairs.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        positions = [[] for _ in self._shards]
+        batches = [[] for _ in self._shards]
+        for position, (id, result) in enumerate(entries):
+            index = self._shard_index(result)
+            if index is None:
+                index = 0
+            if (isinstance(id, basestring) and len(id) == 26 and
+                    id[-2:] == '{:02x}'.format(index) and _is_id(id[:-2])):
+                batches[index].append((id[:-2], None, result))
+            else:
+                batches[index].append((None, _utc_timestamp(result), result))
+            positions[index].append(position)
+        ids = [None] * len(entries)
+        for index, batch in enumerate(batches):
+            shard_ids = self._shards[index]._load(batch)
+            for position, id in zip(positions[index], shard_ids):
+                ids[position] = '{}{:02x}'.format(id, index)
+        return succeed(ids)
+
+    def retrieve(self, id, fields=None):
+        """
+        Retrive a result by the given identifier.
+        """
+        try:
+            shard, shard_id = self._locate(id)
+        except BadResultId as e:
+            return fail(e)
+        d = shard.retrieve(shard_id, fields)
+        d.addErrback(_reraise_not_found, id)
+        return d
+
+    def query(self, filter, limit=None, fields=None):
+        """
+        Return matching results.
+
+        A filter on the partitioning field is answered by its shard.
+        Otherwise the results of all the shards are merged until the
+        limit is reached.
+        """
+        index = self._shard_index(filter)
+        if index is not None:
+            return self._shards[index].query(filter, limit, fields)
+        matching = islice(self._iter_matching(filter), limit)
+        return succeed(
+            [_project(result, fields) for (_, result) in matching]
+        )
+
+    def latest(self, filter, key, limit=None, fields=None):
+        """
+        Return the latest matching result for every value of a userdata
+        field.
+
+        A filter on the partitioning field is answered by its shard.
+        Otherwise the latest results of the groups in all the shards are
+        combined.
+        """
+        index = self._shard_index(filter)
+        if index is not None:
+            return self._shards[index].latest(filter, key, limit, fields)
+        latest = {}
+        for index, shard in enumerate(self._shards):
+            for id, result in shard._latest_entries(filter, key):
+                id = '{}{:02x}'.format(id, index)
+                group = _group_of(result, key)
+                if latest.get(group, ('',))[0] < id:
+                    latest[group] = (id, result)
+        entries = sorted(latest.itervalues(), reverse=True)[:limit]
+        return succeed(
+            [_project(result, fields) for (_, result) in entries]
+        )
+
+    def page(self, filter, limit=None, cursor=None, fields=None):
+        """
+        Return a page of matching results.
+
+        The cursor is the identifier of the last result of the previous
+        page.
+        """
+        if cursor is not None and not (
+                len(cursor) == 26 and _is_id(cursor[:-2]) and
+                all(c in '0123456789abcdef' for c in cursor[-2:])):
+            return fail(BadRequest("Invalid cursor {}".format(cursor)))
+        entries, next_cursor = _paginate(
+            self._iter_matching(filter, cursor), limit
+        )
+        return succeed((_project_entries(entries, fields), next_cursor))
+
+    def cursor_before(self, timestamp):
+        """
+        Make a cursor for the page of the results before a timestamp, as
+        ``InMemoryBackend.cursor_before`` does.
+        """
+        return '{}00'.format(_make_id(timestamp, 0))
+
+    def _iter_matching(self, filter, before=None):
+        """
+        Iterate over the matching results of all the relevant shards from
+        the latest to the oldest.
+
+        :param str before: Only iterate over the results with identifiers
+            less than this one, if given.
+        :return: An iterator over the identifiers and the results.
+        """
+        index = self._shard_index(filter)
+        if index is None:
+            indices = range(len(self._shards))
+        else:
+            indices = [index]
+
+        def iter_shard(index):
+            shard = self._shards[index]
+            if before is None:
+                matching = shard._iter_matching(filter)
+            else:
+                # The identifiers are compared by the identifier within
+                # the shard and then by the shard index.
+                matching = shard._iter_matching(
+                    filter, before[:-2], int(before[-2:], 16) > index
+                )
+            for id, result in matching:
+                yield '{}{:02x}'.format(id, index), result
+
+        # The identifiers are time-ordered, so they are the sort key of
+        # the merge.
+        return _merge_descending(
+            map(iter_shard, indices), key=itemgetter(0)
+        )
+
+    def delete(self, id):
+        """
+        Delete a result by the given identifier.
+        """
+        try:
+            shard, shard_id = self._locate(id)
+        except BadResultId as e:
+            return fail(e)
+        d = shard.delete(shard_id)
+        d.addErrback(_reraise_not_found, id)
+        return d
+
+
+def _reraise_not_found(failure, id):
+    """
+    Report a result that is not found by a part of a backend under the
+    identifier known to the clients of the backend.
+    """
+    failure.trap(ResultNotFound)
+    raise failure.value.__class__(id)
+
+
+class UpstreamError(Exception):
+    """
+    A downstream benchmark server failed to process a request.
+    """
+
+
+def _filter_to_args(filter):
+    """
+    Convert a filter to the query arguments of the HTTP API.
+
+    :raises BadRequest: If the filter can not be expressed with the
+        arguments.
+    """
+    if not filter:
+        return {}
+    userdata = filter.get('userdata')
+    if (filter.keys() == ['userdata'] and isinstance(userdata, dict) and
+            userdata.keys() == ['branch']):
+        return {'branch': userdata['branch']}
+    raise BadRequest("Unsupported filter {}".format(dumps(filter)))
+
+
+def _translate_error(failure, id=None):
+    """
+    Report an error response of a downstream server as the error of a
+    backend.
+
+    :param id: The identifier of the result the request was about, if any.
+    """
+    failure.trap(APIError)
+    error = failure.value
+    if error.code == NOT_FOUND and id is not None:
+        raise ResultNotFound(id)
+    if error.code == BAD_REQUEST:
+        raise BadRequest(error.message)
+    raise UpstreamError(
+        "Downstream server failed with {}: {}".format(
+            error.code, error.message
+        )
+    )
+
+
+@implementer(IBackend)
+class HTTPBackend(object):
+    """
+    The backend that keeps the results in another benchmark server,
+    using its HTTP API.
+    """
+    def __init__(self, url, reactor=None):
+        """
+        :param str url: The root URL of the API of the server, e.g.
+            ``http://127.0.0.1:8888/v1``.
+        :param reactor: The reactor to use, the global one by default.
+        """
+        self._client = BenchmarkClient(url, reactor)
+
+    def disconnect(self):
+        return self._client.close()
+
+    def store(self, result):
+        """
+        Store a single benchmarking result and return its identifier.
+
+        :param dict result: The result in the JSON compatible format.
+        :return: A Deferred that produces an identifier for the stored
+            result.
+        """
+        d = self._client.store(result)
+        d.addErrback(_translate_error)
+        return d
+
+    def store_many(self, results):
+        """
+        Store several benchmarking results and return their identifiers.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        d = self._client.store_many(results)
+        d.addErrback(_translate_error)
+        return d
+
+    def load(self, entries):
+        """
+        Store results in bulk.
 
-    def retrieve(self, id):
+        The API has no way to keep the identifiers, so the results are
+        submitted in one request and get new identifiers.
+
+        :param list entries: The ``(id, result)`` pairs.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        return self.store_many([result for _, result in entries])
+
+    def retrieve(self, id, fields=None):
         """
         Retrive a result by the given identifier.
         """
+        d = self._client.retrieve(id, fields)
+        d.addErrback(_translate_error, id)
+        return d
+
+    def query(self, filter, limit=None, fields=None):
+        """
+        Return matching results.
+        """
+        try:
+            args = _filter_to_args(filter)
+        except BadRequest:
+            return fail()
+        d = self._client.query(limit=limit, fields=fields, **args)
+        d.addErrback(_translate_error)
+        return d
+
+    def latest(self, filter, key, limit=None, fields=None):
+        """
+        Return the latest matching result for every value of a userdata
+        field.
+        """
+        try:
+            args = _filter_to_args(filter)
+        except BadRequest:
+            return fail()
+        d = self._client.latest(key, limit=limit, fields=fields, **args)
+        d.addErrback(_translate_error)
+        return d
+
+    def page(self, filter, limit=None, cursor=None, fields=None):
+        """
+        Return a page of matching results.
+        """
         try:
-            object_id = ObjectId(id)
-        except InvalidId:
+            args = _filter_to_args(filter)
+        except BadRequest:
+            return fail()
+        d = self._client.page(
+            limit=limit, cursor=cursor, fields=fields, **args
+        )
+        d.addErrback(_translate_error)
+        return d
+
+    def delete(self, id):
+        """
+        Delete a result by the given identifier.
+        """
+        d = self._client.delete(id)
+        d.addErrback(_translate_error, id)
+        return d
+
+
+def _merge_fields(fields):
+    """
+    Get the fields of the results that must be retrieved to merge them by
+    the timestamp.
+    """
+    if fields is None or 'timestamp' in fields:
+        return fields
+    return list(fields) + ['timestamp']
+
+
+def _ring_hash(value):
+    """
+    Hash a value to a position on the ring of ``RoutingBackend``.
+    """
+    return md5(value).digest()
+
+
+@implementer(IBackend)
+class RoutingBackend(object):
+    """
+    The backend that spreads the results between other backends by
+    consistent hashing of their branch.
+
+    The identifier of a result is the name of its backend joined by a
+    hyphen with the identifier given to it by that backend.  So adding
+    a backend moves new results of some branches to it, while the
+    existing results remain reachable.
+    """
+    def __init__(self, backends, replicas=100):
+        """
+        :param dict backends: The backends by their names.  The names
+            must not contain hyphens and must not change for the lifetime
+            of the stored results.
+        :param int replicas: The number of the positions of each backend
+            on the hash ring.
+        """
+        for name in backends:
+            if '-' in name:
+                raise ValueError(
+                    "Backend name {} contains a hyphen".format(name)
+                )
+        self._backends = backends
+        ring = [
+            (_ring_hash('{}-{}'.format(name, replica)), name)
+            for name in backends
+            for replica in range(replicas)
+        ]
+        ring.sort()
+        self._ring_hashes = [position for (position, _) in ring]
+        self._ring_names = [name for (_, name) in ring]
+
+    def disconnect(self):
+        return gatherResults(
+            [backend.disconnect() for backend in self._backends.values()],
+            consumeErrors=True,
+        )
+
+    def _route(self, branch):
+        """
+        Get the name of the backend for a branch.
+        """
+        position = _ring_hash(dumps(branch))
+        index = bisect(self._ring_hashes, position)
+        return self._ring_names[index % len(self._ring_names)]
+
+    def _locate(self, id):
+        """
+        Get the backend and the identifier within it for a result.
+        """
+        name, _, backend_id = id.partition('-')
+        if name not in self._backends or not backend_id:
             raise BadResultId(id)
+        return self._backends[name], backend_id
+
+    def store(self, result):
+        """
+        Store a single benchmarking result and return its identifier.
+
+        :param dict result: The result in the JSON compatible format.
+        :return: A Deferred that produces an identifier for the stored
+            result.
+        """
+        name = self._route(_branch_of(result))
+        d = self._backends[name].store(result)
+        d.addCallback(lambda id: '{}-{}'.format(name, id))
+        return d
+
+    def store_many(self, results):
+        """
+        Store several benchmarking results and return their identifiers.
+
+        The results are sent to each backend in one request.  If one of
+        the backends fails, the results stored by the others remain.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        def store_many(name, batch):
+            return self._backends[name].store_many(batch)
+
+        return self._spread(results, store_many)
+
+    def load(self, entries):
+        """
+        Store results in bulk, keeping the identifiers they were dumped
+        with if the branches of their results are still routed to the
+        backends named by them.
 
-        def post_process(result):
-            if result is None:
-                raise ResultNotFound(id)
-            return result
-
-        # Do not include the '_id' and 'sort$timestamp' fields in the
-        # results as these are not part of the original document.
-        # If we later choose to include '_id', its type is 'ObjectId'
-        # which can not be serialized to JSON. Either a custom
-        # JSONEncoder or bson.json_util.dumps would be needed.
-        d = self.collection.find_one(
-            {'_id': object_id},
-            fields={'_id': False, 'sort$timestamp': False}
+        :param list entries: The ``(id, result)`` pairs.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        def load(name, batch):
+            backend_entries = []
+            for id, result in batch:
+                prefix, _, backend_id = (id or '').partition('-')
+                if prefix != name or not backend_id:
+                    backend_id = None
+                backend_entries.append((backend_id, result))
+            return self._backends[name].load(backend_entries)
+
+        return self._spread(entries, load, itemgetter(1))
+
+    def _spread(self, items, store, result_of=lambda item: item):
+        """
+        Store items in the backends their results are routed to, in one
+        call per backend.
+
+        :param list items: The items to store.
+        :param store: The function to call with the name of a backend and
+            the list of its items, which returns a Deferred that produces
+            their identifiers.
+        :param result_of: The function to get the result of an item with.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        positions = defaultdict(list)
+        for position, item in enumerate(items):
+            positions[self._route(_branch_of(result_of(item)))].append(
+                position
+            )
+        names = list(positions)
+        d = gatherResults(
+            [store(name, [items[position] for position in positions[name]])
+             for name in names],
+            consumeErrors=True,
         )
-        d.addCallback(post_process)
+        d.addErrback(lambda failure: failure.value.subFailure)
+
+        def collect(stored):
+            ids = [None] * len(items)
+            for name, backend_ids in zip(names, stored):
+                for position, id in zip(positions[name], backend_ids):
+                    ids[position] = '{}-{}'.format(name, id)
+            return ids
+
+        d.addCallback(collect)
+        return d
+
+    def retrieve(self, id, fields=None):
+        """
+        Retrive a result by the given identifier.
+        """
+        try:
+            backend, backend_id = self._locate(id)
+        except BadResultId as e:
+            return fail(e)
+        d = backend.retrieve(backend_id, fields)
+        d.addErrback(_reraise_not_found, id)
         return d
 
-    def query(self, filter, limit=None):
+    def query(self, filter, limit=None, fields=None):
         """
         Return matching results.
+
+        A filter on the branch is answered by the backend of the branch.
+        Otherwise the query is sent to all the backends and the latest
+        results are picked from their responses.
         """
-        if limit == 0:
-            return succeed([])
-
-        # The txmongo API differs from pymongo with regard to sorting.
-        # To sort results when making a query using txmongo, a query
-        # filter needs to be created and passed to collection.find().
-        sort_filter = orderby(DESCENDING('sort$timestamp'))
-
-        # Do not include the '_id' and 'sort$timestamp' fields in the
-        # results as these are not part of the original document.
-        find_args = dict(
-            filter=sort_filter,
-            fields={'_id': False, 'sort$timestamp': False}
+        branch = _branch_of(filter)
+        if branch is not None:
+            return self._backends[self._route(branch)].query(
+                filter, limit, fields
+            )
+
+        # The backends are queried in the order of their names, so that
+        # the results with equal timestamps are ordered as in the pages.
+        d = gatherResults(
+            [self._backends[name].query(filter, limit, _merge_fields(fields))
+             for name in sorted(self._backends)],
+            consumeErrors=True,
+        )
+        d.addErrback(lambda failure: failure.value.subFailure)
+
+        def merge(results):
+            merged = _merge_descending(results, key=_utc_timestamp)
+            merged = list(islice(merged, limit))
+            if _merge_fields(fields) is not fields:
+                for result in merged:
+                    del result['timestamp']
+            return merged
+
+        d.addCallback(merge)
+        return d
+
+    def latest(self, filter, key, limit=None, fields=None):
+        """
+        Return the latest matching result for every value of a userdata
+        field.
+
+        A filter on the branch is answered by the backend of the branch.
+        Otherwise the latest results of the groups in all the backends
+        are combined.  The latest ``limit`` groups overall are among the
+        latest ``limit`` groups of the backends that hold their latest
+        results, so the limit is passed on to the backends.
+        """
+        branch = _branch_of(filter)
+        if branch is not None:
+            return self._backends[self._route(branch)].latest(
+                filter, key, limit, fields
+            )
+
+        backend_fields = fields
+        if fields is not None:
+            # The group of every result is needed to combine them.
+            backend_fields = list(_merge_fields(fields))
+            if not {'userdata', 'userdata.' + key} & set(fields):
+                backend_fields.append('userdata.' + key)
+        names = sorted(self._backends)
+        d = gatherResults(
+            [self._backends[name].latest(filter, key, limit, backend_fields)
+             for name in names],
+            consumeErrors=True,
         )
-        if limit:
-            find_args['limit'] = limit
+        d.addErrback(lambda failure: failure.value.subFailure)
+
+        def combine(results):
+            # The first result of a group in the merged results is the
+            # latest one.
+            groups = set()
+            combined = []
+            for result in _merge_descending(results, key=_utc_timestamp):
+                group = _group_of(result, key)
+                if group not in groups:
+                    groups.add(group)
+                    combined.append(_project(result, fields))
+            return combined[:limit]
+
+        d.addCallback(combine)
+        return d
+
+    def page(self, filter, limit=None, cursor=None, fields=None):
+        """
+        Return a page of matching results.
+
+        A filter on the branch is answered by the backend of the branch
+        with its own cursors.  Otherwise a page is requested from every
+        backend and the latest results are picked from them.  The cursor
+        then holds, for every backend that has more results, the cursor
+        of its last requested page and the number of the results of that
+        page that have already been returned.
+        """
+        branch = _branch_of(filter)
+        if branch is not None:
+            name = self._route(branch)
+            d = self._backends[name].page(filter, limit, cursor, fields)
+
+            def qualify(page):
+                entries, next_cursor = page
+                entries = [
+                    ('{}-{}'.format(name, id), result)
+                    for id, result in entries
+                ]
+                return entries, next_cursor
+
+            d.addCallback(qualify)
+            return d
+
+        if cursor is None:
+            state = {name: [None, 0] for name in self._backends}
+        else:
+            try:
+                state = self._decode_cursor(cursor)
+            except BadRequest:
+                return fail()
+        names = sorted(state)
+
+        def fetch(name):
+            backend_cursor, skip = state[name]
+            backend_limit = None if limit is None else limit + skip
+            return self._backends[name].page(
+                filter, backend_limit, backend_cursor, _merge_fields(fields)
+            )
+
+        d = gatherResults(map(fetch, names), consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+
+        def merge(pages):
+            # The entries of the backends that have been returned already
+            # are skipped.
+            remaining = [
+                [(name, id, result)
+                 for id, result in entries[state[name][1]:]]
+                for name, (entries, _) in zip(names, pages)
+            ]
+            merged = _merge_descending(
+                remaining, key=lambda entry: _utc_timestamp(entry[2])
+            )
+            merged = list(islice(merged, limit))
+            if _merge_fields(fields) is not fields:
+                for _, _, result in merged:
+                    del result['timestamp']
+            returned = defaultdict(int)
+            for name, _, _ in merged:
+                returned[name] += 1
+            next_state = {}
+            for name, (entries, backend_next) in zip(names, pages):
+                backend_cursor, skip = state[name]
+                skip += returned[name]
+                if skip < len(entries):
+                    next_state[name] = [backend_cursor, skip]
+                elif backend_next is not None:
+                    next_state[name] = [backend_next, 0]
+            entries = [
+                ('{}-{}'.format(name, id), result)
+                for name, id, result in merged
+            ]
+            next_cursor = None
+            if next_state:
+                next_cursor = self._encode_cursor(next_state)
+            return entries, next_cursor
+
+        d.addCallback(merge)
+        return d
+
+    @staticmethod
+    def _encode_cursor(state):
+        return urlsafe_b64encode(dumps(state, sort_keys=True))
 
-        return self.collection.find(filter, **find_args)
+    def _decode_cursor(self, cursor):
+        """
+        Decode the cursor of a page of the results of all the backends.
+
+        :raises BadRequest: If the cursor is not valid.
+        """
+        invalid = BadRequest("Invalid cursor {}".format(cursor))
+        try:
+            encoded = loads(urlsafe_b64decode(cursor))
+            state = {}
+            for name, (backend_cursor, skip) in encoded.iteritems():
+                name = name.encode('ascii')
+                if backend_cursor is not None:
+                    backend_cursor = backend_cursor.encode('ascii')
+                if (name not in self._backends or
+                        not isinstance(skip, int) or skip < 0):
+                    raise invalid
+                state[name] = [backend_cursor, skip]
+        except (AttributeError, TypeError, ValueError):
+            raise invalid
+        return state
 
     def delete(self, id):
         """
         Delete a result by the given identifier.
         """
         try:
-            object_id = ObjectId(id)
-        except InvalidId:
-            raise BadResultId(id)
+            backend, backend_id = self._locate(id)
+        except BadResultId as e:
+            return fail(e)
+        d = backend.delete(backend_id)
+        d.addErrback(_reraise_not_found, id)
+        return d
 
-        def handle_result(result):
-            if result.deleted_count == 0:
-                raise ResultNotFound(id)
-            return None
 
-        d = self.collection.delete_one({'_id': object_id})
-        d.addCallback(handle_result)
+class ResultFeed(object):
+    """
+    A feed of the recently stored results.
+
+    Every published result gets the next position in the feed.  Clients
+    remember the position of the last result they have seen and wait for
+    the results published after it.  A waiting client costs only a
+    Deferred and a timer until a matching result is published.
+
+    :ivar int position: The position of the most recently published
+        result.
+    """
+    def __init__(self, reactor, size=1000):
+        """
+        :param reactor: The reactor used for the waiting timeouts.
+        :param int size: The number of the recent results to retain
+            for the clients that are catching up.
+        """
+        self._reactor = reactor
+        self._recent = deque(maxlen=size)
+        # Waiters are indexed by the branch they are interested in,
+        # so that publishing a result wakes up only the relevant ones.
+        # Waiters for all branches are kept under None.
+        self._waiters = defaultdict(set)
+        self.position = 0
+
+    def publish(self, result):
+        """
+        Publish a newly stored result.
+
+        :param dict result: The result in the JSON compatible format.
+        """
+        self.position += 1
+        self._recent.append((self.position, result))
+        branch = _branch_of(result)
+        waiters = list(self._waiters.get(None, ()))
+        # The clients wait for a branch named by a string, and a branch of
+        # another type may not even be hashable.
+        if isinstance(branch, basestring):
+            waiters.extend(self._waiters.get(branch, ()))
+        for waiter in waiters:
+            waiter(self.position, result)
+
+    def changes(self, filter, since):
+        """
+        Get the retained results published after the given position.
+
+        :param dict filter: The filter in the JSON compatible format.
+        :param int since: The position of the last result seen by the
+            client.  A position beyond the end of the feed, e.g. one
+            from before a server restart, is treated as zero.
+        :return: A tuple of the current position and a list of the
+            matching results in the order they were published.
+        """
+        if since > self.position:
+            since = 0
+        results = [
+            result for (position, result) in self._recent
+            if position > since and _matches(filter, result)
+        ]
+        return self.position, results
+
+    def truncated(self, since):
+        """
+        Check whether some of the results published after the given
+        position are no longer retained, so that ``changes`` misses them.
+
+        :param int since: The position of the last result seen by the
+            client, treated as in ``changes``.
+        :return: True if results were dropped after the position.
+        """
+        if since > self.position:
+            since = 0
+        return bool(self._recent) and since < self._recent[0][0] - 1
+
+    def wait(self, filter, since, timeout):
+        """
+        Wait for results published after the given position.
+
+        :param dict filter: The filter in the JSON compatible format.
+        :param int since: The position of the last result seen by the
+            client.
+        :param int timeout: The number of seconds to wait for a matching
+            result.
+        :return: A Deferred that fires with a tuple of the current
+            position and a list of the matching results.  The list is
+            empty if no matching result was published before the timeout.
+            It fires immediately if results were dropped after the
+            position, so that the client can catch up otherwise.
+        """
+        position, results = self.changes(filter, since)
+        if results or not timeout or self.truncated(since):
+            return succeed((position, results))
+
+        key = _branch_of(filter)
+
+        def cleanup():
+            waiters = self._waiters[key]
+            waiters.discard(waiter)
+            if not waiters:
+                del self._waiters[key]
+            if timer.active():
+                timer.cancel()
+
+        def waiter(position, result):
+            if _matches(filter, result):
+                cleanup()
+                d.callback((position, [result]))
+
+        def expire():
+            cleanup()
+            d.callback((self.position, []))
+
+        d = Deferred(lambda _: cleanup())
+        timer = self._reactor.callLater(timeout, expire)
+        self._waiters[key].add(waiter)
         return d
 
 
+# The range of the integers that BSON and MessagePack encode as signed
+# 64-bit integers, and that MongoDB stores.
+_MIN_INTEGER = -2 ** 63
+_MAX_INTEGER = 2 ** 63 - 1
+
+
+def _check_integers(value):
+    """
+    Check that the integers in a value, down to its subdocuments, are in
+    the range of the signed 64-bit integers.
+
+    :raises BadRequest: If one is not.
+    """
+    if isinstance(value, dict):
+        map(_check_integers, value.itervalues())
+    elif isinstance(value, list):
+        map(_check_integers, value)
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        if not _MIN_INTEGER <= value <= _MAX_INTEGER:
+            raise BadRequest("Integer {} is out of range".format(value))
+
+
+def _validate_result(result):
+    """
+    Check that a submitted result has a valid timestamp, and only integers
+    that every response format can encode.
+
+    :raises BadRequest: If the timestamp is missing or not valid, or an
+        integer is out of range.
+    """
+    try:
+        _utc_timestamp(result)
+    except KeyError as e:
+        raise BadRequest("'{}' is missing".format(e.message))
+    except ValueError as e:
+        raise BadRequest(e.message)
+    _check_integers(result)
+
+
+def _validate_results(results):
+    """
+    Check that a bulk submission is a list of valid results.
+
+    :raises BadRequest: If it is not.
+    """
+    if not isinstance(results, list):
+        raise BadRequest("Expected a list of results")
+    for result in results:
+        if not isinstance(result, dict):
+            raise BadRequest("Expected a list of results")
+        _validate_result(result)
+
+
+def _bad_json(failure):
+    """
+    Report a request body that is not valid JSON as a bad request.
+    """
+    failure.trap(ValueError)
+    raise BadRequest(failure.value.message)
+
+
+def _admitted(route_class):
+    """
+    Decorate an API method, so that its requests are subject to the
+    admission control of the API.
+
+    :param str route_class: The class of the requests.
+    """
+    def decorator(f):
+        @wraps(f)
+        def admitted(self, *args, **kwargs):
+            return self.admission.run(route_class, f, self, *args, **kwargs)
+        return admitted
+    return decorator
+
+
 class BenchmarkAPI_V1(object):
     """
     API for storing and accessing benchmarking results.
 
     :ivar IBackend backend: The backend for storing the results.
+    :ivar ResultFeed feed: The feed of the results stored via this API.
+    :ivar AdmissionControl admission: The admission control for the
+        requests.
+    :ivar JSONCodec codec: The codec for the request and response bodies.
+    :ivar SketchIndex sketches: The sketches of the results stored via
+        this API.
+    :ivar dedup: The index of the keys of the submissions, a
+        ``DedupIndex`` or one provided by the backend.
+    :ivar bool content_keys: Whether the submissions without an
+        ``Idempotency-Key`` header are keyed by their content.
+    :ivar RegressionIndex regressions: The statistics of the series of
+        the results stored via this API.
     """
     app = Klein()
     version = 1
 
-    def __init__(self, backend):
+    # The default and the maximum number of seconds a client may wait
+    # for changes.
+    changes_timeout = 30
+    max_changes_timeout = 300
+
+    # The number of the results read from the backend at once by exports.
+    export_page_size = 1000
+
+    # The maximum length of an idempotency key.
+    max_key_length = 255
+
+    def __init__(self, backend, reactor=None, admission=None, codec=None,
+                 sketches=None, dedup=None, content_keys=False,
+                 regressions=None):
         """
         :param IBackend backend: The backend for storing the results.
+        :param reactor: The reactor to use, the global one by default.
+        :param AdmissionControl admission: The admission control for the
+            requests.  By default the requests are not limited.
+        :param JSONCodec codec: The codec for the request and response
+            bodies.  By default, large bodies are processed in the
+            reactor's thread pool.
+        :param SketchIndex sketches: The sketches to update with the
+            stored results.  By default, the sketches start empty.
+        :param dedup: The index of the keys of the submissions.  By
+            default, the keys are kept in the memory.
+        :param bool content_keys: Whether to key the submissions without
+            an ``Idempotency-Key`` header by their content, so that
+            identical submissions are stored once.
+        :param RegressionIndex regressions: The statistics to update with
+            the stored results.  By default, the statistics start empty and
+            the series are identified by the branch.
         """
+        if reactor is None:
+            from twisted.internet import reactor
+        if admission is None:
+            admission = AdmissionControl(reactor)
+        if codec is None:
+            codec = JSONCodec(reactor)
+        if sketches is None:
+            sketches = SketchIndex()
+        if dedup is None:
+            dedup = DedupIndex(reactor)
+        if regressions is None:
+            regressions = RegressionIndex()
         self.backend = backend
+        self.feed = ResultFeed(reactor)
+        self.admission = admission
+        self.codec = codec
+        self.sketches = sketches
+        self.dedup = dedup
+        self.content_keys = content_keys
+        self.regressions = regressions
 
     @staticmethod
     def _make_error_body(message):
@@ -258,6 +1531,41 @@ class BenchmarkAPI_V1(object):
         request.setHeader(b'content-type', b'application/json')
         return self._make_error_body(failure.value.message)
 
+    @app.handle_errors(KeyReused)
+    def _key_reused(self, request, failure):
+        request.setResponseCode(BAD_REQUEST)
+        request.setHeader(b'content-type', b'application/json')
+        return self._make_error_body(
+            "Idempotency key {} was used for a different request".format(
+                failure.value.message
+            )
+        )
+
+    @app.handle_errors(InProgress)
+    def _in_progress(self, request, failure):
+        request.setResponseCode(CONFLICT)
+        request.setHeader(b'content-type', b'application/json')
+        return self._make_error_body(
+            "A request with idempotency key {} is in progress".format(
+                failure.value.message
+            )
+        )
+
+    @app.handle_errors(RequestTooLarge)
+    def _too_large(self, request, failure):
+        request.setResponseCode(REQUEST_ENTITY_TOO_LARGE)
+        request.setHeader(b'content-type', b'application/json')
+        return self._make_error_body("Request body is too large")
+
+    @app.handle_errors(Overloaded)
+    def _overloaded(self, request, failure):
+        request.setResponseCode(SERVICE_UNAVAILABLE)
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(
+            b'retry-after', b'{}'.format(self.admission.retry_after)
+        )
+        return self._make_error_body("Server is overloaded")
+
     @app.handle_errors(Exception)
     def _unhandled_error(self, request, failure):
         err(failure, "Unhandled error")
@@ -266,25 +1574,38 @@ class BenchmarkAPI_V1(object):
         return self._make_error_body(failure.value.message)
 
     @app.route("/benchmark-results", methods=['POST'])
+    @_admitted('write')
     def post(self, request):
         """
         Post a new benchmarking result.
 
+        The result is JSON, unless the content type of the request is
+        ``application/bson`` or ``application/x-msgpack``.
+
+        A request with an ``Idempotency-Key`` header is processed once per
+        key, see ``_store_once``.
+
         :param twisted.web.http.Request request: The request.
         """
         request.setHeader(b'content-type', b'application/json')
-        try:
-            json = loads(request.content.read())
-            timestamp_parser.parse(json['timestamp'])
-        except KeyError as e:
-            raise BadRequest("'{}' is missing".format(e.message))
-        except ValueError as e:
-            raise BadRequest(e.message)
-
-        d = self.backend.store(json)
-
-        def stored(id):
-            msg("stored result with id {}".format(id))
+        d = self.codec.decode(
+            read_body(request), _validate_result,
+            request_format(request.getHeader(b'content-type')),
+        )
+        d.addErrback(_bad_json)
+
+        def decoded(json):
+            d = self._store_once(request, json, self.backend.store)
+            d.addCallback(stored, json)
+            return d
+
+        def stored(outcome, json):
+            id, new = outcome
+            if new:
+                msg("stored result with id {}".format(id))
+                self.feed.publish(json)
+                self.sketches.add(id, json)
+                self.regressions.add(id, json)
             result = {"version": self.version, "id": id}
             response = dumps(result)
             location = urljoin(request.path + '/', id)
@@ -292,19 +1613,130 @@ class BenchmarkAPI_V1(object):
             request.setResponseCode(CREATED)
             return response
 
-        d.addCallback(stored)
+        d.addCallback(decoded)
+        return d
+
+    @app.route("/benchmark-results/bulk", methods=['POST'])
+    @_admitted('write')
+    def post_many(self, request):
+        """
+        Post several new benchmarking results at once.
+
+        The request body is a list of the results, in the formats of
+        ``post``.  In BSON, it is the sequence of the results.  The
+        response holds the list of their identifiers in the same order.
+        The request is processed once per idempotency key, as in ``post``.
+
+        :param twisted.web.http.Request request: The request.
+        """
+        request.setHeader(b'content-type', b'application/json')
+        d = self.codec.decode(
+            read_body(request), _validate_results,
+            request_format(request.getHeader(b'content-type')), many=True,
+        )
+        d.addErrback(_bad_json)
+
+        def decoded(json):
+            d = self._store_once(request, json, self.backend.store_many)
+            d.addCallback(stored, json)
+            return d
+
+        def stored(outcome, json):
+            ids, new = outcome
+            if new:
+                msg("stored {} results".format(len(ids)))
+                for id, result in zip(ids, json):
+                    self.feed.publish(result)
+                    self.sketches.add(id, result)
+                    self.regressions.add(id, result)
+            request.setResponseCode(CREATED)
+            return dumps({"version": self.version, "ids": ids})
+
+        d.addCallback(decoded)
+        return d
+
+    def _store_once(self, request, json, store):
+        """
+        Store the results of a submission, unless a submission with the
+        same key has been stored already.
+
+        The key is the ``Idempotency-Key`` header of the request or, if
+        ``content_keys`` is set, derived from the submitted results.  A
+        repeated submission is answered as the first one was, with an
+        ``Idempotent-Replayed`` header added.
+
+        :param twisted.web.http.Request request: The request.
+        :param json: The submitted results.
+        :param store: The function that stores the results.
+        :return: A Deferred that fires with the identifiers of the results
+            and whether they have been stored just now.
+        """
+        key = request.getHeader(b'idempotency-key')
+        if key is None and not self.content_keys:
+            d = store(json)
+            d.addCallback(lambda ids: (ids, True))
+            return d
+        if key is not None and not self._is_valid_key(key):
+            raise BadRequest("Idempotency key is not valid")
+        digest = fingerprint(request.path, json)
+        if key is None:
+            key = b'content:' + digest
+        else:
+            key = b'client:' + key
+
+        def claimed(previous):
+            if previous is not None:
+                msg("replayed the request with key {}".format(key))
+                request.setHeader(b'idempotent-replayed', b'true')
+                return previous, False
+            d = store(json)
+            d.addCallbacks(completed, failed)
+            return d
+
+        def completed(ids):
+            d = self.dedup.complete(key, ids)
+            d.addCallback(lambda _: (ids, True))
+            return d
+
+        def failed(failure):
+            d = self.dedup.release(key)
+            d.addBoth(lambda _: failure)
+            return d
+
+        d = self.dedup.claim(key, digest)
+        d.addCallback(claimed)
         return d
 
+    def _is_valid_key(self, key):
+        """
+        Check whether an idempotency key is not empty, not too long and
+        UTF-8 text, which the backends can store as a string.
+        """
+        if not 0 < len(key) <= self.max_key_length:
+            return False
+        try:
+            key.decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+        return True
+
     @app.route("/benchmark-results/<string:id>", methods=['GET'])
+    @_admitted('read')
     def get(self, request, id):
         """
         Get a previously stored benchmarking result by its ID.
 
+        Only some fields of the result are returned if the ``fields``
+        argument is given, as in ``query``.
+
         :param twisted.web.http.Request request: The request.
         :param str id: The identifier.
         """
         request.setHeader(b'content-type', b'application/json')
-        d = self.backend.retrieve(id)
+        fields = None
+        if 'fields' in request.args:
+            fields = _parse_fields('fields', request.args['fields'])
+        d = self.backend.retrieve(id, fields)
 
         def retrieved(result):
             response = dumps(result)
@@ -314,6 +1746,7 @@ class BenchmarkAPI_V1(object):
         return d
 
     @app.route("/benchmark-results/<string:id>", methods=['DELETE'])
+    @_admitted('write')
     def delete(self, request, id):
         """
         Delete a previously stored benchmarking result by its ID.
@@ -326,73 +1759,439 @@ class BenchmarkAPI_V1(object):
         return self.backend.delete(id)
 
     @app.route("/benchmark-results", methods=['GET'])
+    @_admitted('read')
     def query(self, request):
         """
         Query the previously stored benchmarking results.
 
         Currently this method only supports filtering the results by the
         branch name.
-        There is no support for paging of results, but a limit on the
-        number of the results to return may be specified.
+        A limit on the number of the results to return may be specified.
         The returned results are ordered by the timestamp in descending
         order.
 
+        The results are paged if the ``cursor`` argument is given.  It is
+        empty for the first page and the ``next`` field of the previous
+        page for the following ones.  The ``limit`` is then the size of a
+        page.  ``next`` is null for the last page.
+
+        Only some fields of the results are returned if the ``fields``
+        argument is given.  It is a comma separated list of the fields,
+        where the fields of subdocuments are given as paths joined by
+        dots, e.g. ``timestamp,result,userdata.branch``.
+
+        Only the latest result for every value of a userdata field is
+        returned if the ``latest`` argument gives the field, e.g.
+        ``latest=branch``.  The results without the field are skipped.
+        The results are then not paged.
+
+        The response is JSON, unless ``application/bson`` or
+        ``application/x-msgpack`` comes first in the Accept header.
+
         :param twisted.web.http.Request request: The request.
         """
-        request.setHeader(b'content-type', b'application/json')
+        content_type = response_format(request.getHeader(b'accept'))
+        request.setHeader(b'content-type', content_type)
         params = self._parse_query_args(request.args)
-        d = self.backend.query(**params)
+        if 'cursor' in params:
+            if 'key' in params:
+                raise BadRequest("latest results are not paged")
+            return self._page(content_type=content_type, **params)
+        if 'key' in params:
+            d = self.backend.latest(**params)
+        else:
+            d = self.backend.query(**params)
 
         def got_results(results):
-            result = {"version": self.version, "results": results}
-            return dumps(result)
+            return self.codec.encode_results(
+                {"version": self.version}, results, content_type
+            )
 
         d.addCallback(got_results)
         return d
 
+    def _page(self, filter, limit, cursor, fields, content_type):
+        if limit == 0:
+            raise BadRequest("limit must be positive when paging")
+        d = self.backend.page(filter, limit, cursor or None, fields)
+
+        def got_page(page):
+            entries, next_cursor = page
+            envelope = {
+                "version": self.version,
+                "ids": [id for (id, _) in entries],
+                "next": next_cursor,
+            }
+            return self.codec.encode_results(
+                envelope, [result for (_, result) in entries], content_type
+            )
+
+        d.addCallback(got_page)
+        return d
+
+    @app.route("/benchmark-results/changes", methods=['GET'])
+    def changes(self, request):
+        """
+        Wait for the results stored after a position in the results feed.
+
+        The response is sent as soon as there are matching results stored
+        after the position given by the ``since`` argument, or after
+        ``timeout`` seconds with an empty list of results.  If ``since``
+        is omitted, only the results stored after the request are
+        returned.  The returned ``position`` should be passed as
+        ``since`` to the next request.
+        The results can be filtered by the branch name in the same way
+        as in ``query``.
+        Only the recent results are retained for the clients that are
+        catching up.  If some of those stored after ``since`` were
+        dropped, the response is sent immediately with ``truncated`` set,
+        and the client should query for the results it missed.
+
+        :param twisted.web.http.Request request: The request.
+        """
+        request.setHeader(b'content-type', b'application/json')
+        params = self._parse_changes_args(request.args)
+        if params['since'] is None:
+            params['since'] = self.feed.position
+        timeout = min(params['timeout'], self.max_changes_timeout)
+        truncated = self.feed.truncated(params['since'])
+        d = self.feed.wait(params['filter'], params['since'], timeout)
+
+        def got_changes(changes):
+            position, results = changes
+            result = {
+                "version": self.version,
+                "position": position,
+                "results": results,
+                "truncated": truncated,
+            }
+            return dumps(result)
+
+        d.addCallback(got_changes)
+        return d
+
+    @app.route("/benchmark-results/export", methods=['GET'])
+    @_admitted('export')
+    def export(self, request):
+        """
+        Export the stored benchmarking results as a stream, the latest
+        first.
+
+        The ``format`` argument selects the format: ``ndjson`` (the
+        default), ``csv`` or ``columnar``, see ``benchmark.export``.
+        The results can be filtered and limited as in ``query``, and
+        restricted to the timestamps from ``start`` and before ``end``.
+        For NDJSON, the exported fields can be given as in ``query``.
+        For the other formats, the exported userdata fields can be given
+        as a comma separated list with the ``columns`` argument.
+
+        :param twisted.web.http.Request request: The request.
+        """
+        params = self._parse_export_args(request.args)
+        encoder = params.pop('encoder')
+        request.setHeader(b'content-type', encoder.content_type)
+        exporter = Exporter(
+            self.backend, request, encoder,
+            page_size=self.export_page_size, **params
+        )
+        return exporter.export()
+
+    @app.route("/benchmark-results/percentiles", methods=['GET'])
+    @_admitted('read')
+    def percentiles(self, request):
+        """
+        Get the approximate percentiles of the values of the results.
+
+        The percentiles are estimated from the sketches of the results of
+        every branch and day, within 1% of the true values.  The results
+        can be filtered by the branch name as in ``query`` and restricted
+        to the timestamps from ``start`` and before ``end``, which are
+        extended to whole days.  The ``q`` argument is a comma separated
+        list of the percentiles, between 0 and 100, by default
+        ``50,90,95,99``.  Results without a numeric value are not
+        counted, and deleted results are counted until the server is
+        restarted.
+
+        :param twisted.web.http.Request request: The request.
+        """
+        request.setHeader(b'content-type', b'application/json')
+        params = self._parse_percentiles_args(request.args)
+        sketch = self.sketches.sketch(
+            params['branch'], params['start'], params['end']
+        )
+        percentiles = dict(
+            ('{:g}'.format(p), sketch.quantile(p / 100.0))
+            for p in params['percentiles']
+        )
+        return dumps({
+            "version": self.version,
+            "count": sketch.count,
+            "percentiles": percentiles,
+        })
+
+    @app.route("/benchmark-results/regressions", methods=['GET'])
+    @_admitted('read')
+    def deviating_series(self, request):
+        """
+        List the series of the results whose latest values deviate from
+        their history.
+
+        The series are identified by the branch and the other userdata
+        fields the server is configured with, and their statistics are
+        updated as the results are stored.  A series deviates if the
+        z-score of its latest value reaches ``threshold``, 3 by default,
+        or its CUSUM reaches ``cusum``, 5 by default, once it has at least
+        ``min_count`` values, 10 by default.  The series can be filtered
+        by the branch name as in ``query``, and the most deviating series
+        are listed first.  Results without a numeric value are not
+        counted, and deleted results are counted until the server is
+        restarted.
+
+        :param twisted.web.http.Request request: The request.
+        """
+        request.setHeader(b'content-type', b'application/json')
+        params = self._parse_regressions_args(request.args)
+        series = []
+        for identity, stats in self.regressions.deviating(**params):
+            entry = stats.to_dict()
+            entry["series"] = identity
+            series.append(entry)
+        return dumps({"version": self.version, "series": series})
+
     @staticmethod
     def _parse_query_args(args):
-        def ensure_one_value(key, values):
-            if len(values) != 1:
-                raise BadRequest("'{}' should have one value".format(key))
-            return values[0]
-
-        limit = None
+        params = {'limit': None, 'fields': None}
         filter = {}
         for k, v in args.iteritems():
             if k == 'limit':
-                limit = ensure_one_value(k, v)
-                try:
-                    limit = int(limit)
-                    if limit < 0:
-                        raise BadRequest(
-                            "limit is not a non-negative integer: {}".
-                            format(limit)
-                        )
-                except ValueError:
-                    raise BadRequest(
-                        "limit is not an integer: '{}'".format(limit)
-                    )
+                params['limit'] = _parse_non_negative_integer(k, v)
             elif k == 'branch':
-                branch = ensure_one_value(k, v)
+                branch = _ensure_one_value(k, v)
                 filter['userdata'] = {'branch': branch}
+            elif k == 'cursor':
+                params['cursor'] = _ensure_one_value(k, v)
+            elif k == 'fields':
+                params['fields'] = _parse_fields(k, v)
+            elif k == 'latest':
+                params['key'] = _parse_userdata_field(k, v)
+            else:
+                raise BadRequest("unexpected query argument '{}'".format(k))
+        params['filter'] = filter
+        return params
+
+    @classmethod
+    def _parse_changes_args(cls, args):
+        args = dict(args)
+        since = None
+        timeout = cls.changes_timeout
+        if 'since' in args:
+            since = _parse_non_negative_integer('since', args.pop('since'))
+        if 'timeout' in args:
+            timeout = _parse_non_negative_integer(
+                'timeout', args.pop('timeout')
+            )
+        for k in ('limit', 'cursor', 'fields', 'latest'):
+            if k in args:
+                raise BadRequest("unexpected query argument '{}'".format(k))
+        params = cls._parse_query_args(args)
+        return {'filter': params['filter'], 'since': since, 'timeout': timeout}
+
+    @staticmethod
+    def _parse_percentiles_args(args):
+        params = {
+            'branch': None, 'start': None, 'end': None,
+            'percentiles': [50, 90, 95, 99],
+        }
+        for k, v in args.iteritems():
+            if k == 'branch':
+                params['branch'] = _ensure_one_value(k, v)
+            elif k in ('start', 'end'):
+                params[k] = _parse_timestamp(k, v)
+            elif k == 'q':
+                params['percentiles'] = _parse_percentiles(k, v)
             else:
                 raise BadRequest("unexpected query argument '{}'".format(k))
-        return {'filter': filter, 'limit': limit}
+        return params
+
+    @staticmethod
+    def _parse_regressions_args(args):
+        params = {}
+        for k, v in args.iteritems():
+            if k == 'branch':
+                params['branch'] = _ensure_one_value(k, v)
+            elif k == 'threshold':
+                params['threshold'] = _parse_positive_number(k, v)
+            elif k == 'cusum':
+                params['cusum_threshold'] = _parse_positive_number(k, v)
+            elif k == 'min_count':
+                params['min_count'] = _parse_non_negative_integer(k, v)
+            else:
+                raise BadRequest("unexpected query argument '{}'".format(k))
+        return params
+
+    @classmethod
+    def _parse_export_args(cls, args):
+        args = dict(args)
+        format = 'ndjson'
+        if 'format' in args:
+            format = _ensure_one_value('format', args.pop('format'))
+            if format not in ENCODERS:
+                raise BadRequest("unknown format '{}'".format(format))
+        params = {}
+        for k in ('start', 'end'):
+            if k in args:
+                params[k] = _parse_timestamp(k, args.pop(k))
+        columns = None
+        if 'columns' in args and format != 'ndjson':
+            columns = _parse_fields('columns', args.pop('columns'))
+            for column in columns:
+                if '.' in column:
+                    raise BadRequest(
+                        "columns has an invalid field: '{}'".format(column)
+                    )
+        for k in ('cursor', 'latest',
+                  'fields' if format != 'ndjson' else 'columns'):
+            if k in args:
+                raise BadRequest("unexpected query argument '{}'".format(k))
+        query_params = cls._parse_query_args(args)
+        if format == 'ndjson':
+            params['encoder'] = NDJSONEncoder(query_params['fields'])
+        else:
+            params['encoder'] = ENCODERS[format](columns)
+        params['filter'] = query_params['filter']
+        params['limit'] = query_params['limit']
+        return params
 
 
-def create_api_service(endpoint, backend):
+def _ensure_one_value(key, values):
+    """
+    Get the single value of a query argument.
+    """
+    if len(values) != 1:
+        raise BadRequest("'{}' should have one value".format(key))
+    return values[0]
+
+
+def _parse_timestamp(key, values):
+    """
+    Get the single value of a query argument as a naive timestamp in UTC.
+    """
+    value = _ensure_one_value(key, values)
+    try:
+        return to_utc(timestamp_parser.parse(value))
+    except (ValueError, OverflowError):
+        # Very long numbers overflow in the parser, and the timestamps
+        # near the end of the range may overflow once in UTC.
+        raise BadRequest("{} is not a timestamp: '{}'".format(key, value))
+
+
+def _parse_percentiles(key, values):
+    """
+    Get the single value of a query argument as a comma separated list of
+    percentiles.
+    """
+    value = _ensure_one_value(key, values)
+    try:
+        percentiles = map(float, value.split(','))
+    except ValueError:
+        percentiles = None
+    if not percentiles or not all(0 <= p <= 100 for p in percentiles):
+        raise BadRequest(
+            "{} is not a list of percentiles: '{}'".format(key, value)
+        )
+    return percentiles
+
+
+def _parse_userdata_field(key, values):
+    """
+    Get the single value of a query argument as the name of a userdata
+    field.
+    """
+    value = _ensure_one_value(key, values)
+    if not value or '.' in value or '$' in value:
+        raise BadRequest(
+            "{} is not a userdata field: '{}'".format(key, value)
+        )
+    return value
+
+
+def _parse_fields(key, values):
+    """
+    Get the single value of a query argument as a list of fields.
+    """
+    value = _ensure_one_value(key, values)
+    fields = value.split(',')
+    for field in fields:
+        if '$' in field or '' in field.split('.'):
+            raise BadRequest("{} has an invalid field: '{}'".format(
+                key, field
+            ))
+    return fields
+
+
+def _parse_positive_number(key, values):
+    """
+    Get the single value of a query argument as a positive number.
+    """
+    value = _ensure_one_value(key, values)
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if not number > 0 or number == float('inf'):
+        raise BadRequest(
+            "{} is not a positive number: '{}'".format(key, value)
+        )
+    return number
+
+
+def _parse_non_negative_integer(key, values):
+    """
+    Get the single value of a query argument as a non-negative integer.
+    """
+    value = _ensure_one_value(key, values)
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(
+            "{} is not an integer: '{}'".format(key, value)
+        )
+    if value < 0:
+        raise BadRequest(
+            "{} is not a non-negative integer: {}".format(key, value)
+        )
+    return value
+
+
+def create_api_service(endpoint, backend, admission=None,
+                       max_body_size=None, codec=None, sketches=None,
+                       dedup=None, content_keys=False, regressions=None):
     """
     Create a Twisted Service that serves the API on the given endpoint.
 
     :param endpoint: Twisted endpoint to listen on.
+    :param AdmissionControl admission: The admission control for the
+        requests.  By default the requests are not limited.
+    :param int max_body_size: The maximum size of a request body in bytes,
+        or None for no limit.
+    :param JSONCodec codec: The codec for the request and response bodies.
+    :param SketchIndex sketches: The sketches of the results.
+    :param dedup: The index of the keys of the submissions.
+    :param bool content_keys: Whether to key the submissions by their
+        content.
+    :param RegressionIndex regressions: The statistics of the series of
+        the results.
     :return: Service that will listen on the endpoint using HTTP API server.
     """
     api_root = Resource()
-    api = BenchmarkAPI_V1(backend)
+    api = BenchmarkAPI_V1(
+        backend, admission=admission, codec=codec, sketches=sketches,
+        dedup=dedup, content_keys=content_keys, regressions=regressions,
+    )
     api_root.putChild('v1', api.app.resource())
 
-    return StreamServerEndpointService(endpoint, Site(api_root))
+    site = LimitedSite(api_root, max_body_size=max_body_size)
+    return StreamServerEndpointService(endpoint, site)
 
 
 class BackendService(Service):
@@ -407,12 +2206,32 @@ class BackendService(Service):
         return self.backend.disconnect()
 
 
-def start_services(reactor, endpoint, backend):
+def start_services(reactor, endpoint, backend, admission=None,
+                   max_body_size=None, codec=None, dedup=None,
+                   content_keys=False, regressions=None,
+                   cache_stats_interval=None):
     top_service = MultiService()
-    api_service = create_api_service(endpoint, backend)
+    sketches = SketchIndex()
+    if regressions is None:
+        regressions = RegressionIndex()
+    api_service = create_api_service(
+        endpoint, backend, admission, max_body_size, codec, sketches, dedup,
+        content_keys, regressions,
+    )
     api_service.setServiceParent(top_service)
     backend_service = BackendService(backend)
     backend_service.setServiceParent(top_service)
+    sketch_service = SketchService(sketches, backend)
+    sketch_service.setServiceParent(top_service)
+    regression_service = RegressionService(regressions, backend)
+    regression_service.setServiceParent(top_service)
+    cache = getattr(backend, 'cache', None)
+    if cache is not None and cache_stats_interval:
+        stats_service = TimerService(
+            cache_stats_interval, lambda: msg(cache.describe())
+        )
+        stats_service.clock = reactor
+        stats_service.setServiceParent(top_service)
 
     # XXX Setting _raiseSynchronously makes startService raise an exception
     # on error rather than just logging and dropping it.
@@ -426,36 +2245,164 @@ def start_services(reactor, endpoint, backend):
     )
 
 
-class ServerOptions(Options):
-    longdesc = "Run the benchmark results server"
+# The built-in backends, as the entry points that they are also
+# registered as.  Their modules are imported only when they are selected.
+BACKENDS = {
+    'in-memory': 'benchmark.httpapi:InMemoryBackend',
+    'sharded-in-memory': 'benchmark.httpapi:ShardedInMemoryBackend',
+    'mongodb': 'benchmark.mongo:TxMongoBackend',
+    'routing': 'benchmark.httpapi:RoutingBackend',
+}
+
+# The backends that keep the results in the memory of the process that
+# loads them.
+in_process_backends = frozenset(['in-memory', 'sharded-in-memory'])
+
+
+def load_backend(name):
+    """
+    Import the class of a backend.
+
+    The built-in backends are looked up directly, and the other backends
+    through the ``benchmark.backends`` entry points of the installed
+    distributions, so that their modules are not imported unless the
+    backend is used.
+
+    :param str name: The name of the backend.
+    :raises KeyError: If there is no backend with the name.
+    :return: The class of the backend.
+    """
+    path = BACKENDS.get(name)
+    if path is None:
+        # Scanning the installed distributions takes a while, so it is
+        # only done for backends that are not built in.
+        from pkg_resources import iter_entry_points
+        for entry_point in iter_entry_points('benchmark.backends', name):
+            return entry_point.load()
+        raise KeyError(name)
+    module, _, attribute = path.partition(':')
+    return getattr(import_module(module), attribute)
+
+
+class BackendOptions(Options):
+    """
+    The options that select and configure the persistence backend.
 
-    _BACKENDS = {
-        'in-memory': InMemoryBackend,
-        'mongodb': TxMongoBackend,
-    }
+    After parsing, ``self['backend']`` is the backend.
+    """
 
     optParameters = [
-        ['port', None, 8888, "The port to listen on", int],
         ['backend', None, 'in-memory', "The persistence backend to use. "
-         "One of {}.".format(', '.join(_BACKENDS)), str],
+         "One of {}, or a backend registered as a benchmark.backends "
+         "entry point.".format(', '.join(sorted(BACKENDS))), str],
         ['db-hostname', None, None, "The hostname of the database", str],
         ['db-port', None, None, "The port of the database", str],
+        ['cache-size', None, 64 * 1024 * 1024,
+         "The maximum size in bytes of the results cached by the mongodb "
+         "backend, 0 to disable the cache", int],
+        ['shard-count', None, 16,
+         "The number of shards of the sharded-in-memory backend", int],
+        ['shard-key', None, 'branch',
+         "The userdata field to partition the results of the "
+         "sharded-in-memory backend by", str],
+        ['latest-keys', None, 8,
+         "The maximum number of the userdata fields whose latest results "
+         "the in-memory backends index, 0 to scan the results instead",
+         int],
+        ['nodes', None, None,
+         "The comma separated downstream servers of the routing backend, "
+         "each given as name=url, where url is the root of the API, "
+         "e.g. a=http://127.0.0.1:8888/v1", str],
     ]
 
     def postOptions(self):
+        name = self['backend']
         try:
-            backend = self._BACKENDS[self['backend']]
+            backend = load_backend(name)
         except KeyError:
-            raise UsageError("Unknown backend {}".format(self['backend']))
+            raise UsageError("Unknown backend {}".format(name))
 
         conn = dict()
         if self['db-hostname']:
             conn['hostname'] = self['db-hostname']
         if self['db-port']:
             conn['port'] = self['db-port']
+        if name == 'mongodb':
+            conn['cache_size'] = self['cache-size']
+        if name in in_process_backends:
+            conn['latest_keys'] = self['latest-keys']
+        if name == 'sharded-in-memory':
+            conn['shards'] = self['shard-count']
+            conn['key'] = self['shard-key']
+        if name == 'routing':
+            conn = {'backends': self._parse_nodes(self['nodes'])}
 
         self['backend'] = backend(**conn)
 
+    @staticmethod
+    def _parse_nodes(nodes):
+        if not nodes:
+            raise UsageError("The routing backend requires --nodes")
+        backends = {}
+        for node in nodes.split(','):
+            name, separator, url = node.partition('=')
+            if not separator or not name or not url or '-' in name:
+                raise UsageError("Invalid node {}".format(node))
+            backends[name] = HTTPBackend(url)
+        return backends
+
+
+class ServerOptions(BackendOptions):
+    longdesc = "Run the benchmark results server"
+
+    optParameters = [
+        ['port', None, 8888, "The port to listen on", int],
+        ['max-concurrent-reads', None, None,
+         "The maximum number of read requests processed concurrently",
+         int],
+        ['max-concurrent-writes', None, None,
+         "The maximum number of write requests processed concurrently",
+         int],
+        ['max-concurrent-exports', None, None,
+         "The maximum number of exports processed concurrently", int],
+        ['max-queued', None, 100,
+         "The maximum number of requests of each kind waiting to be "
+         "processed when the concurrency limit is reached", int],
+        ['request-timeout', None, None,
+         "The number of seconds after which the processing of a request "
+         "is abandoned, except for exports", float],
+        ['max-body-size', None, None,
+         "The maximum size of a request body in bytes", int],
+        ['offload-size', None, 64 * 1024,
+         "The size in bytes of a request body from which it is decoded "
+         "in a worker thread", int],
+        ['offload-count', None, 100,
+         "The number of results in a response from which they are "
+         "encoded in a worker thread", int],
+        ['dedup-expiry', None, 24 * 60 * 60,
+         "The number of seconds the idempotency keys of the submissions "
+         "are kept for", int],
+        ['dedup-size', None, 100000,
+         "The maximum number of the idempotency keys kept in the memory",
+         int],
+        ['series-fields', None, 'branch',
+         "The comma separated userdata fields that identify a series of "
+         "the results for the regression detection", str],
+        ['cache-stats-interval', None, 60,
+         "The number of seconds between the reports of the use of the "
+         "result cache of the backend in the log, 0 not to report it",
+         float],
+        ['restore', None, None,
+         "A backup archive whose results are loaded into the backend "
+         "before the server starts listening", str],
+    ]
+
+    optFlags = [
+        ['dedup-content', None,
+         "Key the submissions without an idempotency key by their "
+         "content, so that identical submissions are stored once"],
+    ]
+
 
 def main(reactor, args):
     try:
@@ -470,14 +2417,65 @@ def main(reactor, args):
         raise SystemExit(1)
 
     startLogging(sys.stderr)
+    msg("Running on {}".format(type(reactor).__name__))
 
     endpoint = TCP4ServerEndpoint(reactor, options['port'])
     backend = options['backend']
-    start_services(reactor, endpoint, backend)
+    concurrency = {}
+    if options['max-concurrent-reads'] is not None:
+        concurrency['read'] = options['max-concurrent-reads']
+    if options['max-concurrent-writes'] is not None:
+        concurrency['write'] = options['max-concurrent-writes']
+    if options['max-concurrent-exports'] is not None:
+        concurrency['export'] = options['max-concurrent-exports']
+    admission = AdmissionControl(
+        reactor,
+        concurrency=concurrency,
+        queue_size=options['max-queued'],
+        timeout=options['request-timeout'],
+        # Exports take as long as the clients take to read them.
+        timeouts={'export': None},
+    )
+    codec = JSONCodec(
+        reactor,
+        size_threshold=options['offload-size'],
+        count_threshold=options['offload-count'],
+    )
+    if hasattr(backend, 'dedup_index'):
+        # Keep the keys with the results, so that they are shared by all
+        # the servers and survive restarts.
+        dedup = backend.dedup_index(options['dedup-expiry'])
+    else:
+        dedup = DedupIndex(
+            reactor,
+            expiry=options['dedup-expiry'],
+            max_size=options['dedup-size'],
+        )
+    regressions = RegressionIndex(options['series-fields'].split(','))
+    if options['restore'] is not None:
+        # Imported here, as the backup module imports this one.
+        from .backup import restore_archive
+        d = restore_archive(backend, options['restore'])
+        d.addCallback(lambda count: msg("Restored {} results".format(count)))
+    else:
+        d = succeed(None)
+
+    def start(_):
+        start_services(
+            reactor, endpoint, backend, admission, options['max-body-size'],
+            codec, dedup, options['dedup-content'], regressions,
+            options['cache-stats-interval'],
+        )
+        # Do not quit until the reactor is stopped.
+        return Deferred()
 
-    # Do not quit until the reactor is stopped.
-    return Deferred()
+    d.addCallback(start)
+    return d
 
 
 if __name__ == '__main__':
-    react(main, (sys.argv[1:],))
+    # The backends loaded by name import this module by its name, so run
+    # the main function of that module rather than of this script, lest
+    # the API and the backends use two copies of the classes.
+    from benchmark import httpapi
+    react(httpapi.main, (sys.argv[1:],))
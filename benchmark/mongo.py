@@ -0,0 +1,473 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+The MongoDB backend, using the txmongo driver.
+
+The backend is imported only when selected, so that the servers using the
+other backends do not load the driver.
+"""
+
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from twisted.internet.defer import fail, succeed
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from bson.son import SON
+
+from dateutil import parser as timestamp_parser
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from txmongo import MongoConnectionPool
+from txmongo.filter import ASCENDING, DESCENDING, sort as orderby
+
+from zope.interface import implementer
+
+from ._backend import BadRequest, BadResultId, ResultNotFound, _project
+from ._interfaces import IBackend
+from .cache import ResultCache
+from .dedup import InProgress, KeyReused
+
+# The code of the write errors of the documents with existing identifiers.
+DUPLICATE_KEY = 11000
+
+
+@implementer(IBackend)
+class TxMongoBackend(object):
+    """
+    The backend that uses txmongo driver to work with MongoDB.
+
+    The results are never modified once stored, so the retrieved results
+    are cached.  The cache holds copies of the results, and the callers
+    get copies of the cached results, so that neither the callers nor the
+    cache share the subdocuments that the callers may modify.
+
+    :ivar ResultCache cache: The cache of the results, or None.
+    """
+    def __init__(self, hostname="127.0.0.1", port=27017, cache_size=0):
+        """
+        :param int cache_size: The maximum size in bytes of the cached
+            results.  The results are not cached if it is 0.
+        """
+        connection = MongoConnectionPool(host=hostname, port=port)
+        self.collection = connection.benchmark.results
+        self.cache = None
+        if cache_size:
+            self.cache = ResultCache(cache_size)
+
+    def disconnect(self):
+        return self.collection.database.connection.disconnect()
+
+    def store(self, result):
+        """
+        Store a single benchmarking result and return its identifier.
+
+        :param dict result: The result in the JSON compatible format.
+        :return: A Deferred that produces an identifier for the stored
+            result.
+        """
+        def to_str(inserted):
+            id = str(inserted.inserted_id)
+            if self.cache is not None:
+                self.cache.put(id, deepcopy(result))
+            return id
+
+        id = self.collection.insert_one(self._to_document(result))
+        id.addCallback(to_str)
+        return id
+
+    def store_many(self, results):
+        """
+        Store several benchmarking results and return their identifiers.
+
+        :param list results: The results in the JSON compatible format.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        def to_str(inserted):
+            ids = map(str, inserted.inserted_ids)
+            if self.cache is not None:
+                for id, result in zip(ids, results):
+                    self.cache.put(id, deepcopy(result))
+            return ids
+
+        documents = [self._to_document(result) for result in results]
+        ids = self.collection.insert_many(documents)
+        ids.addCallback(to_str)
+        return ids
+
+    def load(self, entries, batch_size=1000):
+        """
+        Store results in bulk, keeping the identifiers they were dumped
+        with.
+
+        The results are inserted in unordered batches, which the database
+        does not have to apply one by one, and the index that the results
+        are paged by is built afterwards, rather than updated with every
+        result.  The results are not cached.
+
+        :param list entries: The ``(id, result)`` pairs.
+        :param int batch_size: The number of the results to insert at
+            once, so that the commands stay within the size limit.
+        :return: A Deferred that produces a list of the identifiers.
+        """
+        documents = []
+        for id, result in entries:
+            document = self._to_document(result)
+            if id is not None and ObjectId.is_valid(id):
+                document['_id'] = ObjectId(id)
+            else:
+                document['_id'] = ObjectId()
+            documents.append(document)
+
+        def ignore_duplicates(failure):
+            # The results already stored under their identifiers are
+            # reported as duplicate keys after the others are inserted.
+            failure.trap(BulkWriteError)
+            errors = failure.value.details.get('writeErrors', [])
+            if any(error.get('code') != DUPLICATE_KEY for error in errors):
+                return failure
+
+        def insert(start):
+            if start >= len(documents):
+                return self.collection.create_index(
+                    orderby(DESCENDING(['sort$timestamp', '_id']))
+                )
+            d = self.collection.insert_many(
+                documents[start:start + batch_size], ordered=False
+            )
+            d.addErrback(ignore_duplicates)
+            d.addCallback(lambda _: insert(start + batch_size))
+            return d
+
+        d = insert(0)
+        d.addCallback(
+            lambda _: [str(document['_id']) for document in documents]
+        )
+        return d
+
+    @staticmethod
+    def _to_document(result):
+        """
+        Make the document to store for a result.
+        """
+        # Store the timestamp field as a special hidden datetime field
+        # for sorting.  The document is copied, so that neither that field
+        # nor the '_id' field added by the driver leak to the caller.
+        document = dict(result)
+        document['sort$timestamp'] = timestamp_parser.parse(
+            result['timestamp']
+        )
+        return document
+
+    @staticmethod
+    def _projection(fields):
+        """
+        Make the MongoDB projection for the fields of the results.
+
+        The '_id' and 'sort$timestamp' fields are not included as these
+        are not part of the original document.
+        If we later choose to include '_id', its type is 'ObjectId'
+        which can not be serialized to JSON. Either a custom
+        JSONEncoder or bson.json_util.dumps would be needed.
+        """
+        if fields is None:
+            return {'_id': False, 'sort$timestamp': False}
+        projection = dict.fromkeys(fields, True)
+        projection['_id'] = False
+        return projection
+
+    def retrieve(self, id, fields=None):
+        """
+        Retrive a result by the given identifier.
+
+        Only the whole results are added to the cache, the requested
+        fields of a cached result are taken from it.
+        """
+        try:
+            object_id = ObjectId(id)
+        except InvalidId:
+            raise BadResultId(id)
+
+        cache = self.cache
+        if cache is not None:
+            key = str(object_id)
+            cached = cache.get(key)
+            if cached is not None:
+                # The callers may modify the result they get.
+                return succeed(deepcopy(_project(cached, fields)))
+            generation = cache.generation
+
+        def post_process(result):
+            if result is None:
+                raise ResultNotFound(id)
+            if cache is not None and fields is None:
+                cache.put(key, deepcopy(result), generation)
+            return result
+
+        d = self.collection.find_one(
+            {'_id': object_id}, fields=self._projection(fields)
+        )
+        d.addCallback(post_process)
+        return d
+
+    def query(self, filter, limit=None, fields=None):
+        """
+        Return matching results.
+        """
+        if limit == 0:
+            return succeed([])
+
+        # The txmongo API differs from pymongo with regard to sorting.
+        # To sort results when making a query using txmongo, a query
+        # filter needs to be created and passed to collection.find().
+        sort_filter = orderby(DESCENDING('sort$timestamp'))
+
+        find_args = dict(
+            filter=sort_filter, fields=self._projection(fields)
+        )
+        if limit:
+            find_args['limit'] = limit
+
+        return self.collection.find(filter, **find_args)
+
+    def latest(self, filter, key, limit=None, fields=None):
+        """
+        Return the latest matching result for every value of a userdata
+        field.
+
+        The results are sorted and grouped by the database, which returns
+        only the latest result of every group.
+        """
+        if limit == 0:
+            return succeed([])
+        field = 'userdata.' + key
+        spec = dict(filter)
+        spec[field] = {'$exists': True}
+        order = SON([('sort$timestamp', -1), ('_id', -1)])
+        pipeline = [
+            {'$match': spec},
+            {'$sort': order},
+            {'$group': {'_id': '$' + field, 'latest': {'$first': '$$ROOT'}}},
+            {'$sort': SON(
+                ('latest.' + name, direction)
+                for name, direction in order.items()
+            )},
+        ]
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+
+        def got_groups(groups):
+            results = []
+            for group in groups:
+                result = group['latest']
+                del result['_id'], result['sort$timestamp']
+                results.append(_project(result, fields))
+            return results
+
+        d = self.collection.aggregate(pipeline, allowDiskUse=True)
+        d.addCallback(got_groups)
+        return d
+
+    def page(self, filter, limit=None, cursor=None, fields=None):
+        """
+        Return a page of matching results.
+
+        The results are ordered by the timestamp and then by the
+        identifier.  The cursor holds both of them for the last result of
+        the previous page, so the next page starts right after it instead
+        of skipping over the preceding results.
+        """
+        spec = dict(filter)
+        if cursor is not None:
+            timestamp, _, id = cursor.partition('_')
+            try:
+                timestamp = timestamp_parser.parse(timestamp)
+                object_id = ObjectId(id)
+            except (ValueError, InvalidId):
+                return fail(BadRequest("Invalid cursor {}".format(cursor)))
+            spec['$or'] = [
+                {'sort$timestamp': {'$lt': timestamp}},
+                {'sort$timestamp': timestamp, '_id': {'$lt': object_id}},
+            ]
+
+        find_args = dict(
+            filter=orderby(DESCENDING(['sort$timestamp', '_id']))
+        )
+        if fields is not None:
+            # The identifier and the timestamp are needed for the cursor.
+            # The identifier is included unless it is excluded.
+            find_args['fields'] = dict.fromkeys(fields, True)
+            find_args['fields']['sort$timestamp'] = True
+        if limit is not None:
+            # Fetch one more result to find out if there is a next page.
+            find_args['limit'] = limit + 1
+
+        def got_documents(documents):
+            next_cursor = None
+            if limit is not None and len(documents) > limit:
+                del documents[limit:]
+                last = documents[-1]
+                next_cursor = '{}_{}'.format(
+                    last['sort$timestamp'].isoformat(), last['_id']
+                )
+            entries = []
+            for document in documents:
+                del document['sort$timestamp']
+                entries.append((str(document.pop('_id')), document))
+            return entries, next_cursor
+
+        d = self.collection.find(spec, **find_args)
+        d.addCallback(got_documents)
+        return d
+
+    def cursor_before(self, timestamp):
+        """
+        Make a cursor for the page of the results before a timestamp, as
+        ``InMemoryBackend.cursor_before`` does.  No identifier is less
+        than the one of zeros, so the results at the timestamp are left
+        out.
+        """
+        return '{}_{}'.format(timestamp.isoformat(), '0' * 24)
+
+    def delete(self, id):
+        """
+        Delete a result by the given identifier.
+        """
+        try:
+            object_id = ObjectId(id)
+        except InvalidId:
+            raise BadResultId(id)
+
+        def invalidate(passthrough):
+            # Results read while the delete is in progress are not cached
+            # either.
+            if self.cache is not None:
+                self.cache.invalidate(str(object_id))
+            return passthrough
+
+        def handle_result(result):
+            if result.deleted_count == 0:
+                raise ResultNotFound(id)
+            return None
+
+        invalidate(None)
+        d = self.collection.delete_one({'_id': object_id})
+        d.addBoth(invalidate)
+        d.addCallback(handle_result)
+        return d
+
+    def dedup_index(self, expiry):
+        """
+        Make an index of the submission keys kept in the database of the
+        results, so that it is shared by all the servers using it.
+
+        :param int expiry: The number of seconds a key is kept for.
+        :return: A ``TxMongoDedupIndex``.
+        """
+        return TxMongoDedupIndex(
+            self.collection.database.idempotency_keys, expiry
+        )
+
+
+class TxMongoDedupIndex(object):
+    """
+    An index of the submission keys kept in a MongoDB collection, like
+    ``benchmark.dedup.DedupIndex``.
+
+    The keys are the unique identifiers of the documents, so the index is
+    shared by all the servers using the database and survives their
+    restarts.  The keys are removed by a TTL index, within a minute or so
+    of their expiry.
+
+    A key is claimed for a lease, which a later submission takes over once
+    it has run out, so that a server stopping before it completes or
+    releases a key does not hold the key until it expires.  The lease has
+    to be longer than the submissions take, lest they be stored twice.
+    """
+    def __init__(self, collection, expiry=24 * 60 * 60, lease=5 * 60):
+        """
+        :param collection: The txmongo collection of the keys.
+        :param int expiry: The number of seconds a key is kept for.
+        :param int lease: The number of seconds a key is claimed for.
+        """
+        self.collection = collection
+        self.expiry = expiry
+        self.lease = lease
+        self._indexed = False
+
+    def _ensure_index(self):
+        if self._indexed:
+            return succeed(None)
+        d = self.collection.create_index(
+            orderby(ASCENDING('created')), expireAfterSeconds=self.expiry
+        )
+        d.addCallback(lambda _: setattr(self, '_indexed', True))
+        return d
+
+    def claim(self, key, fingerprint):
+        """
+        Claim a key for a submission, see ``DedupIndex.claim``.
+
+        A key whose submission has not completed within its lease is
+        claimed again.
+        """
+        now = datetime.utcnow()
+        leased = now + timedelta(seconds=self.lease)
+
+        def existing(failure):
+            failure.trap(DuplicateKeyError)
+            d = self.collection.find_one({'_id': key})
+            d.addCallback(check)
+            return d
+
+        def check(document):
+            # The key may just have expired.
+            if not document:
+                raise InProgress(key)
+            if document['fingerprint'] != fingerprint:
+                raise KeyReused(key)
+            if 'value' in document:
+                return document['value']
+            if document['leased'] > now:
+                raise InProgress(key)
+            # Take the lease over, unless another submission has taken it
+            # or the submission has completed in the meantime.
+            d = self.collection.update_one(
+                {'_id': key, 'leased': document['leased'],
+                 'value': {'$exists': False}},
+                {'$set': {'leased': leased}},
+            )
+            d.addCallback(taken_over)
+            return d
+
+        def taken_over(result):
+            if result.modified_count == 0:
+                raise InProgress(key)
+            return None
+
+        d = self._ensure_index()
+        d.addCallback(lambda _: self.collection.insert_one({
+            '_id': key, 'fingerprint': fingerprint, 'created': now,
+            'leased': leased,
+        }))
+        d.addCallbacks(lambda _: None, existing)
+        return d
+
+    def complete(self, key, value):
+        """
+        Record the value of a claimed key, see ``DedupIndex.complete``.
+        """
+        d = self.collection.update_one(
+            {'_id': key}, {'$set': {'value': value}}
+        )
+        d.addCallback(lambda _: None)
+        return d
+
+    def release(self, key):
+        """
+        Give up a claimed key, see ``DedupIndex.release``.
+        """
+        d = self.collection.delete_one({'_id': key})
+        d.addCallback(lambda _: None)
+        return d
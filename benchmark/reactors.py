@@ -0,0 +1,88 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Run the commands on a chosen reactor.
+
+A reactor has to be installed before the global reactor is imported,
+and the commands import it with ``twisted.web``.  So the commands are
+launched through this module, which installs the reactor before it
+imports them::
+
+    python -m benchmark.reactors --reactor epoll benchmark.httpapi \\
+        --port 8888
+
+The reactors are those that Twisted can install on the platform, e.g.
+``epoll``, ``poll`` and ``select`` on Linux, and ``asyncio`` with the
+versions of Twisted that run on an asyncio event loop.  The commands are
+run on the default reactor for the platform if none is chosen.
+"""
+
+import sys
+from importlib import import_module
+
+from twisted.application.reactors import getReactorTypes, installReactor
+from twisted.internet.task import react
+from twisted.python.usage import Options, UsageError
+
+
+def reactor_names():
+    """
+    Get the names of the reactors known to Twisted, including those that
+    can not be installed on the platform.
+    """
+    return sorted(reactor.shortName for reactor in getReactorTypes())
+
+
+class ReactorOptions(Options):
+    synopsis = "[--reactor=<name>] <module> [<argument>...]"
+    longdesc = (
+        "Run the main function of a module, e.g. benchmark.httpapi, with "
+        "the arguments that follow it, on the chosen reactor"
+    )
+
+    optParameters = [
+        ['reactor', None, None, "The reactor to run on, e.g. epoll, poll, "
+         "select or asyncio, the default one for the platform by default",
+         str],
+    ]
+
+    def parseArgs(self, module, *args):
+        self['module'] = module
+        self['args'] = list(args)
+
+    def postOptions(self):
+        name = self['reactor']
+        if name is not None and name not in reactor_names():
+            raise UsageError(
+                "Unknown reactor {}, choose one of {}".format(
+                    name, ', '.join(reactor_names())
+                )
+            )
+
+
+def main(args):
+    try:
+        options = ReactorOptions()
+        options.parseOptions(args)
+        if options['reactor'] is not None:
+            try:
+                installReactor(options['reactor'])
+            except ImportError as e:
+                raise UsageError(
+                    "The reactor {} is not available: {}".format(
+                        options['reactor'], e
+                    )
+                )
+    except UsageError as e:
+        sys.stderr.write(e.args[0])
+        sys.stderr.write('\n\n')
+        sys.stderr.write(options.getSynopsis())
+        sys.stderr.write('\n')
+        sys.stderr.write(options.getUsage())
+        raise SystemExit(1)
+
+    command = import_module(options['module'])
+    react(command.main, (options['args'],))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
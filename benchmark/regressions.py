@@ -0,0 +1,388 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Detection of the regressions as the results are stored.
+
+The results are grouped into series by the userdata fields that identify
+what was measured, the branch by default.  Every series keeps running
+statistics of its values that are updated in constant time as each
+result is stored, so the series whose latest values deviate from their
+history are found without reading any results.
+
+The values of every series are taken in the order of the timestamps of
+the results, both as the results are stored and when the statistics are
+rebuilt from the backend.  A result stored after a later one of its
+series counts towards the mean and the deviation, which do not depend on
+the order, and takes its place in the other statistics the next time they
+are rebuilt.
+"""
+
+from json import dumps
+from math import sqrt
+
+from twisted.internet.defer import Deferred
+
+from dateutil import parser as timestamp_parser
+
+from ._indexes import RebuildService, is_finite, read_pages, value_of
+from .export import to_utc
+
+
+class SeriesStats(object):
+    """
+    Running statistics of the values of a series, in the order they were
+    added.
+
+    The mean and the variance are updated with Welford's algorithm.  The
+    deviation of every value is its z-score against the values before it,
+    and the deviations are accumulated by a two-sided CUSUM, which keeps
+    growing while the values deviate in the same direction and so detects
+    shifts too small to stand out in any single value.
+
+    :ivar int count: The number of the values.
+    :ivar float mean: The mean of the values.
+    :ivar float ewma: The exponentially weighted moving average of the
+        values.
+    :ivar latest: The latest value.
+    :ivar timestamp: The timestamp of the latest value.
+    :ivar zscore: The z-score of the latest value against the values
+        before it, or None if they do not vary.
+    """
+    def __init__(self, alpha=0.1, allowance=0.5):
+        """
+        :param float alpha: The weight of the latest value in the moving
+            average.
+        :param float allowance: The deviation in standard deviations that
+            the CUSUM tolerates in every value.
+        """
+        self.alpha = alpha
+        self.allowance = allowance
+        self.count = 0
+        self.mean = 0.0
+        self.ewma = None
+        self.latest = None
+        self.timestamp = None
+        self.zscore = None
+        self._m2 = 0.0
+        self._high = 0.0
+        self._low = 0.0
+
+    @property
+    def variance(self):
+        """
+        The sample variance of the values, or None if there are fewer than
+        two of them.
+        """
+        if self.count < 2:
+            return None
+        return self._m2 / (self.count - 1)
+
+    @property
+    def stddev(self):
+        """
+        The sample standard deviation of the values, or None.
+        """
+        variance = self.variance
+        if variance is None:
+            return None
+        return sqrt(variance)
+
+    @property
+    def cusum(self):
+        """
+        The larger of the cumulative sums of the deviations above and
+        below the mean, negative if it is the one below.
+        """
+        if self._low > self._high:
+            return -self._low
+        return self._high
+
+    def add(self, value, timestamp=None):
+        """
+        Add a value.  Infinite and NaN values are ignored, since a single
+        one would make all the statistics infinite or NaN for good.
+        """
+        if not is_finite(value):
+            return
+        stddev = self.stddev
+        if stddev:
+            self.zscore = (value - self.mean) / stddev
+            self._high = max(0.0, self._high + self.zscore - self.allowance)
+            self._low = max(0.0, self._low - self.zscore - self.allowance)
+        else:
+            self.zscore = None
+        self._add_moments(value)
+        if self.ewma is None:
+            self.ewma = float(value)
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+        self.latest = value
+        self.timestamp = timestamp
+
+    def add_earlier(self, value):
+        """
+        Add a value that comes before the latest one.  It counts towards
+        the mean and the variance, which do not depend on the order of the
+        values, but not towards the statistics of the latest values.
+        """
+        if is_finite(value):
+            self._add_moments(value)
+
+    def _add_moments(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self._m2 += delta * (value - self.mean)
+
+    def to_dict(self):
+        """
+        Get the statistics in the JSON compatible format.
+        """
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stddev": self.stddev,
+            "ewma": self.ewma,
+            "latest": self.latest,
+            "timestamp": self.timestamp,
+            "zscore": self.zscore,
+            "cusum": self.cusum,
+        }
+
+
+class RegressionIndex(object):
+    """
+    The running statistics of every series of the results.
+
+    The statistics are updated as results are stored through ``add``.
+    Deleted results stay in the statistics until they are rebuilt from
+    the backend with ``rebuild``.  The values of every series are taken in
+    the order of the timestamps of the results.
+    """
+    def __init__(self, fields=('branch',), alpha=0.1, allowance=0.5):
+        """
+        :param fields: The userdata fields that identify a series.
+        :param float alpha: See ``SeriesStats``.
+        :param float allowance: See ``SeriesStats``.
+        """
+        self.fields = tuple(fields)
+        self.alpha = alpha
+        self.allowance = allowance
+        # The values of the identifying fields, the statistics and the
+        # timestamp in UTC of the latest value, by the JSON encoding of the
+        # values.
+        self._series = {}
+        # The results added while rebuilding.
+        self._added = None
+
+    def _identify(self, result):
+        """
+        Find the series of a result.
+
+        :return: The values of the identifying fields of the result, the
+            missing fields left out, and their JSON encoding.
+        """
+        userdata = result.get('userdata')
+        if not isinstance(userdata, dict):
+            userdata = {}
+        identity = dict(
+            (field, userdata[field]) for field in self.fields
+            if field in userdata
+        )
+        return identity, dumps(identity, sort_keys=True)
+
+    def _values_of(self, result):
+        """
+        Get what is added to the statistics for a result.
+
+        :return: The values of the identifying fields of the result, their
+            JSON encoding, the value, the timestamp and the timestamp in
+            UTC, or None if the result has no numeric value.
+        """
+        value = value_of(result)
+        if value is None:
+            return None
+        identity, key = self._identify(result)
+        timestamp = result.get('timestamp')
+        try:
+            when = to_utc(timestamp_parser.parse(timestamp))
+        except (ValueError, TypeError, AttributeError, OverflowError):
+            when = None
+        return identity, key, value, timestamp, when
+
+    def _add_to(self, series, identity, key, value, timestamp, when):
+        entry = series.get(key)
+        if entry is None:
+            entry = series[key] = [
+                identity, SeriesStats(self.alpha, self.allowance), None
+            ]
+        if when is not None and entry[2] is not None and when < entry[2]:
+            entry[1].add_earlier(value)
+            return
+        entry[1].add(value, timestamp)
+        entry[2] = when
+
+    def add(self, id, result):
+        """
+        Add a stored result.  Results without a numeric value are ignored.
+
+        :param str id: The identifier of the result.
+        :param dict result: The result in the JSON compatible format.
+        """
+        values = self._values_of(result)
+        if values is None:
+            return
+        self._add_to(self._series, *values)
+        if self._added is not None:
+            self._added.append((id, values))
+
+    def series(self, branch=None):
+        """
+        Get the statistics of the series.
+
+        :param branch: The branch of the series, or None for all of them.
+        :return: A list of the values of the identifying fields and the
+            ``SeriesStats`` of every series.
+        """
+        return [
+            (identity, stats) for identity, stats, _ in self._series.values()
+            if branch is None or identity.get('branch') == branch
+        ]
+
+    def deviating(self, branch=None, threshold=3.0, cusum_threshold=5.0,
+                  min_count=10):
+        """
+        Find the series whose latest values deviate from their history.
+
+        :param branch: The branch of the series, or None for all of them.
+        :param float threshold: The z-score of the latest value from which
+            a series deviates.
+        :param float cusum_threshold: The CUSUM from which a series
+            deviates.
+        :param int min_count: The number of the values a series needs to
+            be judged.
+        :return: A list like the one of ``series``, the most deviating
+            series first.
+        """
+        def severity(entry):
+            stats = entry[1]
+            return max(
+                abs(stats.zscore or 0) / threshold,
+                abs(stats.cusum) / cusum_threshold,
+            )
+
+        deviating = [
+            entry for entry in self.series(branch)
+            if entry[1].count >= min_count and severity(entry) >= 1
+        ]
+        deviating.sort(key=severity, reverse=True)
+        return deviating
+
+    def rebuild(self, backend, page_size=1000):
+        """
+        Rebuild the statistics from all the results in a backend.
+
+        The backend returns the results from the latest to the oldest, but
+        they have to be added from the oldest.  So the results are read
+        twice: first to find where every page starts, and then a page at a
+        time from the oldest page, whose results are added in reverse.
+        Only the bounds of the pages and the results of one page are held
+        at once.  The current statistics keep being used until the rebuild
+        finishes.
+
+        :param IBackend backend: The backend.
+        :param int page_size: The number of the results to read at once.
+        :return: A Deferred that fires when the statistics are rebuilt.
+        """
+        self._added = []
+        series = {}
+        # The cursor that every page is read from, and the identifiers of
+        # its latest and oldest results.
+        pages = []
+        cursors = [None]
+        done = Deferred()
+
+        def got_bounds(entries, cursor):
+            if entries:
+                pages.append((cursors[-1], entries[0][0], entries[-1][0]))
+                cursors.append(cursor)
+            return cursor
+
+        def got_bounds_read(_):
+            replay(len(pages) - 1)
+
+        def read_page(number):
+            # Read the results of a page again, up to its oldest result or
+            # the latest result of the next page, as other results may have
+            # been stored or deleted in the meantime.
+            cursor, _, last = pages[number]
+            stop = None
+            if number + 1 < len(pages):
+                stop = pages[number + 1][1]
+            entries = []
+
+            def got_page(page, cursor):
+                added = set(id for id, _ in self._added)
+                for id, result in page:
+                    if id == stop:
+                        return None
+                    # The results added while rebuilding are added after
+                    # all the others.
+                    if id not in added:
+                        entries.append(result)
+                    if id == last:
+                        return None
+                return cursor
+
+            d = read_pages(backend, got_page, cursor, page_size)
+            d.addCallback(lambda _: entries)
+            return d
+
+        def got_entries(entries):
+            for result in reversed(entries):
+                values = self._values_of(result)
+                if values is not None:
+                    self._add_to(series, *values)
+
+        def replay(number):
+            # Replay the pages that are read immediately in a loop, so that
+            # the stack does not grow with the number of pages.
+            while number >= 0:
+                d = read_page(number)
+                d.addCallback(got_entries)
+                if not d.called:
+                    d.addCallbacks(
+                        lambda _, number=number: replay(number - 1),
+                        done.errback,
+                    )
+                    return
+                failures = []
+                d.addErrback(failures.append)
+                if failures:
+                    done.errback(failures[0])
+                    return
+                number -= 1
+            done.callback(None)
+
+        def finish(_):
+            for _, values in self._added:
+                self._add_to(series, *values)
+            self._series = series
+            self._added = None
+
+        def failed(failure):
+            self._added = None
+            return failure
+
+        d = read_pages(backend, got_bounds, page_size=page_size,
+                       fields=['timestamp'])
+        d.addCallbacks(got_bounds_read, done.errback)
+        done.addCallbacks(finish, failed)
+        return done
+
+
+class RegressionService(RebuildService):
+    """
+    A service that rebuilds the regression statistics from the backend
+    when started.
+    """
+    description = "regression statistics"
@@ -0,0 +1,589 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Measure how the operations of a backend scale with the number of the
+stored results.
+
+The backend is filled up to each of the dataset sizes in turn.  At each
+size every operation is timed a number of times, one call after another,
+and its throughput, latency percentiles and the peak memory usage of the
+process are reported.  The reports are written as JSON, so that a later
+run can be compared with them.
+
+The backend should be empty when the benchmark starts.  The results
+stored to time ``store`` are deleted to time ``delete``, so the backend
+has the same size before and after the measurements at each size.
+
+The time it takes to import the server and the backend is measured too,
+in new processes, as the ``import`` operation at size 0.
+
+The measurements record the reactor they were made on, so the event
+loops are compared by running the benchmark on each of them through
+``benchmark.reactors`` and comparing the runs with ``--baseline``.  The
+calls to an in-process backend hardly run the reactor, so the event
+loops are compared with ``--http``, which serves the backend with the
+API of the server and makes every operation a request over a real
+connection.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from json import dump, load, loads
+from random import Random
+from resource import RUSAGE_SELF, getrusage
+from timeit import default_timer
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import react
+from twisted.internet.utils import getProcessOutput
+from twisted.python.failure import Failure
+from twisted.python.usage import UsageError
+
+from .httpapi import BackendOptions, HTTPBackend, create_api_service
+
+# The percentiles of the latencies that are reported.
+PERCENTILES = (50, 90, 99)
+
+_EPOCH = datetime(2016, 1, 1)
+
+
+def percentile(values, p):
+    """
+    Find a percentile of values using the nearest rank method.
+
+    :param list values: The values, sorted.
+    :param p: The percentile, between 0 and 100.
+    """
+    if not values:
+        return None
+    rank = max(int(-(-len(values) * p // 100)), 1)
+    return values[rank - 1]
+
+
+def _max_rss(maxrss=None):
+    """
+    Get the peak resident set size of the process in bytes.
+
+    :param maxrss: The size reported by ``getrusage``, by default that of
+        this process.
+    """
+    if maxrss is None:
+        maxrss = getrusage(RUSAGE_SELF).ru_maxrss
+    # The size is in kilobytes on Linux and in bytes on OS X.
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def _repeat(f, count):
+    """
+    Call a function that may return a Deferred a number of times, each
+    call after the previous one has finished.
+
+    The calls that finish immediately are made in a loop rather than from
+    the callbacks, so that the stack does not grow with the count.
+
+    :param f: The function to call with the number of the call.
+    :param int count: The number of the calls.
+    :return: A Deferred that fires when all the calls have finished, or
+        fails with the first failure.
+    """
+    done = Deferred()
+    calls = iter(xrange(count))
+
+    def run():
+        for i in calls:
+            d = maybeDeferred(f, i)
+            # A Deferred that waits on another one has been called, but
+            # has no result yet, so look for the result itself.
+            outcome = []
+            d.addBoth(outcome.append)
+            if not outcome:
+                d.addCallback(lambda _: finished(outcome[0]))
+                return
+            if isinstance(outcome[0], Failure):
+                done.errback(outcome[0])
+                return
+        done.callback(None)
+
+    def finished(result):
+        if isinstance(result, Failure):
+            done.errback(result)
+        else:
+            run()
+
+    run()
+    return done
+
+
+class ScalabilityBenchmark(object):
+    """
+    A benchmark of the operations of a backend at growing dataset sizes.
+
+    :ivar list measurements: The measurements made so far, see
+        ``measure``.
+    """
+    def __init__(self, backend, sizes, samples=100, limits=(1, 10, 100),
+                 branches=10, batch_size=1000, clock=default_timer, seed=0,
+                 name=None):
+        """
+        :param backend: The ``IBackend`` provider to benchmark.
+        :param sizes: The numbers of the results to measure at.
+        :param int samples: The number of the times each operation is
+            timed at each size.
+        :param limits: The limits of the timed queries.
+        :param int branches: The number of the branches the results are
+            spread over.  The filtered queries select one of them.
+        :param int batch_size: The number of the results stored at once
+            while filling the backend.
+        :param clock: The function that returns the current time in
+            seconds.
+        :param str name: The name of the backend to report, the name of
+            its class by default.
+        """
+        self.backend = backend
+        if name is None:
+            name = type(backend).__name__
+        self.name = name
+        self.sizes = sorted(sizes)
+        self.samples = samples
+        self.limits = limits
+        self.branches = branches
+        self.batch_size = batch_size
+        self.measurements = []
+        self._clock = clock
+        self._random = Random(seed)
+        self._count = 0
+        self._size = 0
+        # A uniform sample of the identifiers of the stored results.
+        self._ids = []
+        self._seen = 0
+        self._stored = []
+
+    def _result(self):
+        """
+        Make the next result.  Each result is newer than the previous one.
+        """
+        n = self._count
+        self._count += 1
+        return {
+            u"timestamp": (_EPOCH + timedelta(seconds=n)).isoformat(),
+            u"result": self._random.random(),
+            u"userdata": {u"branch": u"branch-{}".format(n % self.branches)},
+        }
+
+    def _sample_id(self, id):
+        """
+        Keep an identifier in the sample of the stored results.
+        """
+        self._seen += 1
+        if len(self._ids) < self.samples:
+            self._ids.append(id)
+        else:
+            index = self._random.randrange(self._seen)
+            if index < self.samples:
+                self._ids[index] = id
+
+    def run(self):
+        """
+        Run the benchmark at all the sizes.
+
+        :return: A Deferred that fires with the measurements.
+        """
+        d = _repeat(lambda i: self._run_size(self.sizes[i]), len(self.sizes))
+        d.addCallback(lambda _: self.measurements)
+        return d
+
+    def _run_size(self, size):
+        d = self._fill(size)
+        d.addCallback(lambda _: self._measure_all(size))
+        return d
+
+    def _fill(self, size):
+        """
+        Store results until there are ``size`` of them.
+        """
+        remaining = size - self._size
+        batches = -(-remaining // self.batch_size)
+        self._size = max(size, self._size)
+
+        def store_batch(i):
+            count = min(self.batch_size, remaining - i * self.batch_size)
+            d = self.backend.store_many(
+                [self._result() for _ in xrange(count)]
+            )
+            d.addCallback(lambda ids: map(self._sample_id, ids))
+            return d
+
+        return _repeat(store_batch, batches)
+
+    def _measure_all(self, size):
+        measurements = [
+            ('store', {}, self._store),
+            ('retrieve', {}, self._retrieve),
+        ]
+        for limit in self.limits:
+            measurements.append(
+                ('query', {'limit': limit, 'filtered': False},
+                 self._query(limit, {}))
+            )
+            measurements.append(
+                ('query', {'limit': limit, 'filtered': True},
+                 self._query(limit, {u"userdata": {u"branch": u"branch-0"}}))
+            )
+        measurements.append(('delete', {}, self._delete))
+
+        def measure(i):
+            operation, parameters, f = measurements[i]
+            return self.measure(size, operation, parameters, f)
+
+        return _repeat(measure, len(measurements))
+
+    def _store(self, i):
+        d = self.backend.store(self._result())
+        d.addCallback(self._stored.append)
+        return d
+
+    def _retrieve(self, i):
+        return self.backend.retrieve(self._ids[i % len(self._ids)])
+
+    def _query(self, limit, filter):
+        return lambda i: self.backend.query(filter, limit)
+
+    def _delete(self, i):
+        return self.backend.delete(self._stored.pop())
+
+    def measure(self, size, operation, parameters, f):
+        """
+        Time an operation.
+
+        :param int size: The number of the stored results.
+        :param str operation: The name of the operation.
+        :param dict parameters: The parameters of the operation to report.
+        :param f: The function that runs the operation once, given the
+            number of the run.
+        :return: A Deferred that fires with the measurement, a dict that is
+            also added to ``measurements``.
+        """
+        latencies = []
+
+        def timed(i):
+            start = self._clock()
+            d = f(i)
+            d.addCallback(lambda _: latencies.append(self._clock() - start))
+            return d
+
+        start = self._clock()
+        d = _repeat(timed, self.samples)
+
+        def finished(_):
+            measurement = _measurement(
+                self.name, size, operation, parameters,
+                latencies, self._clock() - start, _max_rss(),
+            )
+            self.measurements.append(measurement)
+            return measurement
+
+        d.addCallback(finished)
+        return d
+
+
+def serve_http(backend, reactor=None):
+    """
+    Serve the API of the server with a backend on a free port of the
+    loopback interface.
+
+    :param backend: The ``IBackend`` provider to serve.
+    :param reactor: The reactor to listen with, the global one by default.
+    :return: A Deferred that fires with the listening port and an
+        ``HTTPBackend`` that makes the requests to it.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    service = create_api_service(
+        TCP4ServerEndpoint(reactor, 0, interface='127.0.0.1'), backend
+    )
+    d = service.endpoint.listen(service.factory)
+
+    def listening(port):
+        url = 'http://127.0.0.1:{}/v1'.format(port.getHost().port)
+        return port, HTTPBackend(url, reactor)
+
+    d.addCallback(listening)
+    return d
+
+
+def _measurement(backend, size, operation, parameters, latencies, elapsed,
+                 max_rss):
+    """
+    Summarize the latencies of an operation.
+
+    :param float elapsed: The number of seconds all the operations took.
+    :return: The measurement, see ``ScalabilityBenchmark.measure``.
+    """
+    latencies = sorted(latencies)
+    measurement = {
+        'backend': backend,
+        'size': size,
+        'operation': operation,
+        'parameters': parameters,
+        'samples': len(latencies),
+        'ops_per_second': len(latencies) / elapsed if elapsed > 0 else None,
+        'latency': dict(
+            ('p{}'.format(p), percentile(latencies, p)) for p in PERCENTILES
+        ),
+        'max_rss': max_rss,
+    }
+    measurement['latency']['max'] = latencies[-1]
+    return measurement
+
+
+# Import a module and report how long it took and the peak memory usage
+# of the process.
+_IMPORT_SCRIPT = """
+import json, resource, timeit
+start = timeit.default_timer()
+import {module}
+elapsed = timeit.default_timer() - start
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([elapsed, maxrss]))
+"""
+
+
+def measure_import(module, backend, samples=5, reactor=None):
+    """
+    Time the import of a module, every time in a new process, so that
+    none of the modules it imports has been imported before.
+
+    :param str module: The name of the module.
+    :param str backend: The name of the backend to report the measurement
+        for.
+    :param int samples: The number of the times the import is timed.
+    :param reactor: The reactor to run the processes with, the global one
+        by default.
+    :return: A Deferred that fires with the measurement, in the format of
+        ``ScalabilityBenchmark.measure``, with the largest peak memory
+        usage of the processes.
+    """
+    env = dict(os.environ)
+    # Import this package from where it was imported here.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + filter(None, [env.get('PYTHONPATH')])
+    )
+    latencies = []
+    max_rss = []
+
+    def run(i):
+        d = getProcessOutput(
+            sys.executable, ['-c', _IMPORT_SCRIPT.format(module=module)],
+            env=env, reactor=reactor,
+        )
+        d.addCallback(record)
+        return d
+
+    def record(output):
+        elapsed, maxrss = loads(output)
+        latencies.append(elapsed)
+        max_rss.append(_max_rss(maxrss))
+
+    def finished(_):
+        return _measurement(
+            backend, 0, 'import', {'module': module}, latencies,
+            sum(latencies), max(max_rss),
+        )
+
+    d = _repeat(run, samples)
+    d.addCallback(finished)
+    return d
+
+
+def _key(measurement):
+    """
+    Identify what a measurement measured, to match it with a measurement
+    from another run.
+    """
+    return (
+        measurement['backend'], measurement['size'],
+        measurement['operation'],
+        tuple(sorted(measurement['parameters'].items())),
+    )
+
+
+def format_report(measurements, baseline=None):
+    """
+    Format measurements as a table.
+
+    :param list measurements: The measurements.
+    :param list baseline: The measurements of an earlier run.  If given,
+        the throughput is also shown relative to the throughput of the
+        same measurement in it.
+    :return: The lines of the table.
+    """
+    previous = {}
+    if baseline is not None:
+        previous = dict((_key(m), m) for m in baseline)
+    header = "{:>10} {:<10} {:<24} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+        "size", "operation", "parameters", "ops/s", "p50 ms", "p99 ms",
+        "rss MiB", "change",
+    )
+    lines = [header.rstrip()]
+    for m in measurements:
+        parameters = ','.join(
+            '{}={}'.format(name, value)
+            for name, value in sorted(m['parameters'].items())
+        )
+        change = ''
+        old = previous.get(_key(m))
+        if old is not None and old['ops_per_second'] and m['ops_per_second']:
+            change = '{:+.0%}'.format(
+                m['ops_per_second'] / old['ops_per_second'] - 1
+            )
+        lines.append(
+            "{:>10} {:<10} {:<24} {:>10.0f} {:>10.3f} {:>10.3f} {:>10.1f} "
+            "{:>8}".format(
+                m['size'], m['operation'], parameters,
+                m['ops_per_second'] or 0,
+                m['latency']['p50'] * 1000, m['latency']['p99'] * 1000,
+                m['max_rss'] / 1024.0 / 1024, change,
+            ).rstrip()
+        )
+    return lines
+
+
+def _parse_integers(value):
+    try:
+        # Allow sizes like 1e6.
+        return [int(float(item)) for item in value.split(',')]
+    except ValueError:
+        raise UsageError("Invalid list of numbers {}".format(value))
+
+
+class ScalabilityOptions(BackendOptions):
+    longdesc = (
+        "Measure how the operations of an empty backend scale with the "
+        "number of the stored results"
+    )
+
+    optParameters = [
+        ['sizes', None, '1e3,1e4,1e5',
+         "The comma separated numbers of the results to measure at", str],
+        ['samples', None, 100,
+         "The number of the times each operation is timed at each size",
+         int],
+        ['limits', None, '1,10,100',
+         "The comma separated limits of the timed queries", str],
+        ['branches', None, 10,
+         "The number of the branches the results are spread over", int],
+        ['import-samples', None, 5,
+         "The number of the times the imports of the server and the "
+         "backend are timed, 0 not to time them", int],
+        ['output', None, None,
+         "The file to write the measurements to as JSON", str],
+        ['baseline', None, None,
+         "The file with the measurements of an earlier run to compare "
+         "with", str],
+    ]
+
+    optFlags = [
+        ['http', None,
+         "Serve the backend with the API of the server and time the "
+         "operations as requests over real connections"],
+    ]
+
+    def postOptions(self):
+        self['sizes'] = _parse_integers(self['sizes'])
+        self['limits'] = _parse_integers(self['limits'])
+        BackendOptions.postOptions(self)
+
+
+def main(reactor, args):
+    try:
+        options = ScalabilityOptions()
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write(e.args[0])
+        sys.stderr.write('\n\n')
+        sys.stderr.write(options.getSynopsis())
+        sys.stderr.write('\n')
+        sys.stderr.write(options.getUsage())
+        raise SystemExit(1)
+
+    baseline = None
+    if options['baseline'] is not None:
+        with open(options['baseline']) as f:
+            baseline = load(f)
+
+    backend = options['backend']
+    reactor_name = type(reactor).__name__
+    # The listening port and the client when the backend is served.
+    served = []
+
+    def run(_):
+        target, name = backend, type(backend).__name__
+        if served:
+            target, name = served[1], name + ' over HTTP'
+        benchmark = ScalabilityBenchmark(
+            target,
+            options['sizes'],
+            samples=options['samples'],
+            limits=options['limits'],
+            branches=options['branches'],
+            name=name,
+        )
+        return benchmark.run()
+
+    def report(measurements):
+        reactors = [reactor_name]
+        if baseline:
+            reactors.append(baseline[0].get('reactor', 'unknown'))
+        sys.stdout.write(
+            "reactor {}\n".format(' compared with '.join(reactors))
+        )
+        for measurement in measurements:
+            measurement['reactor'] = reactor_name
+        for line in format_report(measurements, baseline):
+            sys.stdout.write(line + '\n')
+        if options['output'] is not None:
+            with open(options['output'], 'w') as f:
+                dump(measurements, f, indent=2)
+
+    def disconnect(passthrough):
+        if served:
+            port, client = served
+            d = maybeDeferred(client.disconnect)
+            d.addCallback(lambda _: port.stopListening())
+        else:
+            d = succeed(None)
+        d.addCallback(lambda _: backend.disconnect())
+        d.addCallback(lambda _: passthrough)
+        return d
+
+    # The cold start of the server with the backend.
+    modules = []
+    if options['import-samples']:
+        modules = sorted({'benchmark.httpapi', type(backend).__module__})
+    imports = []
+
+    def measure_import_of(i):
+        d = measure_import(
+            modules[i], type(backend).__name__, options['import-samples'],
+            reactor,
+        )
+        d.addCallback(imports.append)
+        return d
+
+    d = _repeat(measure_import_of, len(modules))
+    if options['http']:
+        d.addCallback(lambda _: serve_http(backend, reactor))
+        d.addCallback(served.extend)
+    d.addCallback(run)
+    d.addCallback(lambda measurements: imports + measurements)
+    d.addCallback(report)
+    d.addBoth(disconnect)
+    return d
+
+
+if __name__ == '__main__':
+    react(main, (sys.argv[1:],))
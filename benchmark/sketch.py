@@ -0,0 +1,264 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+"""
+Approximate percentiles of the stored results.
+
+The values of the results are summarized by mergeable quantile sketches,
+one for every branch and time bucket, which are updated as the results
+are stored.  The percentiles over any range of buckets are found by
+merging their sketches, without reading any results.
+"""
+
+from datetime import timedelta
+from math import ceil, log
+
+from dateutil import parser as timestamp_parser
+
+from ._indexes import RebuildService, is_finite, read_all, value_of
+from .export import to_utc
+
+
+class DDSketch(object):
+    """
+    A quantile sketch with a relative accuracy guarantee.
+
+    Positive and negative values are counted in buckets whose bounds grow
+    geometrically, so every quantile is found within the relative
+    accuracy of the true value, with the number of the buckets growing
+    only with the logarithm of the range of the values.  Sketches with the
+    same accuracy are merged by adding up their buckets.
+
+    See "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with
+    Relative-Error Guarantees", Masson et al., 2019.
+
+    :ivar int count: The number of the values added.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        """
+        :param float relative_accuracy: The maximum relative error of the
+            quantiles.
+        """
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = log(self._gamma)
+        self._positive = {}
+        self._negative = {}
+        self._zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        """
+        Find the bucket of a positive value.  Bucket ``i`` holds the values
+        in ``(gamma ** (i - 1), gamma ** i]``.
+        """
+        return int(ceil(log(value) / self._log_gamma))
+
+    def _value(self, index):
+        """
+        Estimate the values in a bucket, within the relative accuracy.
+        """
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value):
+        """
+        Add a value.
+
+        :raises ValueError: If the value is infinite or NaN, which has no
+            bucket.
+        """
+        if not is_finite(value):
+            raise ValueError("Can not sketch {}".format(value))
+        if value > 0:
+            index = self._index(value)
+            self._positive[index] = self._positive.get(index, 0) + 1
+        elif value < 0:
+            index = self._index(-value)
+            self._negative[index] = self._negative.get(index, 0) + 1
+        else:
+            self._zeros += 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can not merge sketches of different accuracy")
+        for mine, theirs in ((self._positive, other._positive),
+                             (self._negative, other._negative)):
+            for index, count in theirs.iteritems():
+                mine[index] = mine.get(index, 0) + count
+        self._zeros += other._zeros
+        self.count += other.count
+        if other.count:
+            if self.min is None or other.min < self.min:
+                self.min = other.min
+            if self.max is None or other.max > self.max:
+                self.max = other.max
+
+    def quantile(self, q):
+        """
+        Estimate a quantile of the values.
+
+        :param float q: The quantile, between 0 and 1.
+        :return: The estimate, or None if no values were added.
+        """
+        if not self.count:
+            return None
+        # The extremes are known exactly.
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = 0
+        # From the most negative values to the most positive ones.
+        buckets = (
+            [(-self._value(index), self._negative[index])
+             for index in sorted(self._negative, reverse=True)] +
+            [(0.0, self._zeros)] +
+            [(self._value(index), self._positive[index])
+             for index in sorted(self._positive)]
+        )
+        for value, count in buckets:
+            seen += count
+            if seen > rank:
+                break
+        return min(max(value, self.min), self.max)
+
+
+class SketchIndex(object):
+    """
+    The quantile sketches of the values of the results per branch and time
+    bucket.
+
+    The sketches are updated as results are stored through ``add``.
+    Deleted results stay in the sketches until they are rebuilt from the
+    backend with ``rebuild``.
+    """
+    def __init__(self, bucket=timedelta(days=1), relative_accuracy=0.01):
+        """
+        :param timedelta bucket: The length of the time buckets.
+        :param float relative_accuracy: The maximum relative error of the
+            percentiles.
+        """
+        self._bucket_seconds = int(bucket.total_seconds())
+        self.relative_accuracy = relative_accuracy
+        # The sketches by the branch and then by the bucket.
+        self._sketches = {}
+        # The sketches being rebuilt and the identifiers of the results
+        # added while rebuilding, which the backend may return too.
+        self._rebuilt = None
+        self._added = None
+
+    def _bucket(self, timestamp):
+        """
+        Get the number of the time bucket of a naive timestamp in UTC.
+        """
+        delta = timestamp - timestamp.min
+        return (delta.days * 86400 + delta.seconds) // self._bucket_seconds
+
+    def _add_to(self, sketches, result):
+        """
+        Add a result to the sketches of its branch and to those of all the
+        branches, which are kept under None.
+        """
+        value = value_of(result)
+        if value is None:
+            return
+        userdata = result.get('userdata')
+        branches = [None]
+        if isinstance(userdata, dict):
+            branch = userdata.get('branch')
+            if isinstance(branch, basestring):
+                branches.append(branch)
+        bucket = self._bucket(
+            to_utc(timestamp_parser.parse(result['timestamp']))
+        )
+        for branch in branches:
+            buckets = sketches.setdefault(branch, {})
+            sketch = buckets.get(bucket)
+            if sketch is None:
+                sketch = buckets[bucket] = DDSketch(self.relative_accuracy)
+            sketch.add(value)
+
+    def add(self, id, result):
+        """
+        Add a stored result.  Results without a numeric value are ignored.
+
+        :param str id: The identifier of the result.
+        :param dict result: The result in the JSON compatible format.
+        """
+        self._add_to(self._sketches, result)
+        if self._rebuilt is not None:
+            self._added.add(id)
+            self._add_to(self._rebuilt, result)
+
+    def sketch(self, branch=None, start=None, end=None):
+        """
+        Merge the sketches of a branch over a range of time.
+
+        The range is extended to whole buckets.
+
+        :param branch: The branch, or None for all the branches.
+        :param datetime start: The earliest timestamp in UTC, or None.
+        :param datetime end: The timestamp in UTC the range ends before,
+            or None.
+        :return: A ``DDSketch`` of the values in the range.
+        """
+        first = last = None
+        if start is not None:
+            first = self._bucket(start)
+        if end is not None:
+            last = self._bucket(end - timedelta(microseconds=1))
+        merged = DDSketch(self.relative_accuracy)
+        buckets = self._sketches.get(branch, {})
+        for bucket, sketch in buckets.iteritems():
+            if first is not None and bucket < first:
+                continue
+            if last is not None and bucket > last:
+                continue
+            merged.merge(sketch)
+        return merged
+
+    def rebuild(self, backend, page_size=1000):
+        """
+        Rebuild the sketches from all the results in a backend.
+
+        The current sketches keep being used until the rebuild finishes.
+
+        :param IBackend backend: The backend.
+        :param int page_size: The number of the results to read at once.
+        :return: A Deferred that fires when the sketches are rebuilt.
+        """
+        self._rebuilt = {}
+        self._added = set()
+
+        def got_entries(entries):
+            for id, result in entries:
+                if id not in self._added:
+                    self._add_to(self._rebuilt, result)
+
+        def finish(_):
+            self._sketches = self._rebuilt
+            self._rebuilt = self._added = None
+
+        def failed(failure):
+            self._rebuilt = self._added = None
+            return failure
+
+        d = read_all(backend, got_entries, page_size)
+        d.addCallbacks(finish, failed)
+        return d
+
+
+class SketchService(RebuildService):
+    """
+    A service that rebuilds the sketches from the backend when started.
+    """
+    description = "percentile sketches"
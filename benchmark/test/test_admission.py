@@ -0,0 +1,251 @@
+from json import dumps
+
+from twisted.application.internet import StreamServerEndpointService
+from twisted.internet import endpoints
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web import client, http
+
+from testtools import TestCase
+from testtools.deferredruntest import AsynchronousDeferredRunTest
+
+from benchmark.admission import (
+    AdmissionControl, DeadlineExceeded, LimitedSite, Overloaded, _Limiter
+)
+from benchmark.httpapi import BenchmarkAPI_V1, InMemoryBackend
+
+from .test_httpapi import StringProducer, TestEndpoint
+
+
+class LimiterTests(SynchronousTestCase):
+    """
+    Tests for ``_Limiter``.
+    """
+    def test_queue(self):
+        """
+        Operations above the concurrency limit are queued and started
+        in order as the running operations complete.
+        """
+        limiter = _Limiter(1, 2)
+        first = limiter.acquire()
+        second = limiter.acquire()
+        third = limiter.acquire()
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.assertNoResult(third)
+        limiter.release()
+        self.successResultOf(second)
+        self.assertNoResult(third)
+        self.assertEqual((1, 1), (limiter.active, limiter.queued))
+
+    def test_queue_full(self):
+        """
+        Operations that do not fit into the queue are rejected.
+        """
+        limiter = _Limiter(1, 1)
+        limiter.acquire()
+        limiter.acquire()
+        self.failureResultOf(limiter.acquire(), Overloaded)
+
+    def test_cancel_queued(self):
+        """
+        Cancelling a queued operation removes it from the queue.
+        """
+        limiter = _Limiter(1, 1)
+        limiter.acquire()
+        d = limiter.acquire()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual((1, 0), (limiter.active, limiter.queued))
+        limiter.release()
+        self.assertEqual(0, limiter.active)
+
+
+class AdmissionControlTests(SynchronousTestCase):
+    """
+    Tests for ``AdmissionControl``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_unlimited(self):
+        """
+        Requests of the route classes without a limit are processed
+        immediately.
+        """
+        admission = AdmissionControl(self.clock, concurrency={'write': 1})
+        pending = [Deferred() for _ in range(3)]
+        results = [admission.run('read', lambda d: d, d) for d in pending]
+        for d in pending:
+            d.callback(None)
+        for d in results:
+            self.successResultOf(d)
+
+    def test_release(self):
+        """
+        The slot of a request is released when its processing fails.
+        """
+        admission = AdmissionControl(self.clock, concurrency={'read': 1})
+        self.failureResultOf(
+            admission.run('read', lambda: 1 / 0), ZeroDivisionError
+        )
+        self.assertEqual(1, self.successResultOf(
+            admission.run('read', lambda: 1)
+        ))
+
+    def test_deadline(self):
+        """
+        Processing of a request is cancelled when its deadline passes.
+        """
+        admission = AdmissionControl(
+            self.clock, concurrency={'read': 1}, timeout=5
+        )
+        cancelled = []
+        processing = Deferred(cancelled.append)
+        d = admission.run('read', lambda: processing)
+        self.clock.advance(5)
+        self.failureResultOf(d, DeadlineExceeded)
+        self.assertEqual([processing], cancelled)
+
+    def test_no_deadline_for_class(self):
+        """
+        Requests of the route classes with no timeout of their own have no
+        deadline.
+        """
+        admission = AdmissionControl(
+            self.clock, timeout=5, timeouts={'export': None}
+        )
+        processing = Deferred()
+        d = admission.run('export', lambda: processing)
+        self.clock.advance(10)
+        self.assertNoResult(d)
+        processing.callback(1)
+        self.assertEqual(1, self.successResultOf(d))
+
+    def test_deadline_met(self):
+        """
+        The deadline timer is cancelled when a request is processed.
+        """
+        admission = AdmissionControl(self.clock, timeout=5)
+        self.assertEqual(1, self.successResultOf(
+            admission.run('read', lambda: 1)
+        ))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class PendingBackend(InMemoryBackend):
+    """
+    A backend whose stores complete only when the test says so.
+    """
+    def __init__(self):
+        super(PendingBackend, self).__init__()
+        self.pending = []
+        self.cancelled = []
+
+    def store(self, result):
+        d = Deferred(self.cancelled.append)
+        self.pending.append(d)
+        return d
+
+
+class AdmissionAPITests(TestCase):
+    """
+    Tests for the admission control of the HTTP API.
+    """
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=1)
+
+    RESULT = {u"userdata": {u"branch": "master"}, u"run": 1, u"result": 1,
+              u"timestamp": u"2016-01-01T00:00:05"}
+
+    def start(self, admission, max_body_size=None):
+        """
+        Start serving the API with the given limits.
+        """
+        self.backend = PendingBackend()
+        api = BenchmarkAPI_V1(self.backend, self.reactor, admission)
+        site = LimitedSite(api.app.resource(), max_body_size=max_body_size)
+
+        def make_client(listening_port):
+            addr = listening_port.getHost()
+            self.agent = client.ProxyAgent(
+                endpoints.TCP4ClientEndpoint(
+                    self.reactor, addr.host, addr.port,
+                ),
+                self.reactor,
+            )
+
+        listening = Deferred()
+        listening.addCallback(make_client)
+        service = StreamServerEndpointService(
+            TestEndpoint(self.reactor, listening), site
+        )
+        service.startService()
+        self.addCleanup(service.stopService)
+        return listening
+
+    def submit(self, body):
+        return self.agent.request(
+            "POST", "/benchmark-results", bodyProducer=StringProducer(body)
+        )
+
+    def test_overloaded(self):
+        """
+        A request is rejected with SERVICE_UNAVAILABLE and a Retry-After
+        header when its route class is at the limit and the queue is
+        full.
+        """
+        admission = AdmissionControl(
+            self.reactor, concurrency={'write': 1}, retry_after=7
+        )
+        d = self.start(admission)
+        first = []
+        d.addCallback(lambda _: first.append(self.submit(dumps(self.RESULT))))
+
+        def check_rejected(response):
+            self.assertEqual(http.SERVICE_UNAVAILABLE, response.code)
+            self.assertEqual(
+                ['7'], response.headers.getRawHeaders(b'retry-after')
+            )
+            # The first request is still being processed.
+            self.assertEqual(1, len(self.backend.pending))
+            self.backend.pending[0].callback("id")
+            return first[0]
+
+        d.addCallback(lambda _: self.submit(dumps(self.RESULT)))
+        d.addCallback(check_rejected)
+        d.addCallback(
+            lambda response: self.assertEqual(http.CREATED, response.code)
+        )
+        return d
+
+    def test_deadline(self):
+        """
+        A request that is not processed within its deadline is answered
+        with SERVICE_UNAVAILABLE and the backend operation is cancelled.
+        """
+        admission = AdmissionControl(self.reactor, timeout=0.01)
+        d = self.start(admission)
+        d.addCallback(lambda _: self.submit(dumps(self.RESULT)))
+
+        def check(response):
+            self.assertEqual(http.SERVICE_UNAVAILABLE, response.code)
+            self.assertEqual(self.backend.pending, self.backend.cancelled)
+
+        d.addCallback(check)
+        return d
+
+    def test_body_too_large(self):
+        """
+        A request with a body larger than allowed is rejected with
+        REQUEST_ENTITY_TOO_LARGE without reaching the backend.
+        """
+        d = self.start(AdmissionControl(self.reactor), max_body_size=10)
+        d.addCallback(lambda _: self.submit(dumps(self.RESULT)))
+
+        def check(response):
+            self.assertEqual(http.REQUEST_ENTITY_TOO_LARGE, response.code)
+            self.assertEqual([], self.backend.pending)
+
+        d.addCallback(check)
+        return d
@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+from gzip import GzipFile
+from StringIO import StringIO
+
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.backup import (
+    BackupOptions, BadArchive, dump, restore, restore_archive,
+)
+from benchmark.httpapi import (
+    InMemoryBackend, RoutingBackend, ShardedInMemoryBackend,
+)
+
+
+def result(n):
+    return {
+        u"timestamp": (datetime(2016, 1, 1) + timedelta(hours=n)).isoformat(),
+        u"result": n,
+        u"userdata": {u"branch": unicode(n % 3)},
+    }
+
+
+class BackupTests(SynchronousTestCase):
+    """
+    Tests for ``dump`` and ``restore``.
+    """
+    def dump(self, backend, page_size=2):
+        f = StringIO()
+        self.assertEqual(
+            len(self.successResultOf(backend.query({}))),
+            self.successResultOf(dump(backend, f, page_size)),
+        )
+        f.seek(0)
+        return f
+
+    def assertRoundTrip(self, make_backend):
+        source = make_backend()
+        self.successResultOf(source.store_many(map(result, range(7))))
+        f = self.dump(source)
+        backend = make_backend()
+        self.assertEqual(
+            7, self.successResultOf(restore(backend, f, batch_size=3))
+        )
+        self.assertEqual(
+            self.successResultOf(source.page({})),
+            self.successResultOf(backend.page({})),
+        )
+
+    def test_round_trip(self):
+        """
+        The results restored to a backend of the same kind keep their
+        identifiers and order.
+        """
+        self.assertRoundTrip(InMemoryBackend)
+
+    def test_round_trip_sharded(self):
+        """
+        The results restored to a sharded backend keep their identifiers
+        and order.
+        """
+        self.assertRoundTrip(lambda: ShardedInMemoryBackend(shards=4))
+
+    def test_other_kind(self):
+        """
+        The results restored to a backend of another kind get new
+        identifiers.
+        """
+        source = InMemoryBackend()
+        results = map(result, range(5))
+        self.successResultOf(source.store_many(results))
+        backend = ShardedInMemoryBackend(shards=4)
+        self.successResultOf(restore(backend, self.dump(source)))
+        self.assertEqual(
+            results[::-1], self.successResultOf(backend.query({}))
+        )
+
+    def test_restore_twice(self):
+        """
+        Restoring an archive again does not duplicate the results.
+        """
+        source = InMemoryBackend()
+        self.successResultOf(source.store_many(map(result, range(5))))
+        f = self.dump(source)
+        backend = InMemoryBackend()
+        self.successResultOf(restore(backend, f))
+        f.seek(0)
+        self.successResultOf(restore(backend, f))
+        self.assertEqual(5, len(self.successResultOf(backend.query({}))))
+
+    def test_bad_archive(self):
+        """
+        Restoring fails if the archive is not valid.
+        """
+        backend = InMemoryBackend()
+        self.failureResultOf(restore(backend, StringIO(b"{}\n")), BadArchive)
+        f = StringIO(
+            b'{"version": 1, "backend": ""}\n{"result": {}}\n{"id": "x"}\n'
+        )
+        self.failureResultOf(restore(backend, f), BadArchive)
+
+    def test_restore_archive(self):
+        """
+        The results in a compressed archive file are restored.
+        """
+        source = InMemoryBackend()
+        self.successResultOf(source.store_many(map(result, range(5))))
+        path = self.mktemp()
+        f = GzipFile(path, 'wb')
+        f.write(self.dump(source).getvalue())
+        f.close()
+        backend = InMemoryBackend()
+        self.assertEqual(
+            5, self.successResultOf(restore_archive(backend, path))
+        )
+        self.assertEqual(
+            self.successResultOf(source.page({})),
+            self.successResultOf(backend.page({})),
+        )
+
+
+class BackupOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``BackupOptions``.
+    """
+    def test_restore(self):
+        """
+        The restore command creates the backend to restore to.
+        """
+        options = BackupOptions()
+        options.parseOptions([
+            'restore', '--backend', 'routing', '--nodes',
+            'a=http://localhost:8888', '--batch-size', '5', 'archive.gz',
+        ])
+        self.assertEqual('restore', options.subCommand)
+        self.assertEqual('archive.gz', options.subOptions['archive'])
+        self.assertEqual(5, options.subOptions['batch-size'])
+        self.assertIsInstance(options.subOptions['backend'], RoutingBackend)
+
+    def test_in_memory(self):
+        """
+        The in-memory backends, which are empty outside of the server, are
+        rejected.
+        """
+        for command in ['dump', 'restore']:
+            for backend in ['in-memory', 'sharded-in-memory']:
+                self.assertRaises(
+                    UsageError, BackupOptions().parseOptions,
+                    [command, '--backend', backend, 'archive.gz'],
+                )
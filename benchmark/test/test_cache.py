@@ -0,0 +1,90 @@
+from json import dumps
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.cache import ResultCache
+
+
+def result(value):
+    return {u"result": value}
+
+
+SIZE = len(dumps(result(0)))
+
+
+class ResultCacheTests(SynchronousTestCase):
+    """
+    Tests for ``ResultCache``.
+    """
+    def test_get(self):
+        """
+        An added result is found and the lookups are counted.
+        """
+        cache = ResultCache(10 * SIZE)
+        cache.put('a', result(0))
+        self.assertEqual(
+            [result(0), None], [cache.get('a'), cache.get('b')]
+        )
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_describe(self):
+        """
+        The description of the cache has its hit rate and size.
+        """
+        cache = ResultCache(10 * SIZE)
+        self.assertEqual(
+            "result cache: 0 hits, 0 misses (0% hit rate), 0 results in 0 "
+            "of {} bytes".format(10 * SIZE),
+            cache.describe(),
+        )
+        cache.put('a', result(0))
+        for id in ['a', 'a', 'a', 'b']:
+            cache.get(id)
+        self.assertEqual(
+            "result cache: 3 hits, 1 misses (75% hit rate), 1 results in {} "
+            "of {} bytes".format(SIZE, 10 * SIZE),
+            cache.describe(),
+        )
+
+    def test_evict_least_recently_used(self):
+        """
+        When the cache is full, the least recently used results are
+        removed to make room for a new one.
+        """
+        cache = ResultCache(2 * SIZE)
+        cache.put('a', result(0))
+        cache.put('b', result(1))
+        cache.get('a')
+        cache.put('c', result(2))
+        self.assertEqual(
+            [result(0), None, result(2)],
+            [cache.get('a'), cache.get('b'), cache.get('c')],
+        )
+        self.assertEqual(2 * SIZE, cache.size)
+
+    def test_too_large(self):
+        """
+        A result larger than the cache is not added.
+        """
+        cache = ResultCache(SIZE - 1)
+        cache.put('a', result(0))
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+    def test_invalidate(self):
+        """
+        An invalidated result is removed.
+        """
+        cache = ResultCache(10 * SIZE)
+        cache.put('a', result(0))
+        cache.invalidate('a')
+        self.assertEqual((None, 0), (cache.get('a'), cache.size))
+
+    def test_stale_read(self):
+        """
+        A result read before a result was invalidated is not added.
+        """
+        cache = ResultCache(10 * SIZE)
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.put('a', result(0), generation)
+        self.assertIs(None, cache.get('a'))
@@ -0,0 +1,201 @@
+from twisted.internet.defer import fail
+from twisted.web import http, server
+
+from testtools import TestCase
+from testtools.deferredruntest import (
+    AsynchronousDeferredRunTest, flush_logged_errors
+)
+
+from benchmark.admission import AdmissionControl, Overloaded
+from benchmark.client import APIError, BenchmarkClient
+from benchmark.httpapi import BenchmarkAPI_V1, InMemoryBackend
+
+
+class RecordingBackend(InMemoryBackend):
+    """
+    A backend that records the calls to some of its methods and can be
+    made to fail them.
+    """
+    def __init__(self):
+        super(RecordingBackend, self).__init__()
+        self.calls = []
+        self.failures = []
+
+    def _record(self, name):
+        self.calls.append(name)
+        if self.failures:
+            return fail(self.failures.pop(0))
+        return None
+
+    def store(self, result):
+        return self._record('store') or (
+            super(RecordingBackend, self).store(result)
+        )
+
+    def store_many(self, results):
+        return self._record('store_many') or (
+            super(RecordingBackend, self).store_many(results)
+        )
+
+    def retrieve(self, id, fields=None):
+        return self._record('retrieve') or (
+            super(RecordingBackend, self).retrieve(id, fields)
+        )
+
+
+class BenchmarkClientTests(TestCase):
+    """
+    Tests for ``BenchmarkClient``.
+    """
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=1)
+
+    def result(self, second):
+        return {
+            u"userdata": {u"branch": u"master"},
+            u"timestamp": u"2016-01-01T00:00:{:02d}".format(second),
+        }
+
+    def setUp(self):
+        super(BenchmarkClientTests, self).setUp()
+        self.backend = RecordingBackend()
+        self.api = BenchmarkAPI_V1(
+            self.backend, self.reactor,
+            AdmissionControl(self.reactor, retry_after=0),
+        )
+        port = self.reactor.listenTCP(
+            0, server.Site(self.api.app.resource()), interface='127.0.0.1'
+        )
+        self.addCleanup(port.stopListening)
+        self.client = BenchmarkClient(
+            'http://127.0.0.1:{}/'.format(port.getHost().port),
+            self.reactor, backoff=0.01, batch_size=3, batch_delay=0.01,
+        )
+        self.addCleanup(self.client.close)
+
+    def test_store_retrieve(self):
+        """
+        A stored result can be retrieved by its identifier.
+        """
+        result = self.result(0)
+        d = self.client.store(result)
+        d.addCallback(self.client.retrieve)
+        d.addCallback(self.assertEqual, result)
+        return d
+
+    def test_retrieve_not_found(self):
+        """
+        Error responses are reported as ``APIError``.
+        """
+        d = self.client.retrieve('nonexistent')
+        d.addCallbacks(
+            self.fail,
+            lambda failure: self.assertEqual(
+                http.NOT_FOUND, failure.trap(APIError) and failure.value.code
+            ),
+        )
+        return d
+
+    def test_submit_batch(self):
+        """
+        Results submitted together are sent in one bulk request as soon as
+        there are enough of them.
+        """
+        results = [self.result(second) for second in range(3)]
+        d = self.client.submit(results[0])
+        self.client.submit(results[1])
+        self.client.submit(results[2])
+
+        def check(id):
+            self.assertEqual(['store_many'], self.backend.calls)
+            return self.client.retrieve(id)
+
+        d.addCallback(check)
+        d.addCallback(self.assertEqual, results[0])
+        return d
+
+    def test_submit_delay(self):
+        """
+        A submitted result is sent after the batch delay if no more
+        results are submitted.
+        """
+        d = self.client.submit(self.result(0))
+        d.addCallback(
+            lambda _: self.assertEqual(['store_many'], self.backend.calls)
+        )
+        return d
+
+    def test_flush(self):
+        """
+        ``flush`` sends the submitted results right away.
+        """
+        submitted = self.client.submit(self.result(0))
+        self.client.batch_delay = 10
+        d = self.client.flush()
+        d.addCallback(lambda _: submitted)
+        return d
+
+    def test_cursor(self):
+        """
+        A cursor iterates over all the results, a page at a time, from
+        the latest to the oldest.
+        """
+        results = [self.result(second) for second in range(5)]
+        d = self.client.store_many(results)
+        collected = []
+        d.addCallback(
+            lambda _: self.client.cursor(page_size=2).for_each(
+                collected.append
+            )
+        )
+        d.addCallback(lambda _: self.assertEqual(results[::-1], collected))
+        return d
+
+    def test_retry_overloaded(self):
+        """
+        A request rejected because the server is overloaded is retried.
+        """
+        result = self.result(0)
+        d = self.client.store(result)
+
+        def retrieve(id):
+            self.backend.failures.append(Overloaded())
+            return self.client.retrieve(id)
+
+        d.addCallback(retrieve)
+        d.addCallback(self.assertEqual, result)
+        d.addCallback(
+            lambda _: self.assertEqual(
+                ['store', 'retrieve', 'retrieve'], self.backend.calls
+            )
+        )
+        return d
+
+    def test_store_idempotent(self):
+        """
+        The results are stored with an idempotency key, so that the server
+        stores them once if the request is retried.
+        """
+        d = self.client.store(self.result(0))
+
+        def check(id):
+            [(_, _, value)] = self.api.dedup._entries.values()
+            self.assertEqual(id, value)
+
+        d.addCallback(check)
+        return d
+
+    def test_no_retry_store_error(self):
+        """
+        A store that fails on the server is not retried.
+        """
+        self.backend.failures.append(RuntimeError("broken"))
+        d = self.client.store(self.result(0))
+        d.addCallbacks(
+            self.fail,
+            lambda failure: failure.trap(APIError) and self.assertEqual(
+                (http.INTERNAL_SERVER_ERROR, ['store']),
+                (failure.value.code, self.backend.calls),
+            ),
+        )
+        d.addCallback(lambda _: flush_logged_errors(RuntimeError))
+        return d
@@ -0,0 +1,203 @@
+from datetime import datetime
+from json import loads
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from bson import BSON
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from benchmark.codec import (
+    BSON_TYPE, JSON, MSGPACK, JSONCodec, request_format, response_format
+)
+
+
+class FakeReactor(object):
+    """
+    A reactor that runs the calls from the threads immediately.
+    """
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class FakeThreadPool(object):
+    """
+    A thread pool that runs the calls immediately and records them.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append(f)
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            onResult(False, e)
+        else:
+            onResult(True, result)
+
+
+class JSONCodecTests(SynchronousTestCase):
+    """
+    Tests for ``JSONCodec``.
+    """
+    def setUp(self):
+        self.threadpool = FakeThreadPool()
+        self.codec = JSONCodec(
+            FakeReactor(), self.threadpool, size_threshold=10,
+            count_threshold=2,
+        )
+
+    def test_decode_small(self):
+        """
+        Small documents are decoded without the thread pool.
+        """
+        d = self.codec.decode('{"a": 1}')
+        self.assertEqual({u"a": 1}, self.successResultOf(d))
+        self.assertEqual([], self.threadpool.calls)
+
+    def test_decode_large(self):
+        """
+        Large documents are decoded in the thread pool.
+        """
+        d = self.codec.decode('{"a": 1, "b": 2}')
+        self.assertEqual({u"a": 1, u"b": 2}, self.successResultOf(d))
+        self.assertEqual(1, len(self.threadpool.calls))
+
+    def test_decode_invalid(self):
+        """
+        Decoding fails if the validation of the document fails.
+        """
+        def validate(document):
+            raise KeyError(document.keys()[0])
+
+        d = self.codec.decode('{"a": 1, "b": 2}', validate)
+        self.failureResultOf(d, KeyError)
+
+    def test_encode_results(self):
+        """
+        The results are encoded as a field of the envelope, in the
+        thread pool if there are many of them.
+        """
+        results = [{u"a": 1}, {u"b": [2]}]
+        for count in range(len(results) + 1):
+            d = self.codec.encode_results({u"version": 1}, results[:count])
+            self.assertEqual(
+                {u"version": 1, u"results": results[:count]},
+                loads(self.successResultOf(d)),
+            )
+        self.assertEqual(1, len(self.threadpool.calls))
+
+
+class FormatTests(SynchronousTestCase):
+    """
+    Tests for the binary formats of ``JSONCodec``.
+    """
+    def setUp(self):
+        self.codec = JSONCodec(FakeReactor(), FakeThreadPool())
+
+    def test_bson(self):
+        """
+        A BSON document is decoded as one document and a sequence of them
+        as a list.
+        """
+        documents = [{u"a": 1}, {u"b": [2.5, u"c"]}]
+        data = b''.join(map(BSON.encode, documents))
+        self.assertEqual(
+            documents,
+            self.successResultOf(
+                self.codec.decode(data, content_type=BSON_TYPE, many=True)
+            ),
+        )
+        self.assertEqual(
+            documents[0],
+            self.successResultOf(
+                self.codec.decode(data[:len(BSON.encode(documents[0]))],
+                                  content_type=BSON_TYPE)
+            ),
+        )
+        self.failureResultOf(
+            self.codec.decode(data, content_type=BSON_TYPE), ValueError
+        )
+
+    def test_bson_invalid(self):
+        """
+        Decoding fails with ``ValueError`` for data that is not BSON or
+        values that are not JSON compatible.
+        """
+        for data in (b"garbage", BSON.encode({u"a": [datetime.now()]})):
+            self.failureResultOf(
+                self.codec.decode(data, content_type=BSON_TYPE), ValueError
+            )
+
+    def test_encode_results_bson(self):
+        """
+        The results can be encoded as a BSON document.
+        """
+        d = self.codec.encode_results(
+            {u"version": 1}, [{u"a": 1}], BSON_TYPE
+        )
+        self.assertEqual(
+            {u"version": 1, u"results": [{u"a": 1}]},
+            BSON(self.successResultOf(d)).decode(),
+        )
+
+    def test_msgpack(self):
+        """
+        MessagePack documents are decoded and the results can be encoded
+        with it.
+        """
+        data = msgpack.packb([{u"a": 1}], use_bin_type=True)
+        self.assertEqual(
+            [{u"a": 1}],
+            self.successResultOf(
+                self.codec.decode(data, content_type=MSGPACK, many=True)
+            ),
+        )
+        d = self.codec.encode_results({u"version": 1}, [], MSGPACK)
+        self.assertEqual(
+            {u"version": 1, u"results": []},
+            msgpack.unpackb(self.successResultOf(d), raw=False),
+        )
+
+    if msgpack is None:
+        test_msgpack.skip = "msgpack is not installed"
+
+    def test_msgpack_binary(self):
+        """
+        Decoding fails with ``ValueError`` for MessagePack documents with
+        binary values or keys, which are not JSON compatible.
+        """
+        for document in ({u"a": b"\xff"}, {b"a": 1}):
+            data = msgpack.packb(document, use_bin_type=True)
+            self.failureResultOf(
+                self.codec.decode(data, content_type=MSGPACK), ValueError
+            )
+
+    if msgpack is None:
+        test_msgpack_binary.skip = "msgpack is not installed"
+
+    def test_request_format(self):
+        """
+        The format of a request body is given by its content type, and is
+        JSON for unsupported or missing content types.
+        """
+        self.assertEqual(
+            [BSON_TYPE, JSON, JSON],
+            map(request_format,
+                [b"Application/BSON; x=y", b"text/plain", None]),
+        )
+
+    def test_response_format(self):
+        """
+        The format of a response is the first supported content type in
+        the Accept header, or JSON.
+        """
+        self.assertEqual(
+            [BSON_TYPE, JSON, JSON],
+            map(response_format,
+                [b"text/html, application/bson;q=0.9, */*", b"*/*", None]),
+        )
@@ -0,0 +1,89 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.dedup import DedupIndex, InProgress, KeyReused, fingerprint
+
+
+class FingerprintTests(SynchronousTestCase):
+    """
+    Tests for ``fingerprint``.
+    """
+    def test_order(self):
+        """
+        The fingerprint does not depend on the order of the fields.
+        """
+        self.assertEqual(
+            fingerprint(b"/a", {u"x": 1, u"y": 2}),
+            fingerprint(b"/a", {u"y": 2, u"x": 1}),
+        )
+
+    def test_path(self):
+        """
+        The same results submitted to different paths have different
+        fingerprints.
+        """
+        self.assertNotEqual(
+            fingerprint(b"/a", [{u"x": 1}]), fingerprint(b"/b", [{u"x": 1}])
+        )
+
+
+class DedupIndexTests(SynchronousTestCase):
+    """
+    Tests for ``DedupIndex``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.index = DedupIndex(self.clock, expiry=10, max_size=3)
+
+    def test_claim(self):
+        """
+        A key is claimed once, and the value it is completed with is found
+        by the later claims.
+        """
+        self.assertIs(None, self.successResultOf(self.index.claim("k", "f")))
+        self.failureResultOf(self.index.claim("k", "f"), InProgress)
+        self.successResultOf(self.index.complete("k", ["id"]))
+        self.assertEqual(
+            ["id"], self.successResultOf(self.index.claim("k", "f"))
+        )
+
+    def test_reused(self):
+        """
+        A claim of a key with a different fingerprint fails.
+        """
+        self.index.claim("k", "f")
+        self.index.complete("k", ["id"])
+        self.failureResultOf(self.index.claim("k", "g"), KeyReused)
+
+    def test_release(self):
+        """
+        A released key can be claimed again.
+        """
+        self.index.claim("k", "f")
+        self.successResultOf(self.index.release("k"))
+        self.assertIs(None, self.successResultOf(self.index.claim("k", "f")))
+
+    def test_expiry(self):
+        """
+        The keys expire after the expiry time.
+        """
+        self.index.claim("k", "f")
+        self.index.complete("k", ["id"])
+        self.clock.advance(9)
+        self.index.claim("l", "f")
+        self.clock.advance(1)
+        self.assertIs(None, self.successResultOf(self.index.claim("k", "f")))
+        self.assertEqual(2, len(self.index))
+
+    def test_max_size(self):
+        """
+        The oldest keys are dropped when there are too many keys.
+        """
+        for key in "abcd":
+            self.index.claim(key, "f")
+            self.index.complete(key, [key])
+        self.assertEqual(3, len(self.index))
+        self.assertIs(None, self.successResultOf(self.index.claim("a", "f")))
+        self.assertEqual(
+            ["d"], self.successResultOf(self.index.claim("d", "f"))
+        )
@@ -0,0 +1,272 @@
+from datetime import datetime
+from json import loads
+from math import isnan
+from struct import unpack_from
+
+from twisted.internet.defer import CancelledError, fail
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.export import (
+    COLUMNAR_MAGIC, CSVEncoder, ColumnarEncoder, Exporter, NDJSONEncoder,
+    read_columnar
+)
+from benchmark.httpapi import InMemoryBackend
+
+
+def result(second, branch=u"master", value=1, **userdata):
+    userdata[u"branch"] = branch
+    return {
+        u"timestamp": u"2016-01-01T00:00:{:02d}".format(second),
+        u"result": value,
+        u"userdata": userdata,
+    }
+
+
+def rows(*results):
+    return [
+        (datetime(2016, 1, 1, 0, 0, int(r[u"timestamp"][-2:])), r)
+        for r in results
+    ]
+
+
+class EncoderTests(SynchronousTestCase):
+    """
+    Tests for the encoders of the exports.
+    """
+    def test_ndjson(self):
+        """
+        ``NDJSONEncoder`` encodes a result per line.
+        """
+        results = [result(1), result(2)]
+        encoder = NDJSONEncoder()
+        data = encoder.header() + encoder.encode(rows(*results))
+        data += encoder.footer()
+        self.assertEqual(results, map(loads, data.splitlines()))
+
+    def test_csv(self):
+        """
+        ``CSVEncoder`` writes the userdata fields of the first batch as
+        the columns.  Missing values are empty and values other than
+        strings are encoded as JSON.
+        """
+        encoder = CSVEncoder()
+        data = encoder.encode(rows(result(1, host=u"a"), result(2)))
+        data += encoder.encode(rows(result(3, value=2.5, host=[1])))
+        data += encoder.footer()
+        self.assertEqual(
+            b"timestamp,result,branch,host\r\n"
+            b"2016-01-01T00:00:01,1,master,a\r\n"
+            b"2016-01-01T00:00:02,1,master,\r\n"
+            b"2016-01-01T00:00:03,2.5,master,[1]\r\n",
+            data,
+        )
+
+    def test_csv_empty(self):
+        """
+        An export without results has just the header.
+        """
+        encoder = CSVEncoder([u"host"])
+        self.assertEqual(
+            b"timestamp,result,host\r\n", encoder.header() + encoder.footer()
+        )
+
+    def test_columnar(self):
+        """
+        ``ColumnarEncoder`` batches can be read back, with the userdata
+        values decoded from their dictionaries.
+        """
+        encoder = ColumnarEncoder()
+        data = encoder.header()
+        data += encoder.encode(rows(
+            result(1, host=u"a"), result(2, value=u"x", host=u"b"),
+            result(3, host=u"a"),
+        ))
+        data += encoder.encode(rows(result(4, branch=u"other")))
+        data += encoder.footer()
+        [first, second] = read_columnar(data)
+        self.assertEqual(
+            [1451606401000000, 1451606402000000, 1451606403000000],
+            first['timestamp'],
+        )
+        self.assertEqual(1.0, first['result'][0])
+        self.assertTrue(isnan(first['result'][1]))
+        self.assertEqual(
+            {u"branch": [u"master"] * 3, u"host": [u"a", u"b", u"a"]},
+            first['userdata'],
+        )
+        self.assertEqual({u"branch": [u"other"]}, second['userdata'])
+
+    def test_columnar_aligned(self):
+        """
+        The arrays of the columnar format are aligned to 8 bytes and the
+        values of the columns are dictionary encoded.
+        """
+        encoder = ColumnarEncoder([u"host"])
+        data = encoder.header() + encoder.encode(rows(
+            result(1, host=u"a"), result(2), result(3, host=u"a"),
+        ))
+        self.assertEqual(COLUMNAR_MAGIC, data[:8])
+        self.assertEqual((3, 1), unpack_from('<II', data, 8))
+        # The column name and its dictionary of one value.
+        offset = 16 + 4 + len(b"host") + 4 + 4 + len(b'"a"')
+        offset += -offset % 8
+        self.assertEqual(
+            (1451606401000000,), unpack_from('<q', data, offset)
+        )
+        self.assertEqual(
+            (0, -1, 0), unpack_from('<3i', data, offset + 2 * 8 * 3)
+        )
+        self.assertEqual(0, len(data) % 8)
+
+
+class FakeTransport(object):
+    aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+
+class FakeRequest(object):
+    """
+    A request that records what is written to it and optionally pauses
+    its producer on every write.
+    """
+    def __init__(self, pause=False):
+        self.pause = pause
+        self.written = []
+        self.producer = None
+        self.transport = FakeTransport()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+        if self.pause:
+            self.producer.pauseProducing()
+
+
+class CountingBackend(InMemoryBackend):
+    """
+    A backend that counts the pages read from it and fails the pages
+    after the given number.
+    """
+    def __init__(self, fail_after=None):
+        super(CountingBackend, self).__init__()
+        self.pages = 0
+        self.fail_after = fail_after
+
+    def page(self, *args, **kwargs):
+        self.pages += 1
+        if self.fail_after is not None and self.pages > self.fail_after:
+            return fail(RuntimeError("broken"))
+        return super(CountingBackend, self).page(*args, **kwargs)
+
+
+class ExporterTests(SynchronousTestCase):
+    """
+    Tests for ``Exporter``.
+    """
+    def setUp(self):
+        self.results = [result(second) for second in range(10)]
+
+    def export(self, backend, request, **kwargs):
+        backend.store_many(self.results)
+        exporter = Exporter(
+            backend, request, NDJSONEncoder(), {}, page_size=3, **kwargs
+        )
+        return exporter.export()
+
+    def exported(self, request):
+        return map(loads, b''.join(request.written).splitlines())
+
+    def test_export(self):
+        """
+        All the results are written from the latest to the oldest.
+        """
+        backend = CountingBackend()
+        request = FakeRequest()
+        self.successResultOf(self.export(backend, request))
+        self.assertEqual(self.results[::-1], self.exported(request))
+        self.assertEqual(4, backend.pages)
+        self.assertIs(None, request.producer)
+
+    def test_range_and_limit(self):
+        """
+        Only the results in the range are written, up to the limit, and no
+        more pages are read than needed.
+        """
+        backend = CountingBackend()
+        request = FakeRequest()
+        self.successResultOf(self.export(
+            backend, request, start=datetime(2016, 1, 1, 0, 0, 2),
+            end=datetime(2016, 1, 1, 0, 0, 8), limit=4,
+        ))
+        self.assertEqual(self.results[7:3:-1], self.exported(request))
+        self.assertEqual(2, backend.pages)
+
+    def test_end(self):
+        """
+        The first page starts at the end of the range, so the later results
+        are not read.
+        """
+        backend = CountingBackend()
+        request = FakeRequest()
+        self.successResultOf(self.export(
+            backend, request, end=datetime(2016, 1, 1, 0, 0, 4),
+        ))
+        self.assertEqual(self.results[3::-1], self.exported(request))
+        self.assertEqual(2, backend.pages)
+
+    def test_backpressure(self):
+        """
+        The next page is not read until the paused request resumes the
+        export.
+        """
+        backend = CountingBackend()
+        request = FakeRequest(pause=True)
+        d = self.export(backend, request)
+        self.assertEqual(1, backend.pages)
+        request.producer.resumeProducing()
+        self.assertEqual(2, backend.pages)
+        request.pause = False
+        request.producer.resumeProducing()
+        self.successResultOf(d)
+        self.assertEqual(self.results[::-1], self.exported(request))
+
+    def test_stop(self):
+        """
+        No more pages are read once the export is stopped.
+        """
+        backend = CountingBackend()
+        request = FakeRequest(pause=True)
+        d = self.export(backend, request)
+        producer = request.producer
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        producer.resumeProducing()
+        self.assertEqual(1, backend.pages)
+
+    def test_first_page_fails(self):
+        """
+        The export fails if the first page can not be read.
+        """
+        request = FakeRequest()
+        self.failureResultOf(
+            self.export(CountingBackend(fail_after=0), request), RuntimeError
+        )
+        self.assertEqual([], request.written)
+
+    def test_later_page_fails(self):
+        """
+        The connection is aborted if a page fails after the export has
+        started.
+        """
+        request = FakeRequest()
+        d = self.export(CountingBackend(fail_after=1), request)
+        self.assertNoResult(d)
+        self.assertTrue(request.transport.aborted)
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
@@ -1,15 +1,26 @@
+import sys
+
+from base64 import urlsafe_b64encode
 from datetime import datetime
 from json import dumps, loads
+from os.path import dirname
+from runpy import run_module
+from subprocess import check_output
 from urllib import urlencode
 from urlparse import urljoin
 
 from twisted.application.internet import StreamServerEndpointService
 from twisted.internet import endpoints
-from twisted.internet.defer import Deferred, succeed
+from twisted.internet.defer import Deferred, gatherResults, succeed
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
 from twisted.web import client, http, server
+from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 
+from dateutil.tz import tzoffset
+
 from testtools import TestCase
 from testtools.deferredruntest import (
     AsynchronousDeferredRunTest, flush_logged_errors
@@ -17,7 +28,17 @@ from testtools.deferredruntest import (
 
 from zope.interface import implementer
 
-from benchmark.httpapi import BenchmarkAPI_V1, InMemoryBackend, BadRequest
+from bson import BSON
+
+import benchmark
+from benchmark.codec import JSONCodec
+from benchmark.export import read_columnar
+from benchmark.httpapi import (
+    BenchmarkAPI_V1, InMemoryBackend, BadRequest, BadResultId, HTTPBackend,
+    ResultFeed, ResultNotFound, RoutingBackend, ServerOptions,
+    ShardedInMemoryBackend, _make_id, _merge_descending, _project,
+    load_backend
+)
 
 
 @implementer(IBodyProducer)
@@ -73,8 +94,8 @@ class BenchmarkAPITestsMixin(object):
     def setUp(self):
         super(BenchmarkAPITestsMixin, self).setUp()
 
-        api = BenchmarkAPI_V1(self.backend)
-        site = server.Site(api.app.resource())
+        self.api = self.make_api()
+        site = server.Site(self.api.app.resource())
 
         def make_client(listening_port):
             addr = listening_port.getHost()
@@ -95,6 +116,12 @@ class BenchmarkAPITestsMixin(object):
         self.addCleanup(self.service.stopService)
         return listening
 
+    def make_api(self):
+        """
+        Create the API under test.
+        """
+        return BenchmarkAPI_V1(self.backend, self.reactor)
+
     def submit(self, result):
         """
         Submit a result.
@@ -142,6 +169,16 @@ class BenchmarkAPITestsMixin(object):
         req.addCallback(self.check_response_code, http.CREATED)
         return req
 
+    def test_submit_branch_not_string(self):
+        """
+        A result whose branch is not a string can be submitted.
+        """
+        req = self.submit(
+            dict(self.RESULT, userdata={u"branch": [u"a", u"b"]})
+        )
+        req.addCallback(self.check_response_code, http.CREATED)
+        return req
+
     def test_no_timestamp(self):
         """
         Valid JSON with a missing timestamp is an HTTP BAD_REQUEST.
@@ -160,6 +197,18 @@ class BenchmarkAPITestsMixin(object):
         req.addCallback(lambda _: flush_logged_errors(BadRequest))
         return req
 
+    def test_timestamp_out_of_range(self):
+        """
+        A timestamp that is out of range once in UTC is an HTTP
+        BAD_REQUEST.
+        """
+        req = self.submit(
+            dict(self.RESULT, timestamp=u"9999-12-31T23:59:59-01:00")
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
     def test_submit_response_format(self):
         """
         Returned content is the expected JSON.
@@ -240,6 +289,27 @@ class BenchmarkAPITestsMixin(object):
         req.addCallback(retrieve_twice)
         return req
 
+    def test_get_with_fields(self):
+        """
+        Only the requested fields of a result are returned if the fields
+        are specified.
+        """
+        req = self.submit(self.RESULT)
+
+        def retrieve(response):
+            location = response.headers.getRawHeaders(b'Location')[0]
+            return self.agent.request(
+                "GET", location + "?fields=userdata.branch,result"
+            )
+
+        req.addCallback(retrieve)
+        req.addCallback(self.check_response_code, http.OK)
+        req.addCallback(
+            self.check_received_result,
+            {u"userdata": {u"branch": u"master"}, u"result": 1},
+        )
+        return req
+
     def test_get_nonexistent(self):
         """
         Getting non-existent resource is correctly handled.
@@ -521,8 +591,1689 @@ class BenchmarkAPITestsMixin(object):
         d.addCallback(lambda _: flush_logged_errors(BadRequest))
         return d
 
+    def get_pages(self, ignored, filter=None, limit=None):
+        """
+        Query the results of the HTTP API page by page.
 
-class InMemoryBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
-    def setUp(self):
-        self.backend = InMemoryBackend()
-        super(InMemoryBenchmarkAPITests, self).setUp()
+        :param dict filter: The data that the results must include.
+        :param int limit: The size of a page.
+        :return: Deferred that fires with a list of the results of every
+            page.
+        """
+        pages = []
+
+        def get_page(cursor):
+            query = {u"cursor": cursor}
+            if filter:
+                query.update(filter)
+            if limit is not None:
+                query["limit"] = limit
+            req = self.agent.request(
+                "GET", "/benchmark-results?" + urlencode(query)
+            )
+            req.addCallback(self.check_response_code, http.OK)
+            req.addCallback(client.readBody)
+            req.addCallback(got_page)
+            return req
+
+        def got_page(body):
+            data = loads(body)
+            self.assertEqual(len(data['ids']), len(data['results']))
+            pages.append(data['results'])
+            if data['next'] is None:
+                return pages
+            return get_page(data['next'])
+
+        return get_page(u"")
+
+    def test_query_pages(self):
+        """
+        Paging returns all results in the order of ``query``, ``limit``
+        results at a time.
+        """
+        d = self.setup_results()
+        d.addCallback(self.get_pages, limit=3)
+        d.addCallback(
+            self.assertEqual,
+            [[self.BRANCH2_RESULT2, self.BRANCH1_RESULT2,
+              self.BRANCH2_RESULT1],
+             [self.BRANCH1_RESULT1]],
+        )
+        return d
+
+    def test_query_pages_with_filter(self):
+        """
+        Paging returns only the matching results if a filter is given.
+        """
+        d = self.setup_results()
+        d.addCallback(self.get_pages, filter={u"branch": u"1"}, limit=1)
+        d.addCallback(
+            self.assertEqual,
+            [[self.BRANCH1_RESULT2], [self.BRANCH1_RESULT1]],
+        )
+        return d
+
+    def test_query_bad_cursor(self):
+        """
+        ``query`` raises ``BadRequest`` when the cursor is not valid.
+        """
+        d = self.setup_results()
+        d.addCallback(
+            lambda _: self.agent.request(
+                "GET", "/benchmark-results?cursor=nonsense"
+            )
+        )
+        d.addCallback(self.check_response_code, http.BAD_REQUEST)
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return d
+
+    def submit_many(self, results):
+        """
+        Submit several results with one request.
+        """
+        req = self.agent.request(
+            "POST", "/benchmark-results/bulk",
+            bodyProducer=StringProducer(dumps(results)),
+        )
+
+        def add_cleanup(response):
+            if response.code != http.CREATED:
+                return response
+            d = client.readBody(response)
+            d.addCallback(loads)
+
+            def delete_all(data):
+                ids = [id.encode('ascii') for id in data['ids']]
+                for id in ids:
+                    self.addCleanup(
+                        self.agent.request, "DELETE",
+                        "/benchmark-results/" + id,
+                    )
+                return ids
+
+            d.addCallback(delete_all)
+            return d
+
+        req.addCallback(self.check_response_code, http.CREATED)
+        req.addCallback(add_cleanup)
+        return req
+
+    def test_submit_many(self):
+        """
+        Results submitted with one request are stored and get an
+        identifier each.
+        """
+        results = [
+            self.BRANCH2_RESULT1, self.BRANCH1_RESULT1, self.BRANCH2_RESULT2,
+        ]
+        d = self.submit_many(results)
+
+        def check_ids(ids):
+            self.assertEqual(len(results), len(set(ids)))
+            retrieved = [
+                self.agent.request("GET", "/benchmark-results/" + id)
+                for id in ids
+            ]
+            return gatherResults(retrieved)
+
+        def check_results(responses):
+            d = gatherResults(
+                [client.readBody(response) for response in responses]
+            )
+            d.addCallback(
+                lambda bodies: self.assertEqual(results, map(loads, bodies))
+            )
+            return d
+
+        d.addCallback(check_ids)
+        d.addCallback(check_results)
+        return d
+
+    def test_submit_many_bad_timestamp(self):
+        """
+        ``BadRequest`` is raised and nothing is stored if one of the
+        submitted results has an invalid timestamp.
+        """
+        req = self.agent.request(
+            "POST", "/benchmark-results/bulk",
+            bodyProducer=StringProducer(
+                dumps([self.RESULT, self.BAD_TIMESTAMP])
+            ),
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        req.addCallback(self.run_query)
+        req.addCallback(self.check_query_result, expected_results=[])
+        return req
+
+    def test_query_with_fields(self):
+        """
+        Only the requested fields of the results are returned if the
+        fields are specified.
+        """
+        d = self.setup_results()
+        d.addCallback(
+            self.run_query, filter={u"fields": u"value,userdata.branch"},
+            limit=3,
+        )
+        d.addCallback(
+            self.check_query_result,
+            expected_results=[
+                {u"userdata": {u"branch": u"2"}, u"value": 110},
+                {u"userdata": {u"branch": u"1"}, u"value": 120},
+                {u"userdata": {u"branch": u"2"}, u"value": 110},
+            ],
+        )
+        return d
+
+    def submit_keyed(self, body, key=None, path="/benchmark-results"):
+        """
+        Submit results with an idempotency key.
+
+        :return: A Deferred that fires with the response and its body.
+        """
+        headers = Headers()
+        if key is not None:
+            headers.setRawHeaders(b"idempotency-key", [key])
+        req = self.agent.request(
+            "POST", path, headers, StringProducer(dumps(body))
+        )
+
+        def read(response):
+            d = client.readBody(response)
+            d.addCallback(lambda body: (response, loads(body)))
+            return d
+
+        def add_cleanup(submitted):
+            response, data = submitted
+            if response.code == http.CREATED:
+                for id in data.get('ids', [data.get('id')]):
+                    self.addCleanup(
+                        self.agent.request, "DELETE",
+                        "/benchmark-results/" + id.encode('ascii'),
+                    )
+            return submitted
+
+        req.addCallback(read)
+        req.addCallback(add_cleanup)
+        return req
+
+    def test_submit_idempotent(self):
+        """
+        A submission repeated with the same idempotency key is answered
+        with the identifier of the result stored the first time, without
+        storing it again.
+        """
+        req = self.submit_keyed(self.RESULT, b"key-1")
+
+        def repeat(first):
+            response, data = first
+            self.assertEqual(
+                None, response.headers.getRawHeaders(b"idempotent-replayed")
+            )
+            d = self.submit_keyed(self.RESULT, b"key-1")
+            d.addCallback(check, data['id'])
+            return d
+
+        def check(second, id):
+            response, data = second
+            self.check_response_code(response, http.CREATED)
+            self.assertEqual(
+                ([b"true"], id),
+                (response.headers.getRawHeaders(b"idempotent-replayed"),
+                 data['id']),
+            )
+
+        req.addCallback(repeat)
+        req.addCallback(self.run_query)
+        req.addCallback(self.check_query_result, [self.RESULT])
+        return req
+
+    def test_submit_many_idempotent(self):
+        """
+        A bulk submission repeated with the same idempotency key is stored
+        once.
+        """
+        results = [self.BRANCH1_RESULT1, self.BRANCH2_RESULT1]
+        path = "/benchmark-results/bulk"
+        req = self.submit_keyed(results, b"key-1", path)
+
+        def repeat(first):
+            d = self.submit_keyed(results, b"key-1", path)
+            d.addCallback(lambda second: self.assertEqual(first[1], second[1]))
+            return d
+
+        req.addCallback(repeat)
+        req.addCallback(self.run_query)
+        req.addCallback(self.check_query_result, results[::-1])
+        return req
+
+    def test_submit_key_reused(self):
+        """
+        A submission with the idempotency key of a different submission
+        is a bad request.
+        """
+        req = self.submit_keyed(self.RESULT, b"key-1")
+        req.addCallback(
+            lambda _: self.submit_keyed(self.BRANCH1_RESULT1, b"key-1")
+        )
+        req.addCallback(
+            lambda submitted:
+            self.check_response_code(submitted[0], http.BAD_REQUEST)
+        )
+        return req
+
+    def test_submit_key_invalid(self):
+        """
+        A submission with an idempotency key that is empty, too long or
+        not UTF-8 text is a bad request.
+        """
+        keys = [b"", b"k" * (self.api.max_key_length + 1), b"key-\xff"]
+        d = gatherResults([
+            self.submit_keyed(self.RESULT, key).addCallback(
+                lambda submitted:
+                self.check_response_code(submitted[0], http.BAD_REQUEST)
+            )
+            for key in keys
+        ])
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return d
+
+    def test_submit_content_keys(self):
+        """
+        Identical submissions are stored once if they are keyed by their
+        content.
+        """
+        self.api.content_keys = True
+        req = self.submit_keyed(self.RESULT)
+
+        def repeat(first):
+            d = self.submit_keyed(self.RESULT)
+            d.addCallback(lambda second: self.assertEqual(first[1], second[1]))
+            return d
+
+        req.addCallback(repeat)
+        req.addCallback(self.run_query)
+        req.addCallback(self.check_query_result, [self.RESULT])
+        return req
+
+    def test_submit_bson(self):
+        """
+        A result can be submitted as BSON and queried as BSON.
+        """
+        req = self.agent.request(
+            "POST", "/benchmark-results",
+            Headers({b"content-type": [b"application/bson"]}),
+            StringProducer(BSON.encode(self.RESULT)),
+        )
+        req.addCallback(self.check_response_code, http.CREATED)
+
+        def query(response):
+            location = response.headers.getRawHeaders(b'Location')[0]
+            self.addCleanup(lambda: self.agent.request("DELETE", location))
+            return self.agent.request(
+                "GET", "/benchmark-results",
+                Headers({b"accept": [b"application/bson, */*"]}),
+            )
+
+        req.addCallback(query)
+
+        def check(response):
+            self.assertEqual(
+                [b"application/bson"],
+                response.headers.getRawHeaders(b"content-type"),
+            )
+            d = client.readBody(response)
+            d.addCallback(lambda body: BSON(body).decode()['results'])
+            return d
+
+        req.addCallback(check)
+        req.addCallback(self.assertEqual, [self.RESULT])
+        return req
+
+    def test_submit_many_bson(self):
+        """
+        Several results can be submitted as a sequence of BSON documents.
+        """
+        req = self.agent.request(
+            "POST", "/benchmark-results/bulk",
+            Headers({b"content-type": [b"application/bson"]}),
+            StringProducer(
+                BSON.encode(self.BRANCH1_RESULT1) +
+                BSON.encode(self.BRANCH2_RESULT1)
+            ),
+        )
+        req.addCallback(self.check_response_code, http.CREATED)
+        req.addCallback(client.readBody)
+
+        def delete_all(body):
+            for id in loads(body)['ids']:
+                self.addCleanup(
+                    self.agent.request, "DELETE",
+                    "/benchmark-results/" + id.encode('ascii'),
+                )
+
+        req.addCallback(delete_all)
+        req.addCallback(self.run_query)
+        req.addCallback(
+            self.check_query_result,
+            expected_results=[self.BRANCH2_RESULT1, self.BRANCH1_RESULT1],
+        )
+        return req
+
+    def test_submit_bad_bson(self):
+        """
+        Submitting data that is not BSON with the BSON content type is a
+        bad request.
+        """
+        req = self.agent.request(
+            "POST", "/benchmark-results",
+            Headers({b"content-type": [b"application/bson"]}),
+            StringProducer(dumps(self.RESULT)),
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
+    def test_submit_integer_out_of_range(self):
+        """
+        Results with integers that BSON and MessagePack can not encode, down
+        to their subdocuments, are bad requests, alone or in bulk, and are
+        not stored.
+        """
+        results = [
+            dict(self.RESULT, value=2 ** 63),
+            dict(self.RESULT, userdata={u"count": [-2 ** 63 - 1]}),
+        ]
+        d = gatherResults(
+            [self.submit(result) for result in results] +
+            [self.agent.request(
+                "POST", "/benchmark-results/bulk",
+                bodyProducer=StringProducer(dumps(results)),
+            )]
+        )
+        d.addCallback(
+            lambda responses: [
+                self.check_response_code(response, http.BAD_REQUEST)
+                for response in responses
+            ]
+        )
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        d.addCallback(self.run_query)
+        d.addCallback(self.check_query_result, expected_results=[])
+        return d
+
+    def test_query_latest(self):
+        """
+        Only the latest result of every branch is returned if the results
+        are grouped by the branch.
+        """
+        d = self.setup_results()
+        d.addCallback(self.run_query, filter={u"latest": u"branch"})
+        d.addCallback(
+            self.check_query_result,
+            expected_results=[self.BRANCH2_RESULT2, self.BRANCH1_RESULT2],
+        )
+        return d
+
+    def test_query_latest_with_fields(self):
+        """
+        The latest results of the groups are limited and only have the
+        requested fields.
+        """
+        d = self.setup_results()
+        d.addCallback(
+            self.run_query, filter={u"latest": u"branch", u"fields": u"value"},
+            limit=1,
+        )
+        d.addCallback(
+            self.check_query_result, expected_results=[{u"value": 110}],
+        )
+        return d
+
+    def test_query_latest_filtered(self):
+        """
+        The latest matching result of every group is returned, even if a
+        later result of the group does not match the filter.
+        """
+        # The branch filter matches the whole userdata of the results.
+        results = [
+            self.BRANCH1_RESULT1,
+            dict(self.BRANCH2_RESULT2,
+                 userdata={u"branch": u"1", u"host": u"a"}),
+        ]
+        d = self.submit_many(results)
+        d.addCallback(
+            self.run_query, filter={u"branch": u"1", u"latest": u"branch"}
+        )
+        d.addCallback(self.check_query_result, expected_results=[results[0]])
+        return d
+
+    def test_query_latest_by_missing_field(self):
+        """
+        The results without the field they are grouped by are skipped.
+        """
+        d = self.setup_results()
+        d.addCallback(self.run_query, filter={u"latest": u"host"})
+        d.addCallback(self.check_query_result, expected_results=[])
+        return d
+
+    def test_query_latest_bad_field(self):
+        """
+        ``query`` raises ``BadRequest`` when the results are grouped by
+        something that is not a userdata field.
+        """
+        d = self.run_query(None, filter={u"latest": u"a.b"})
+        d.addCallback(self.check_response_code, http.BAD_REQUEST)
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return d
+
+    def test_query_pages_with_fields(self):
+        """
+        Only the requested fields of the results are returned in the
+        pages if the fields are specified.
+        """
+        d = self.setup_results()
+        d.addCallback(self.get_pages, filter={u"fields": u"value"}, limit=3)
+        d.addCallback(
+            self.assertEqual,
+            [[{u"value": 110}, {u"value": 120}, {u"value": 110}],
+             [{u"value": 100}]],
+        )
+        return d
+
+    def test_query_invalid_fields(self):
+        """
+        ``query`` raises ``BadRequest`` when a field is not valid.
+        """
+        d = self.setup_results()
+        d.addCallback(self.run_query, filter={u"fields": u"value,$where"})
+        d.addCallback(self.check_response_code, http.BAD_REQUEST)
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return d
+
+    def get_export(self, ignored, **args):
+        """
+        Invoke the export interface of the HTTP API.
+
+        :return: Deferred that fires with the content type and the body of
+            the response.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/export?" + urlencode(args)
+        )
+        req.addCallback(self.check_response_code, http.OK)
+
+        def read(response):
+            [content_type] = response.headers.getRawHeaders(b'content-type')
+            d = client.readBody(response)
+            d.addCallback(lambda body: (content_type, body))
+            return d
+
+        req.addCallback(read)
+        return req
+
+    def test_export_ndjson(self):
+        """
+        The matching results are exported as NDJSON by default, from the
+        latest to the oldest.
+        """
+        d = self.setup_results()
+        d.addCallback(self.get_export, branch=u"1")
+
+        def check(response):
+            content_type, body = response
+            self.assertEqual(b'application/x-ndjson', content_type)
+            self.assertEqual(
+                [self.BRANCH1_RESULT2, self.BRANCH1_RESULT1],
+                map(loads, body.splitlines()),
+            )
+
+        d.addCallback(check)
+        return d
+
+    def test_export_csv_range(self):
+        """
+        The results in the given range of timestamps are exported as CSV.
+        """
+        d = self.setup_results()
+        d.addCallback(
+            self.get_export, format=u"csv",
+            start=datetime(2016, 1, 1, 0, 0, 6).isoformat(),
+            end=datetime(2016, 1, 1, 0, 0, 8).isoformat(),
+        )
+        d.addCallback(
+            self.assertEqual,
+            (b'text/csv; charset=utf-8',
+             b"timestamp,result,branch\r\n"
+             b"2016-01-01T00:00:07,,1\r\n"
+             b"2016-01-01T00:00:06,,2\r\n"),
+        )
+        return d
+
+    def test_export_columnar(self):
+        """
+        The results are exported in the binary columnar format.
+        """
+        d = self.setup_results()
+        d.addCallback(self.get_export, format=u"columnar", limit=3)
+
+        def check(response):
+            content_type, body = response
+            self.assertEqual(b'application/octet-stream', content_type)
+            [batch] = read_columnar(body)
+            self.assertEqual(
+                {u"branch": [u"2", u"1", u"2"]}, batch['userdata']
+            )
+
+        d.addCallback(check)
+        return d
+
+    def test_export_unknown_format(self):
+        """
+        ``export`` raises ``BadRequest`` when the format is not known.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/export?format=xml"
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
+    def get_percentiles(self, ignored, **args):
+        """
+        Invoke the percentiles interface of the HTTP API.
+
+        :return: Deferred that fires with the decoded response body.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/percentiles?" + urlencode(args)
+        )
+        req.addCallback(self.check_response_code, http.OK)
+        req.addCallback(client.readBody)
+        req.addCallback(loads)
+        return req
+
+    def test_percentiles(self):
+        """
+        The percentiles of the values of the results of a branch in a range
+        of days are estimated within 1%.
+        """
+        def result(branch, day, value):
+            return {u"userdata": {u"branch": branch}, u"result": value,
+                    u"timestamp": datetime(2016, 1, day).isoformat()}
+
+        results = [result(u"1", 1, value) for value in range(1, 51)]
+        results += [result(u"2", 1, 1000), result(u"1", 3, 1000)]
+        d = self.submit_many(results)
+        d.addCallback(
+            self.get_percentiles, branch=u"1", q=u"50,99",
+            end=datetime(2016, 1, 2).isoformat(),
+        )
+
+        def check(data):
+            self.assertEqual(50, data['count'])
+            self.assertEqual([u"50", u"99"], sorted(data['percentiles']))
+            # The estimates are within 1% of the values at the ranks.
+            self.assertTrue(abs(data['percentiles']['50'] - 25) <= 0.25)
+            self.assertTrue(abs(data['percentiles']['99'] - 49) <= 0.49)
+
+        d.addCallback(check)
+        return d
+
+    def test_percentiles_not_finite(self):
+        """
+        The results with infinite or NaN values, which the JSON decoder
+        accepts, are stored but left out of the percentiles.
+        """
+        results = [dict(self.RESULT, result=value)
+                   for value in (float('inf'), float('nan'), 1)]
+        d = self.submit_many(results)
+        d.addCallback(lambda ids: self.assertEqual(3, len(ids)))
+        d.addCallback(self.get_percentiles, q=u"50")
+        d.addCallback(
+            lambda data: self.assertEqual(
+                (1, {u"50": 1}), (data['count'], data['percentiles'])
+            )
+        )
+        return d
+
+    def test_percentiles_empty(self):
+        """
+        There are no percentiles without results.
+        """
+        d = self.get_percentiles(None, q=u"50")
+        d.addCallback(
+            self.assertEqual,
+            {u"version": 1, u"count": 0, u"percentiles": {u"50": None}},
+        )
+        return d
+
+    def test_percentiles_invalid(self):
+        """
+        ``percentiles`` raises ``BadRequest`` when a percentile is not
+        between 0 and 100.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/percentiles?q=50,101"
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
+    def test_timestamp_args_out_of_range(self):
+        """
+        Timestamp arguments that overflow, in the parser or once in UTC,
+        are bad requests.
+        """
+        d = gatherResults([
+            self.agent.request(
+                "GET", path + "?" + urlencode(args)
+            ).addCallback(self.check_response_code, http.BAD_REQUEST)
+            for path in ("/benchmark-results/export",
+                         "/benchmark-results/percentiles")
+            for args in ({u"start": u"9999-12-31T23:00:00-05:00"},
+                         {u"end": u"9" * 30})
+        ])
+        d.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return d
+
+    def get_regressions(self, ignored, **args):
+        """
+        Invoke the regressions interface of the HTTP API.
+
+        :return: Deferred that fires with the decoded response body.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/regressions?" + urlencode(args)
+        )
+        req.addCallback(self.check_response_code, http.OK)
+        req.addCallback(client.readBody)
+        req.addCallback(loads)
+        return req
+
+    def test_regressions(self):
+        """
+        The series whose latest value deviates from the earlier ones are
+        listed with their statistics.
+        """
+        def result(branch, hour, value):
+            return {u"userdata": {u"branch": branch}, u"result": value,
+                    u"timestamp": datetime(2016, 1, 1, hour).isoformat()}
+
+        values = [10, 11, 9, 10, 12, 8, 10, 11, 9, 10]
+        results = [result(u"1", hour, value)
+                   for hour, value in enumerate(values + [20])]
+        results += [result(u"2", hour, value)
+                    for hour, value in enumerate(values)]
+        d = self.submit_many(results)
+        d.addCallback(self.get_regressions)
+
+        def check(data):
+            [series] = data['series']
+            self.assertEqual(
+                ({u"branch": u"1"}, 11, 20, results[10][u"timestamp"]),
+                (series['series'], series['count'], series['latest'],
+                 series['timestamp']),
+            )
+            self.assertTrue(series['zscore'] > 8)
+
+        d.addCallback(check)
+        d.addCallback(self.get_regressions, branch=u"2")
+        d.addCallback(self.assertEqual, {u"version": 1, u"series": []})
+        return d
+
+    def test_regressions_invalid(self):
+        """
+        ``regressions`` raises ``BadRequest`` when the threshold is not a
+        positive number.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/regressions?threshold=0"
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
+    def get_changes(self, ignored, filter=None, since=None, timeout=None):
+        """
+        Invoke the changes interface of the HTTP API.
+
+        :param dict filter: The data that the results must include.
+        :param int since: The position to wait for the changes after.
+        :param int timeout: The number of seconds to wait for changes.
+        :return: Deferred that fires with the decoded response body.
+        """
+        query = {}
+        if filter:
+            query = filter.copy()
+        if since is not None:
+            query["since"] = since
+        if timeout is not None:
+            query["timeout"] = timeout
+        query_string = "?" + urlencode(query, doseq=True)
+        req = self.agent.request(
+            "GET", "/benchmark-results/changes" + query_string
+        )
+        req.addCallback(self.check_response_code, http.OK)
+        req.addCallback(client.readBody)
+        req.addCallback(loads)
+        return req
+
+    def test_changes_without_timeout(self):
+        """
+        Changes are returned immediately with no results if no results
+        were stored after the current position and the timeout is zero.
+        """
+        d = self.get_changes(None, timeout=0)
+
+        def check(data):
+            self.assertEqual(data['version'], 1)
+            self.assertEqual(data['results'], [])
+            self.assertIn('position', data)
+
+        d.addCallback(check)
+        return d
+
+    def test_changes_since(self):
+        """
+        The results stored after the given position are returned
+        immediately, from the oldest to the latest.
+        """
+        d = self.get_changes(None, timeout=0)
+
+        def submit_and_get(data):
+            d = self.setup_results()
+            d.addCallback(
+                self.get_changes, since=data['position'], timeout=0
+            )
+            return d
+
+        d.addCallback(submit_and_get)
+        d.addCallback(
+            lambda data: self.assertEqual(
+                [self.BRANCH2_RESULT1, self.BRANCH1_RESULT1,
+                 self.BRANCH2_RESULT2, self.BRANCH1_RESULT2],
+                data['results'],
+            )
+        )
+        return d
+
+    def test_changes_wait(self):
+        """
+        A pending request for changes fires when a matching result is
+        stored.
+        """
+        d = self.get_changes(None, timeout=0)
+
+        def wait_and_submit(data):
+            changes = self.get_changes(
+                None, filter={u"branch": u"1"}, since=data['position'],
+                timeout=10,
+            )
+            d = self.submit(self.BRANCH2_RESULT1)
+            d.addCallback(lambda _: self.submit(self.BRANCH1_RESULT1))
+            d.addCallback(lambda _: changes)
+            return d
+
+        d.addCallback(wait_and_submit)
+
+        def check(data):
+            self.assertEqual([self.BRANCH1_RESULT1], data['results'])
+
+        d.addCallback(check)
+        return d
+
+    def test_changes_truncated(self):
+        """
+        The changes are flagged as truncated if results stored after the
+        position are no longer retained.
+        """
+        self.api.feed = ResultFeed(self.reactor, size=1)
+        d = self.get_changes(None, timeout=0)
+
+        def submit_and_get(data):
+            d = self.setup_results()
+            d.addCallback(
+                lambda _: gatherResults([
+                    self.get_changes(None, since=since, timeout=10)
+                    for since in (data['position'], self.api.feed.position - 1)
+                ])
+            )
+            return d
+
+        d.addCallback(submit_and_get)
+        d.addCallback(
+            lambda changes: self.assertEqual(
+                [(True, [self.BRANCH1_RESULT2]),
+                 (False, [self.BRANCH1_RESULT2])],
+                [(data['truncated'], data['results']) for data in changes],
+            )
+        )
+        return d
+
+    def test_changes_with_limit(self):
+        """
+        ``changes`` raises ``BadRequest`` when a limit is specified.
+        """
+        req = self.agent.request(
+            "GET", "/benchmark-results/changes?limit=1"
+        )
+        req.addCallback(self.check_response_code, http.BAD_REQUEST)
+        req.addCallback(lambda _: flush_logged_errors(BadRequest))
+        return req
+
+
+class InMemoryBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    def setUp(self):
+        self.backend = InMemoryBackend()
+        super(InMemoryBenchmarkAPITests, self).setUp()
+
+
+class ShardedInMemoryBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    def setUp(self):
+        self.backend = ShardedInMemoryBackend(shards=4)
+        super(ShardedInMemoryBenchmarkAPITests, self).setUp()
+
+
+class RoutingBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    def setUp(self):
+        self.backend = RoutingBackend(
+            {'a': InMemoryBackend(), 'b': InMemoryBackend()}
+        )
+        super(RoutingBenchmarkAPITests, self).setUp()
+
+
+class RoutingHTTPBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    """
+    Tests for BenchmarkAPI with results routed to several other servers.
+    """
+    def setUp(self):
+        backends = {}
+        for name in 'abc':
+            api = BenchmarkAPI_V1(InMemoryBackend(), self.reactor)
+            port = self.reactor.listenTCP(
+                0, server.Site(api.app.resource()), interface='127.0.0.1'
+            )
+            self.addCleanup(port.stopListening)
+            url = 'http://127.0.0.1:{}/'.format(port.getHost().port)
+            backends[name] = HTTPBackend(url, self.reactor)
+        self.backend = RoutingBackend(backends)
+        self.addCleanup(self.backend.disconnect)
+        super(RoutingHTTPBenchmarkAPITests, self).setUp()
+
+
+class OffloadedBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    """
+    Tests for BenchmarkAPI with all bodies processed in the thread pool.
+    """
+    def setUp(self):
+        self.backend = InMemoryBackend()
+        super(OffloadedBenchmarkAPITests, self).setUp()
+
+    def make_api(self):
+        codec = JSONCodec(self.reactor, size_threshold=0, count_threshold=0)
+        return BenchmarkAPI_V1(self.backend, self.reactor, codec=codec)
+
+
+class ScriptBenchmarkAPITests(BenchmarkAPITestsMixin, TestCase):
+    """
+    Tests for BenchmarkAPI run as a script, as ``python -m`` does, with the
+    backend loaded by name.
+    """
+    def setUp(self):
+        # A copy of the module under another name, as ``__main__`` is,
+        # whose exceptions the failures do not match by name.
+        self.script = run_module('benchmark.httpapi', run_name='script')
+        self.backend = self.script['load_backend']('in-memory')()
+        super(ScriptBenchmarkAPITests, self).setUp()
+
+    def make_api(self):
+        return self.script['BenchmarkAPI_V1'](self.backend, self.reactor)
+
+
+class ResultFeedTests(SynchronousTestCase):
+    """
+    Tests for ``ResultFeed``.
+    """
+    def setUp(self):
+        super(ResultFeedTests, self).setUp()
+        self.clock = Clock()
+        self.feed = ResultFeed(self.clock, size=2)
+
+    def test_changes_retained(self):
+        """
+        Only the configured number of the recent results are retained.
+        """
+        for value in range(3):
+            self.feed.publish({u"value": value})
+        self.assertEqual(
+            (3, [{u"value": 1}, {u"value": 2}]),
+            self.feed.changes({}, 0),
+        )
+
+    def test_changes_stale_position(self):
+        """
+        A position beyond the end of the feed is treated as zero.
+        """
+        self.feed.publish({u"value": 1})
+        self.assertEqual((1, [{u"value": 1}]), self.feed.changes({}, 5))
+
+    def test_truncated(self):
+        """
+        The feed is truncated after a position if results published after
+        it are no longer retained.
+        """
+        self.assertFalse(self.feed.truncated(0))
+        for value in range(3):
+            self.feed.publish({u"value": value})
+        self.assertEqual(
+            [True, False, False, True],
+            [self.feed.truncated(since) for since in (0, 1, 3, 5)],
+        )
+
+    def test_wait_truncated(self):
+        """
+        Waiting after a position the feed is truncated after fires
+        immediately, even without matching results.
+        """
+        for value in range(3):
+            self.feed.publish({u"value": value})
+        d = self.feed.wait({u"value": 5}, 0, 10)
+        self.assertEqual((3, []), self.successResultOf(d))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_wait_timeout(self):
+        """
+        Waiting fires with no results after the timeout.
+        """
+        d = self.feed.wait({}, 0, 10)
+        self.clock.advance(10)
+        self.assertEqual((0, []), self.successResultOf(d))
+        self.assertEqual({}, dict(self.feed._waiters))
+
+    def test_wait_published(self):
+        """
+        Waiting fires when a matching result is published and only
+        the waiters for the result's branch are woken up.
+        """
+        result = {u"userdata": {u"branch": u"1"}}
+        branch1 = self.feed.wait(result, 0, 10)
+        branch2 = self.feed.wait({u"userdata": {u"branch": u"2"}}, 0, 10)
+        self.feed.publish(result)
+        self.assertEqual((1, [result]), self.successResultOf(branch1))
+        self.assertNoResult(branch2)
+        self.assertEqual([], self.clock.getDelayedCalls()[1:])
+
+    def test_wait_cancelled(self):
+        """
+        Cancelling a wait forgets the waiter and its timeout.
+        """
+        d = self.feed.wait({}, 0, 10)
+        d.cancel()
+        self.failureResultOf(d)
+        self.assertEqual({}, dict(self.feed._waiters))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class ProjectTests(SynchronousTestCase):
+    """
+    Tests for ``_project``.
+    """
+    DOCUMENT = {
+        u"timestamp": u"2016-01-01T00:00:00",
+        u"userdata": {u"branch": u"master", u"samples": [1, 2, 3]},
+        u"result": 1,
+    }
+
+    def test_all_fields(self):
+        """
+        The document itself is returned if no fields are given.
+        """
+        self.assertIs(self.DOCUMENT, _project(self.DOCUMENT, None))
+
+    def test_fields(self):
+        """
+        Only the given fields are included, with the fields of the
+        subdocuments given by paths.  Missing fields are left out.
+        """
+        self.assertEqual(
+            {u"result": 1, u"userdata": {u"branch": u"master"}},
+            _project(
+                self.DOCUMENT,
+                [u"result", u"userdata.branch", u"missing", u"result.x"],
+            ),
+        )
+
+    def test_shared(self):
+        """
+        The values of the projection are those of the document.
+        """
+        projection = _project(self.DOCUMENT, [u"userdata"])
+        self.assertIs(self.DOCUMENT[u"userdata"], projection[u"userdata"])
+
+    def test_overlapping(self):
+        """
+        A field of a subdocument that is included as a whole does not
+        modify the document.
+        """
+        document = {u"userdata": {u"branch": u"master"}}
+        projection = _project(
+            document, [u"userdata", u"userdata.branch", u"userdata.x.y"]
+        )
+        self.assertEqual({u"userdata": {u"branch": u"master"}}, document)
+        self.assertEqual(document, projection)
+
+
+class MergeDescendingTests(SynchronousTestCase):
+    """
+    Tests for ``_merge_descending``.
+    """
+    def test_merge(self):
+        """
+        The items of all the iterables are produced in descending order,
+        with ties in the order of the iterables.
+        """
+        merged = _merge_descending(
+            [[(5, 'a'), (3, 'a'), (1, 'a')], [], [(4, 'c'), (3, 'c')]],
+            key=lambda item: item[0],
+        )
+        self.assertEqual(
+            [(5, 'a'), (4, 'c'), (3, 'a'), (3, 'c'), (1, 'a')],
+            list(merged),
+        )
+
+    def test_lazy(self):
+        """
+        The iterables are consumed only as far as the merge goes.
+        """
+        consumed = []
+
+        def numbers(values):
+            for value in values:
+                consumed.append(value)
+                yield value
+
+        merged = _merge_descending(
+            [numbers([9, 8, 7]), numbers([6, 5])], key=lambda item: item
+        )
+        self.assertEqual(9, next(merged))
+        self.assertEqual([9, 6], consumed)
+
+
+class MakeIdTests(SynchronousTestCase):
+    """
+    Tests for ``_make_id``.
+    """
+    def test_compact(self):
+        """
+        Identifiers have 24 hex digits.
+        """
+        id = _make_id(datetime(2016, 1, 1), 1)
+        self.assertEqual(24, len(id))
+        int(id, 16)
+
+    def test_order(self):
+        """
+        Identifiers sort by the timestamp and then by the sequence number.
+        """
+        ids = [
+            _make_id(datetime(1970, 1, 1), 5),
+            _make_id(datetime(2016, 1, 1), 0),
+            _make_id(datetime(2016, 1, 1), 1),
+            _make_id(datetime(2016, 1, 1, 0, 0, 0, 1), 0),
+            _make_id(datetime(9999, 12, 31), 0),
+        ]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_timezone(self):
+        """
+        Timestamps with a timezone are ordered by their UTC time.
+        """
+        self.assertEqual(
+            _make_id(datetime(2016, 1, 1, 10), 0),
+            _make_id(datetime(2016, 1, 1, 12, tzinfo=tzoffset(None, 7200)), 0)
+        )
+
+
+def get_all_pages(case, backend, filter, limit, cursor=None):
+    """
+    Get all pages of the results of a synchronous backend.
+
+    :param cursor: The cursor of the first page, or None.
+    :return: The list of the results of every page.
+    """
+    pages = []
+    while True:
+        entries, cursor = case.successResultOf(
+            backend.page(filter, limit, cursor)
+        )
+        pages.append([result for (_, result) in entries])
+        if cursor is None:
+            return pages
+
+
+class InMemoryBackendTests(SynchronousTestCase):
+    """
+    Tests for ``InMemoryBackend``.
+    """
+    RESULT = {u"timestamp": u"2016-01-01T00:00:00"}
+
+    def test_delete_equal_timestamps(self):
+        """
+        Deleting one of the results with equal timestamps removes exactly
+        that result from the index.
+        """
+        backend = InMemoryBackend()
+        results = [dict(self.RESULT, value=value) for value in range(3)]
+        ids = [self.successResultOf(backend.store(r)) for r in results]
+        self.successResultOf(backend.delete(ids[1]))
+        self.assertEqual(
+            [results[2], results[0]],
+            self.successResultOf(backend.query({})),
+        )
+        self.assertEqual(sorted([ids[0], ids[2]]), list(backend._sorted))
+
+    def test_ids_ordered(self):
+        """
+        The identifiers of the results sort in the order of their
+        timestamps.
+        """
+        backend = InMemoryBackend()
+        later = self.successResultOf(backend.store(
+            {u"timestamp": u"2016-01-02T00:00:00"}
+        ))
+        earlier = self.successResultOf(backend.store(self.RESULT))
+        self.assertLess(earlier, later)
+
+    def test_load(self):
+        """
+        Loaded results keep their identifiers, are not loaded twice, and
+        do not share the sequence numbers of the later results.
+        """
+        source = InMemoryBackend()
+        results = [dict(self.RESULT, value=value) for value in range(3)]
+        ids = self.successResultOf(source.store_many(results))
+        backend = InMemoryBackend()
+        self.assertEqual(
+            ids, self.successResultOf(backend.load(zip(ids, results)))
+        )
+        self.successResultOf(backend.load(zip(ids, results)))
+        id = self.successResultOf(backend.store(self.RESULT))
+        [new_id] = self.successResultOf(
+            backend.load([(None, dict(self.RESULT, value=3))])
+        )
+        self.assertEqual(
+            sorted(ids + [id, new_id]), list(backend._sorted)
+        )
+        self.assertEqual(
+            self.successResultOf(source.query({})),
+            self.successResultOf(backend.query({}))[2:],
+        )
+
+    def test_latest_maintained(self):
+        """
+        The latest result of every group is kept up to date as results are
+        stored and deleted.
+        """
+        backend = InMemoryBackend()
+
+        def result(host, second):
+            return {u"userdata": {u"host": host},
+                    u"timestamp": u"2016-01-01T00:00:{:02d}".format(second)}
+
+        def latest():
+            return self.successResultOf(backend.latest({}, u"host"))
+
+        [a1, b2, a3] = self.successResultOf(backend.store_many(
+            [result(u"a", 1), result(u"b", 2), result(u"a", 3)]
+        ))
+        self.assertEqual([result(u"a", 3), result(u"b", 2)], latest())
+        b4 = self.successResultOf(backend.store(result(u"b", 4)))
+        self.assertEqual([result(u"b", 4), result(u"a", 3)], latest())
+        for id in (b4, a3, b2):
+            self.successResultOf(backend.delete(id))
+        self.assertEqual([result(u"a", 1)], latest())
+
+    def test_latest_keys_bounded(self):
+        """
+        Only the latest results of the most recently used fields are
+        indexed, and the results are scanned for the other fields.
+        """
+        backend = InMemoryBackend(latest_keys=2)
+        result = {u"userdata": {u"a": u"1", u"b": u"1", u"c": u"1"},
+                  u"timestamp": u"2016-01-01T00:00:00"}
+        self.successResultOf(backend.store(result))
+        for key in (u"a", u"b", u"a", u"c"):
+            self.assertEqual(
+                [result], self.successResultOf(backend.latest({}, key))
+            )
+        self.assertEqual([u"a", u"c"], list(backend._latest))
+
+    def test_latest_not_indexed(self):
+        """
+        The results are scanned for the latest results of every field if
+        no fields are indexed.
+        """
+        backend = InMemoryBackend(latest_keys=0)
+        results = [
+            {u"userdata": {u"host": host},
+             u"timestamp": u"2016-01-01T00:00:{:02d}".format(second)}
+            for host, second in [(u"a", 1), (u"b", 2), (u"a", 3)]
+        ]
+        self.successResultOf(backend.store_many(results))
+        self.assertEqual(
+            [results[2], results[1]],
+            self.successResultOf(backend.latest({}, u"host")),
+        )
+        self.assertEqual({}, backend._latest)
+
+    def test_page_equal_timestamps(self):
+        """
+        Pages split results with equal timestamps without repeating or
+        missing any of them.
+        """
+        backend = InMemoryBackend()
+        results = [dict(self.RESULT, value=value) for value in range(5)]
+        self.successResultOf(backend.store_many(results))
+        self.assertEqual(
+            [results[4:2:-1], results[2:0:-1], results[:1]],
+            get_all_pages(self, backend, {}, 2),
+        )
+
+    def test_cursor_before(self):
+        """
+        The page of the cursor made for a timestamp starts with the latest
+        result before it.
+        """
+        backend = InMemoryBackend()
+        results = [
+            {u"timestamp": u"2016-01-01T00:00:{:02d}".format(second)}
+            for second in range(4)
+        ]
+        self.successResultOf(backend.store_many(results))
+        cursor = backend.cursor_before(datetime(2016, 1, 1, 0, 0, 2))
+        self.assertEqual(
+            [results[1:2], results[:1]],
+            get_all_pages(self, backend, {}, 1, cursor),
+        )
+
+    def test_page_bad_cursor(self):
+        """
+        A cursor that is not an identifier is a bad request.
+        """
+        backend = InMemoryBackend()
+        self.failureResultOf(backend.page({}, 1, u"cursor"), BadRequest)
+
+    def test_store_many_bad_timestamp(self):
+        """
+        None of the results is stored if one of them has no valid
+        timestamp.
+        """
+        backend = InMemoryBackend()
+        self.assertRaises(
+            ValueError, backend.store_many, [self.RESULT, {u"timestamp": u"x"}]
+        )
+        self.assertRaises(
+            ValueError, backend.store_many,
+            [self.RESULT, {u"timestamp": u"9999-12-31T23:59:59-01:00"}]
+        )
+        self.assertEqual([], self.successResultOf(backend.query({})))
+
+
+class ShardedInMemoryBackendTests(SynchronousTestCase):
+    """
+    Tests for ``ShardedInMemoryBackend``.
+    """
+    def result(self, branch, second):
+        return {
+            u"userdata": {u"branch": branch},
+            u"timestamp": u"2016-01-01T00:00:{:02d}".format(second),
+        }
+
+    def test_filtered_query_one_shard(self):
+        """
+        A query filtered by the partitioning field is answered by the
+        shard of its value alone.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        result = self.result(u"1", 1)
+        backend.store(result)
+        index = backend._shard_index(result)
+        for shard in backend._shards:
+            if shard is not backend._shards[index]:
+                shard.query = shard._iter_matching = None
+        self.assertEqual(
+            [result],
+            self.successResultOf(backend.query(result)),
+        )
+
+    def test_unfiltered_query_merges(self):
+        """
+        An unfiltered query returns the latest results of all the shards.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        results = [
+            self.result(unicode(branch), branch) for branch in range(10)
+        ]
+        for result in results:
+            backend.store(result)
+        self.assertEqual(
+            results[::-1][:3],
+            self.successResultOf(backend.query({}, limit=3)),
+        )
+
+    def test_unfiltered_page_merges(self):
+        """
+        Pages of an unfiltered query return the results of all the shards
+        in the order of the query, including the results with equal
+        timestamps in different shards.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        results = [
+            self.result(unicode(branch), branch // 3) for branch in range(10)
+        ]
+        self.successResultOf(backend.store_many(results))
+        expected = self.successResultOf(backend.query({}))
+        for limit in (1, 2, 3):
+            pages = get_all_pages(self, backend, {}, limit)
+            self.assertEqual(expected, sum(pages, []))
+
+    def test_cursor_before(self):
+        """
+        The pages from the cursor made for a timestamp return the results
+        of all the shards before it.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        results = [
+            self.result(unicode(branch), branch // 3) for branch in range(10)
+        ]
+        self.successResultOf(backend.store_many(results))
+        cursor = backend.cursor_before(datetime(2016, 1, 1, 0, 0, 2))
+        pages = get_all_pages(self, backend, {}, 2, cursor)
+        self.assertEqual(
+            self.successResultOf(backend.query({}))[-6:], sum(pages, [])
+        )
+
+    def test_latest_merges(self):
+        """
+        The latest results of the groups are combined over all the shards
+        if the results are not grouped by the partitioning field.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        results = [
+            dict(self.result(unicode(branch), branch),
+                 userdata={u"branch": unicode(branch), u"host": host})
+            for branch, host in enumerate(u"abcabca")
+        ]
+        self.successResultOf(backend.store_many(results))
+        self.assertEqual(
+            [results[6], results[5]],
+            self.successResultOf(backend.latest({}, u"host", limit=2)),
+        )
+
+    def test_custom_key(self):
+        """
+        The results can be partitioned by any userdata field.
+        """
+        backend = ShardedInMemoryBackend(shards=4, key=u"host")
+        result = {u"userdata": {u"host": u"a"},
+                  u"timestamp": u"2016-01-01T00:00:00"}
+        id = self.successResultOf(backend.store(result))
+        self.assertEqual(result, self.successResultOf(backend.retrieve(id)))
+        self.assertEqual(
+            [result],
+            self.successResultOf(backend.query({u"userdata": {u"host": u"a"}}))
+        )
+
+    def test_bad_id(self):
+        """
+        Identifiers that do not encode a shard are reported as bad.
+        """
+        backend = ShardedInMemoryBackend(shards=4)
+        self.failureResultOf(backend.retrieve(u"zz"), BadResultId)
+        self.failureResultOf(backend.delete(u"0"), BadResultId)
+        self.failureResultOf(backend.retrieve(u"abc03"), ResultNotFound)
+
+    def test_load(self):
+        """
+        Loaded results keep their identifiers if they are in the shards of
+        their results.
+        """
+        results = [self.result(unicode(branch), branch) for branch in range(5)]
+        source = ShardedInMemoryBackend(shards=4)
+        ids = self.successResultOf(source.store_many(results))
+        backend = ShardedInMemoryBackend(shards=4)
+        self.assertEqual(
+            ids, self.successResultOf(backend.load(zip(ids, results)))
+        )
+        other = ShardedInMemoryBackend(shards=3)
+        other_ids = self.successResultOf(other.load(zip(ids, results)))
+        self.assertEqual(
+            results,
+            [self.successResultOf(other.retrieve(id)) for id in other_ids],
+        )
+
+
+class RoutingBackendTests(SynchronousTestCase):
+    """
+    Tests for ``RoutingBackend``.
+    """
+    def setUp(self):
+        self.backends = {name: InMemoryBackend() for name in 'abcd'}
+        self.backend = RoutingBackend(self.backends)
+
+    def result(self, branch, second):
+        return {
+            u"userdata": {u"branch": branch},
+            u"timestamp": u"2016-01-01T00:00:{:02d}".format(second),
+        }
+
+    def test_route_by_branch(self):
+        """
+        Results of a branch are stored in the same backend, whose name
+        is the prefix of their identifiers.
+        """
+        names = set()
+        for second in range(5):
+            id = self.successResultOf(
+                self.backend.store(self.result(u"1", second))
+            )
+            names.add(id.split('-')[0])
+        [name] = names
+        self.assertEqual(
+            5, len(self.successResultOf(self.backends[name].query({})))
+        )
+
+    def test_spread(self):
+        """
+        Results of many branches are spread over all the backends.
+        """
+        for branch in range(100):
+            self.backend.store(self.result(unicode(branch), 0))
+        for backend in self.backends.values():
+            self.assertNotEqual([], self.successResultOf(backend.query({})))
+
+    def test_load(self):
+        """
+        Loaded results keep their identifiers if they are routed to the
+        backends named by them.
+        """
+        results = [self.result(unicode(branch), branch) for branch in range(9)]
+        ids = self.successResultOf(self.backend.store_many(results))
+        backend = RoutingBackend(
+            {name: InMemoryBackend() for name in self.backends}
+        )
+        self.assertEqual(
+            ids, self.successResultOf(backend.load(zip(ids, results)))
+        )
+        [new_id] = self.successResultOf(
+            backend.load([(u"x-" + ids[0], results[0])])
+        )
+        self.assertNotEqual(ids[0], new_id)
+
+    def test_consistent(self):
+        """
+        Adding a backend moves only a part of the branches to it.
+        """
+        bigger = RoutingBackend(dict(self.backends, e=InMemoryBackend()))
+        moved = [
+            branch for branch in range(1000)
+            if self.backend._route(branch) != bigger._route(branch)
+        ]
+        self.assertEqual(
+            set(['e']), set(bigger._route(branch) for branch in moved)
+        )
+        self.assertTrue(100 < len(moved) < 300, len(moved))
+
+    def test_query_merges(self):
+        """
+        An unfiltered query returns the latest results of all the
+        backends.
+        """
+        results = [
+            self.result(unicode(branch), branch) for branch in range(10)
+        ]
+        for result in results:
+            self.backend.store(result)
+        self.assertEqual(
+            results[::-1][:4],
+            self.successResultOf(self.backend.query({}, limit=4)),
+        )
+
+    def test_mixed_timezones(self):
+        """
+        Results with naive timestamps in some backends and timestamps with
+        a timezone in others are merged by their time in UTC.
+        """
+        branches = {}
+        for branch in range(100):
+            branches.setdefault(
+                self.backend._route(unicode(branch)), unicode(branch)
+            )
+        first, second = sorted(branches.values())[:2]
+        results = [
+            {u"userdata": {u"branch": first, u"host": u"a"},
+             u"timestamp": u"2016-01-01T00:30:00"},
+            {u"userdata": {u"branch": second, u"host": u"a"},
+             u"timestamp": u"2016-01-01T01:00:00+01:00"},
+        ]
+        self.successResultOf(self.backend.store_many(results))
+        self.assertEqual(
+            results, self.successResultOf(self.backend.query({}))
+        )
+        self.assertEqual(
+            [results], get_all_pages(self, self.backend, {}, None)
+        )
+        self.assertEqual(
+            results[:1],
+            self.successResultOf(self.backend.latest({}, u"host")),
+        )
+
+    def test_bad_id(self):
+        """
+        Identifiers that do not name a backend are reported as bad.
+        """
+        self.failureResultOf(self.backend.retrieve("x-1"), BadResultId)
+        self.failureResultOf(self.backend.delete("a"), BadResultId)
+        self.failureResultOf(self.backend.retrieve("a-1"), ResultNotFound)
+
+    def test_store_many(self):
+        """
+        Results stored at once are routed to the backends of their
+        branches and their identifiers are returned in order.
+        """
+        results = [
+            self.result(unicode(branch), branch) for branch in range(10)
+        ]
+        ids = self.successResultOf(self.backend.store_many(results))
+        self.assertEqual(
+            results,
+            [self.successResultOf(self.backend.retrieve(id)) for id in ids],
+        )
+        for result, id in zip(results, ids):
+            self.assertEqual(
+                self.backend._route(result[u"userdata"][u"branch"]),
+                id.split('-')[0],
+            )
+
+    def test_unfiltered_page_merges(self):
+        """
+        Pages of an unfiltered query return the results of all the
+        backends in the order of the query.
+        """
+        results = [
+            self.result(unicode(branch), branch // 2) for branch in range(20)
+        ]
+        self.successResultOf(self.backend.store_many(results))
+        expected = self.successResultOf(self.backend.query({}))
+        for limit in (1, 3, 7):
+            pages = get_all_pages(self, self.backend, {}, limit)
+            self.assertEqual(expected, sum(pages, []))
+
+    def test_latest_combines(self):
+        """
+        The latest results of the groups are combined over all the
+        backends and only the requested fields are returned.
+        """
+        results = [
+            dict(self.result(unicode(branch), branch),
+                 userdata={u"branch": unicode(branch), u"host": host})
+            for branch, host in enumerate(u"abcabcab")
+        ]
+        self.successResultOf(self.backend.store_many(results))
+        self.assertEqual(
+            [{u"timestamp": u"2016-01-01T00:00:07"},
+             {u"timestamp": u"2016-01-01T00:00:06"}],
+            self.successResultOf(
+                self.backend.latest({}, u"host", 2, [u"timestamp"])
+            ),
+        )
+
+    def test_page_bad_cursor(self):
+        """
+        A cursor that is not valid is a bad request.
+        """
+        unknown = urlsafe_b64encode(dumps({u"z": [None, 0]}))
+        for cursor in [u"nonsense", unknown]:
+            self.failureResultOf(self.backend.page({}, 1, cursor), BadRequest)
+
+
+class BackendOptionsTests(SynchronousTestCase):
+    """
+    Tests for the loading of the backends.
+    """
+    def test_load_backend(self):
+        """
+        The built-in backends are loaded by their names.
+        """
+        self.assertIs(InMemoryBackend, load_backend('in-memory'))
+        self.assertRaises(KeyError, load_backend, 'no-such-backend')
+
+    def test_options(self):
+        """
+        The selected backend is created with its options.
+        """
+        options = ServerOptions()
+        options.parseOptions(
+            ['--backend', 'sharded-in-memory', '--shard-count', '2',
+             '--latest-keys', '3', '--restore', 'archive.gz']
+        )
+        backend = options['backend']
+        self.assertIsInstance(backend, ShardedInMemoryBackend)
+        self.assertEqual(2, len(backend._shards))
+        self.assertEqual(3, backend._shards[0].latest_keys)
+        self.assertEqual('archive.gz', options['restore'])
+
+    def test_import_lazily(self):
+        """
+        Importing the API does not import the MongoDB driver, nor the
+        MessagePack package.
+        """
+        output = check_output([
+            sys.executable, '-c',
+            'import sys, benchmark.httpapi; '
+            'print(sorted(set(sys.modules) & '
+            '{"bson", "msgpack", "pymongo", "txmongo"}))'
+        ], cwd=dirname(dirname(benchmark.__file__)))
+        self.assertEqual('[]', output.strip())
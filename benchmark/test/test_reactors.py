@@ -0,0 +1,57 @@
+import sys
+
+from os.path import dirname
+from subprocess import check_output
+
+from twisted.internet.defer import succeed
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import SynchronousTestCase
+
+import benchmark
+from benchmark.reactors import ReactorOptions
+
+
+def main(reactor, args):
+    """
+    The command run on the chosen reactor by the tests, which reports the
+    reactor and its arguments.
+    """
+    sys.stdout.write('{} {}\n'.format(type(reactor).__name__, args))
+    return succeed(None)
+
+
+class ReactorOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``ReactorOptions``.
+    """
+    def test_arguments(self):
+        """
+        The options that follow the module are its arguments.
+        """
+        options = ReactorOptions()
+        options.parseOptions(
+            ['--reactor', 'poll', 'benchmark.httpapi', '--port', '80']
+        )
+        self.assertEqual(
+            ('poll', 'benchmark.httpapi', ['--port', '80']),
+            (options['reactor'], options['module'], options['args']),
+        )
+
+    def test_unknown_reactor(self):
+        """
+        Only the reactors known to Twisted are accepted.
+        """
+        self.assertRaises(
+            UsageError, ReactorOptions().parseOptions,
+            ['--reactor', 'no-such-reactor', 'benchmark.httpapi'],
+        )
+
+    def test_run(self):
+        """
+        The main function of the module is run on the chosen reactor.
+        """
+        output = check_output([
+            sys.executable, '-m', 'benchmark.reactors', '--reactor', 'poll',
+            'benchmark.test.test_reactors', 'a',
+        ], cwd=dirname(dirname(benchmark.__file__)))
+        self.assertEqual("PollReactor ['a']", output.strip())
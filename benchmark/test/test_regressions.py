@@ -0,0 +1,263 @@
+from datetime import datetime, timedelta
+from json import dumps
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.httpapi import InMemoryBackend
+from benchmark.regressions import RegressionIndex, SeriesStats
+
+
+def result(n, value, branch=u"master", **userdata):
+    userdata[u"branch"] = branch
+    return {
+        u"timestamp": (datetime(2016, 1, 1) + timedelta(hours=n)).isoformat(),
+        u"result": value,
+        u"userdata": userdata,
+    }
+
+
+# Values that vary around 10.
+STEADY = [10, 11, 9, 10, 12, 8, 10, 11, 9, 10]
+
+
+class SeriesStatsTests(SynchronousTestCase):
+    """
+    Tests for ``SeriesStats``.
+    """
+    def assertWithin(self, expected, actual, delta=1e-9):
+        self.assertTrue(
+            abs(expected - actual) <= delta,
+            "{} != {} within {}".format(expected, actual, delta),
+        )
+
+    def test_moments(self):
+        """
+        The mean and the sample variance are those of all the values.
+        """
+        stats = SeriesStats()
+        for value in STEADY:
+            stats.add(value)
+        self.assertWithin(10, stats.mean)
+        self.assertWithin(12 / 9.0, stats.variance)
+        self.assertEqual((10, 10), (stats.count, stats.latest))
+
+    def test_not_finite(self):
+        """
+        Infinite and NaN values are ignored.
+        """
+        stats = SeriesStats()
+        for value in STEADY[:5] + [float('inf'), float('nan')] + STEADY[5:]:
+            stats.add(value)
+        self.assertEqual((10, 10), (stats.count, stats.latest))
+        self.assertWithin(12 / 9.0, stats.variance)
+        self.assertNotIn('NaN', dumps(stats.to_dict()))
+
+    def test_ewma(self):
+        """
+        The moving average starts at the first value and moves towards the
+        later values by ``alpha``.
+        """
+        stats = SeriesStats(alpha=0.5)
+        for value in (4, 8, 0):
+            stats.add(value)
+        self.assertWithin(3, stats.ewma)
+
+    def test_zscore(self):
+        """
+        The z-score of the latest value is taken against the values before
+        it, and is None while they do not vary.
+        """
+        stats = SeriesStats()
+        stats.add(1)
+        stats.add(1)
+        stats.add(5)
+        self.assertIs(None, stats.zscore)
+        stats.add(1)
+        # The mean of 1, 1 and 5 is 7/3 and their deviation is 4/sqrt(3).
+        self.assertWithin(-1 / 3 ** 0.5, stats.zscore)
+
+    def test_add_earlier(self):
+        """
+        A value added as earlier than the latest counts towards the mean
+        and the variance only.
+        """
+        stats = SeriesStats()
+        for value in STEADY[:-1]:
+            stats.add(value)
+        latest = (stats.latest, stats.ewma, stats.zscore, stats.cusum)
+        stats.add_earlier(STEADY[-1])
+        stats.add_earlier(float('nan'))
+        self.assertEqual(
+            latest, (stats.latest, stats.ewma, stats.zscore, stats.cusum)
+        )
+        self.assertEqual(10, stats.count)
+        self.assertWithin(12 / 9.0, stats.variance)
+
+    def test_cusum(self):
+        """
+        The CUSUM grows while the values keep deviating in one direction,
+        even when none of them deviates much.
+        """
+        stats = SeriesStats()
+        for value in STEADY:
+            stats.add(value)
+        self.assertTrue(abs(stats.cusum) < 2)
+        for value in [12] * 8:
+            stats.add(value)
+        self.assertTrue(stats.zscore < 1)
+        self.assertTrue(stats.cusum > 5)
+        for value in [8] * 20:
+            stats.add(value)
+        self.assertTrue(stats.cusum < -5)
+
+
+class RegressionIndexTests(SynchronousTestCase):
+    """
+    Tests for ``RegressionIndex``.
+    """
+    def test_series(self):
+        """
+        The results are grouped into series by the identifying fields of
+        their userdata.  Results without a numeric value are ignored.
+        """
+        index = RegressionIndex(fields=[u"branch", u"host"])
+        index.add('a', result(0, 1, host=u"a", run=1))
+        index.add('b', result(1, 2, host=u"a", run=2))
+        index.add('c', result(2, 3, host=u"b"))
+        index.add('d', result(3, 4, branch=u"other"))
+        index.add('e', result(4, u"fast"))
+        index.add('f', result(5, float('nan')))
+        self.assertEqual(
+            [({u"branch": u"master", u"host": u"a"}, 2),
+             ({u"branch": u"master", u"host": u"b"}, 1)],
+            sorted(
+                (identity, stats.count)
+                for identity, stats in index.series(u"master")
+            ),
+        )
+        self.assertEqual(3, len(index.series()))
+
+    def test_deviating(self):
+        """
+        The series whose latest value deviates are listed, once they have
+        enough values, the most deviating first.
+        """
+        index = RegressionIndex()
+        for branch, last in ((u"steady", 10), (u"slow", 20), (u"slower", 30),
+                             (u"short", 30)):
+            values = STEADY + [last]
+            if branch == u"short":
+                values = values[-3:]
+            for n, value in enumerate(values):
+                index.add(str(n), result(n, value, branch))
+        self.assertEqual(
+            [{u"branch": u"slower"}, {u"branch": u"slow"}],
+            [identity for identity, _ in index.deviating()],
+        )
+        self.assertEqual(
+            [{u"branch": u"slower"}],
+            [identity for identity, _
+             in index.deviating(threshold=10, cusum_threshold=100)],
+        )
+        self.assertEqual(
+            [{u"branch": u"short"}, {u"branch": u"slower"},
+             {u"branch": u"slow"}],
+            [identity for identity, _ in index.deviating(min_count=3)],
+        )
+
+    def test_rebuild(self):
+        """
+        Rebuilding replaces the statistics with those of the results in the
+        backend, added from the oldest to the latest.
+        """
+        backend = InMemoryBackend()
+        backend.store_many(
+            [result(n, value) for n, value in enumerate(STEADY + [20])]
+        )
+        index = RegressionIndex()
+        index.add('x', result(0, 1000))
+        self.successResultOf(index.rebuild(backend, page_size=3))
+        [(_, stats)] = index.series()
+        self.assertEqual((11, 20), (stats.count, stats.latest))
+        self.assertTrue(stats.zscore > 3)
+
+    def test_add_while_rebuilding(self):
+        """
+        The results added while rebuilding are counted once, after the
+        results read from the backend.
+        """
+        backend = InMemoryBackend()
+        backend.store(result(0, 1))
+        pages = []
+
+        def page(*args):
+            d = Deferred()
+            pages.append((d, args))
+            return d
+
+        backend.page = page
+        index = RegressionIndex()
+        d = index.rebuild(backend)
+        id = self.successResultOf(backend.store(result(1, 2)))
+        index.add(id, result(1, 2))
+        while pages:
+            page_read, args = pages.pop(0)
+            InMemoryBackend.page(backend, *args).chainDeferred(page_read)
+        self.successResultOf(d)
+        [(_, stats)] = index.series()
+        self.assertEqual((2, 2), (stats.count, stats.latest))
+
+    def test_store_while_rebuilding(self):
+        """
+        The pages are read again from the oldest up to the results they
+        started with, even if earlier results were stored after the pages
+        were found.
+        """
+        backend = InMemoryBackend()
+        backend.store_many([result(n, n) for n in range(4)])
+        page = backend.page
+        index = RegressionIndex()
+
+        def store_first(*args):
+            # Store a result within the oldest page once the pages have
+            # been found.
+            if args[3] is None:
+                id = self.successResultOf(backend.store(result(0.5, 10)))
+                index.add(id, result(0.5, 10))
+                backend.page = page
+            return page(*args)
+
+        backend.page = store_first
+        self.successResultOf(index.rebuild(backend, page_size=2))
+        [(_, stats)] = index.series()
+        self.assertEqual((5, 3), (stats.count, stats.latest))
+        self.assertAlmostEqual(16 / 5.0, stats.mean)
+
+    def test_timestamp_order(self):
+        """
+        The values are taken in the order of the timestamps of the results,
+        whether they are stored in that order or not, so the statistics
+        are the same once rebuilt.  An earlier result stored after a later
+        one only counts towards the mean and the deviation.
+        """
+        results = [result(n, value) for n, value in enumerate(STEADY)]
+        index = RegressionIndex()
+        for n, stored in enumerate(results[5:] + results[:5]):
+            index.add(str(n), stored)
+        [(_, stats)] = index.series()
+        self.assertEqual((10, 10), (stats.count, stats.latest))
+        self.assertEqual(results[-1][u"timestamp"], stats.timestamp)
+
+        backend = InMemoryBackend()
+        backend.store_many(results)
+        rebuilt = RegressionIndex()
+        self.successResultOf(rebuilt.rebuild(backend, page_size=3))
+        [(_, rebuilt_stats)] = rebuilt.series()
+        self.assertEqual(
+            (stats.count, stats.latest, stats.timestamp),
+            (rebuilt_stats.count, rebuilt_stats.latest,
+             rebuilt_stats.timestamp),
+        )
+        self.assertAlmostEqual(stats.mean, rebuilt_stats.mean)
+        self.assertAlmostEqual(stats.variance, rebuilt_stats.variance)
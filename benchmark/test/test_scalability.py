@@ -0,0 +1,148 @@
+from itertools import count
+
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+
+from benchmark.httpapi import InMemoryBackend
+from benchmark.scalability import (
+    ScalabilityBenchmark, format_report, measure_import, percentile,
+    serve_http,
+)
+
+
+class PercentileTests(SynchronousTestCase):
+    """
+    Tests for ``percentile``.
+    """
+    def test_nearest_rank(self):
+        """
+        The percentile is the smallest value that is not less than the
+        given percentage of the values.
+        """
+        values = range(1, 11)
+        self.assertEqual(
+            [1, 5, 9, 10, 10],
+            [percentile(values, p) for p in (0, 50, 90, 95, 100)],
+        )
+
+    def test_empty(self):
+        """
+        There is no percentile of no values.
+        """
+        self.assertIs(None, percentile([], 50))
+
+
+class ScalabilityBenchmarkTests(SynchronousTestCase):
+    """
+    Tests for ``ScalabilityBenchmark``.
+    """
+    def run_benchmark(self, backend):
+        # Every reading of the clock is a second later.
+        clock = count().next
+        benchmark = ScalabilityBenchmark(
+            backend, [20, 5], samples=4, limits=[2], branches=3,
+            batch_size=3, clock=lambda: float(clock()),
+        )
+        return self.successResultOf(benchmark.run())
+
+    def test_measurements(self):
+        """
+        Every operation is measured at every size, in the order of the
+        sizes.
+        """
+        measurements = self.run_benchmark(InMemoryBackend())
+        self.assertEqual(
+            [('store', {}), ('retrieve', {}),
+             ('query', {'limit': 2, 'filtered': False}),
+             ('query', {'limit': 2, 'filtered': True}),
+             ('delete', {})] * 2,
+            [(m['operation'], m['parameters']) for m in measurements],
+        )
+        self.assertEqual(
+            [5] * 5 + [20] * 5, [m['size'] for m in measurements]
+        )
+        self.assertEqual(
+            ({'p50': 1.0, 'p90': 1.0, 'p99': 1.0, 'max': 1.0}, 4),
+            (measurements[0]['latency'], measurements[0]['samples']),
+        )
+
+    def test_size(self):
+        """
+        The backend holds as many results as the largest size after the
+        benchmark.
+        """
+        backend = InMemoryBackend()
+        self.run_benchmark(backend)
+        self.assertEqual(
+            20, len(self.successResultOf(backend.query({}, None)))
+        )
+
+    def test_report(self):
+        """
+        The report shows the change of the throughput from the same
+        measurement in the baseline.
+        """
+        measurements = self.run_benchmark(InMemoryBackend())
+        baseline = [dict(m, ops_per_second=m['ops_per_second'] * 2)
+                    for m in measurements]
+        lines = format_report(measurements, baseline)
+        self.assertEqual(len(measurements) + 1, len(lines))
+        self.assertTrue(lines[1].endswith('-50%'))
+
+
+class ServeHTTPTests(TestCase):
+    """
+    Tests for ``serve_http``.
+    """
+    def test_benchmark(self):
+        """
+        The operations on the served backend are made through the API.
+        """
+        backend = InMemoryBackend()
+        d = serve_http(backend)
+
+        def run((port, client)):
+            self.addCleanup(port.stopListening)
+            self.addCleanup(client.disconnect)
+            benchmark = ScalabilityBenchmark(
+                client, [10], samples=2, limits=[2], branches=3,
+                batch_size=4, name='InMemoryBackend over HTTP',
+            )
+            return benchmark.run()
+
+        def check(measurements):
+            self.assertEqual(
+                [('InMemoryBackend over HTTP', 2)] * 5,
+                [(m['backend'], m['samples']) for m in measurements],
+            )
+            self.assertEqual(
+                10, len(self.successResultOf(backend.query({}, None)))
+            )
+
+        d.addCallback(run)
+        d.addCallback(check)
+        return d
+
+
+class MeasureImportTests(TestCase):
+    """
+    Tests for ``measure_import``.
+    """
+    def test_measure(self):
+        """
+        The import of a module is timed in new processes.
+        """
+        d = measure_import('benchmark.dedup', 'InMemoryBackend', samples=2)
+
+        def check(measurement):
+            self.assertEqual(
+                ('InMemoryBackend', 0, 'import',
+                 {'module': 'benchmark.dedup'}, 2),
+                (measurement['backend'], measurement['size'],
+                 measurement['operation'], measurement['parameters'],
+                 measurement['samples']),
+            )
+            self.assertTrue(measurement['latency']['max'] > 0)
+            self.assertTrue(measurement['max_rss'] > 0)
+
+        d.addCallback(check)
+        return d
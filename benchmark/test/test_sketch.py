@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import SynchronousTestCase
+
+from benchmark.httpapi import InMemoryBackend
+from benchmark.sketch import DDSketch, SketchIndex
+
+
+def result(day, value, branch=u"master"):
+    return {
+        u"timestamp": datetime(2016, 1, day, 12).isoformat(),
+        u"result": value,
+        u"userdata": {u"branch": branch},
+    }
+
+
+class DDSketchTests(SynchronousTestCase):
+    """
+    Tests for ``DDSketch``.
+    """
+    def assertWithin(self, expected, actual, error):
+        self.assertTrue(
+            abs(expected - actual) <= abs(expected) * error,
+            "{} is not within {:%} of {}".format(actual, error, expected),
+        )
+
+    def test_relative_accuracy(self):
+        """
+        The quantiles are within the relative accuracy of the true values,
+        for values over several orders of magnitude.
+        """
+        sketch = DDSketch(0.01)
+        values = [1.1 ** i for i in range(200)]
+        for value in values:
+            sketch.add(value)
+        for q in (0.1, 0.5, 0.9, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertWithin(expected, sketch.quantile(q), 0.01)
+
+    def test_extremes(self):
+        """
+        The minimum and the maximum are exact, including for negative
+        values and zeros.
+        """
+        sketch = DDSketch()
+        for value in (-7.3, 0, 0, 12.9):
+            sketch.add(value)
+        self.assertEqual(
+            [-7.3, 0, 0, 12.9],
+            [sketch.quantile(q) for q in (0, 0.34, 0.66, 1)],
+        )
+
+    def test_merge(self):
+        """
+        A merged sketch estimates the quantiles of the values of both
+        sketches.
+        """
+        first, second = DDSketch(), DDSketch()
+        for value in range(1, 51):
+            first.add(value)
+        for value in range(51, 101):
+            second.add(value)
+        first.merge(second)
+        self.assertEqual((100, 1, 100), (first.count, first.min, first.max))
+        self.assertWithin(75, first.quantile(0.75), 0.01)
+
+    def test_merge_different_accuracy(self):
+        """
+        Sketches with different accuracies can not be merged.
+        """
+        self.assertRaises(ValueError, DDSketch(0.01).merge, DDSketch(0.02))
+
+    def test_empty(self):
+        """
+        An empty sketch has no quantiles.
+        """
+        self.assertIs(None, DDSketch().quantile(0.5))
+
+    def test_not_finite(self):
+        """
+        Infinite and NaN values can not be added.
+        """
+        sketch = DDSketch()
+        for value in (float('inf'), float('-inf'), float('nan')):
+            self.assertRaises(ValueError, sketch.add, value)
+        self.assertEqual(0, sketch.count)
+
+
+class SketchIndexTests(SynchronousTestCase):
+    """
+    Tests for ``SketchIndex``.
+    """
+    def test_branches_and_range(self):
+        """
+        The sketches are merged over the buckets of the range, for one
+        branch or for all of them.
+        """
+        index = SketchIndex()
+        index.add('a', result(1, 1))
+        index.add('b', result(2, 2))
+        index.add('c', result(3, 3, branch=u"other"))
+        index.add('d', result(4, 4))
+        self.assertEqual(
+            [2, 4, 2],
+            [index.sketch(u"master", start=datetime(2016, 1, 2)).count,
+             index.sketch().count,
+             index.sketch(start=datetime(2016, 1, 2, 23),
+                          end=datetime(2016, 1, 4)).count],
+        )
+
+    def test_not_numeric(self):
+        """
+        Results without a numeric value are ignored.
+        """
+        index = SketchIndex()
+        for value in (u"fast", True, None):
+            index.add('a', result(1, value))
+        self.assertEqual(0, index.sketch().count)
+
+    def test_not_finite(self):
+        """
+        Results with infinite or NaN values, or with integers too large to
+        be taken as floats, are ignored.
+        """
+        index = SketchIndex()
+        for value in (float('inf'), float('-inf'), float('nan'), 10 ** 400):
+            index.add('a', result(1, value))
+        index.add('b', result(1, 1))
+        self.assertEqual(1, index.sketch().count)
+
+    def test_bucket_size(self):
+        """
+        The range is extended to whole buckets.
+        """
+        index = SketchIndex(bucket=timedelta(hours=1))
+        index.add('a', result(1, 1))
+        self.assertEqual(
+            [1, 0],
+            [index.sketch(start=datetime(2016, 1, 1, 12, 59)).count,
+             index.sketch(start=datetime(2016, 1, 1, 13)).count],
+        )
+
+    def test_rebuild(self):
+        """
+        Rebuilding replaces the sketches with those of the results in the
+        backend.
+        """
+        backend = InMemoryBackend()
+        backend.store_many([result(day, day) for day in range(1, 6)])
+        index = SketchIndex()
+        index.add('x', result(1, 1000))
+        self.successResultOf(index.rebuild(backend, page_size=2))
+        sketch = index.sketch()
+        self.assertEqual((5, 5), (sketch.count, sketch.max))
+
+    def test_add_while_rebuilding(self):
+        """
+        The results added while rebuilding are counted once, even if they
+        are read from the backend too.
+        """
+        backend = InMemoryBackend()
+        pages = []
+
+        def page(*args):
+            d = Deferred()
+            pages.append((d, args))
+            return d
+
+        backend.page = page
+        index = SketchIndex()
+        d = index.rebuild(backend)
+        [(first, args)] = pages
+        id = self.successResultOf(backend.store(result(1, 1)))
+        index.add(id, result(1, 1))
+        InMemoryBackend.page(backend, *args).chainDeferred(first)
+        self.successResultOf(d)
+        self.assertEqual(1, index.sketch().count)
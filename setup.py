@@ -25,8 +25,19 @@ setup(
     extras_require={
         # This extra is for developers who need to work on the code.
         "dev": read('dev-requirements.txt'),
+        # MessagePack request and response bodies.
+        "msgpack": "msgpack>=0.5.2",
+    },
+    entry_points={
+        # The backends are loaded by these names.  The built-in ones are
+        # also known without scanning the entry points.
+        'benchmark.backends': [
+            'in-memory = benchmark.httpapi:InMemoryBackend',
+            'sharded-in-memory = benchmark.httpapi:ShardedInMemoryBackend',
+            'mongodb = benchmark.mongo:TxMongoBackend',
+            'routing = benchmark.httpapi:RoutingBackend',
+        ],
     },
-    entry_points={},
     keywords="",
     license="Apache 2.0",
     url="https://github.com/ClusterHQ/benchmark-server/",